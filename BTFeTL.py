@@ -1,29 +1,31 @@
 #!/usr/bin/env python3
-from datetime import datetime, date
+from datetime import datetime
 import logging
-import linecache
-import sys
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
+import numpy as np
 import pandas as pd
 
+from errors import get_exception
+import instrumentation
+from kernels import event_starts, forward_fill, interpolate_forward, level_roc, prepare_tank
+from output_writers import make_writer
+from resampling import resample_raw_data
+from tank_registry import DEFAULT_CAPACITIES, TANK_COLUMNS, Tank_Config, column_positions, get_registry, split_pumps
 
-def get_exception() -> str:
-    """
-    A function which returns Exception details in the format
-    'Failure at {file_name}: {line_number} [{line}] - {exception_message}'
-
-    Args:
 
-    Returns: Formatted string with exception details
+DISCHARGE_COLUMNS = ['Event_Id', 'Time (Duration)', 'Time (First)', 'Time (Last)', 'Level (Mean)', 'Level (Min*)',
+                     'Level (Max*)', 'Temp. (Mean)', 'Temp. (Min*)', 'Temp. (Max*)', 'Seconds', 'Total Volume',
+                     'Event_rate(Appr.)', 'Minutes', 'Hours', 'Quantity', 'Event_rate(hr)', 'Event_rate(min)',
+                     'Event Type', 'Tank', 'Supply discharge pump%']
+UNLOADING_COLUMNS = DISCHARGE_COLUMNS[:-1] + ['TFMEUnloadSpotRail', 'Supply discharge pump%']
+RESULT_COLUMNS = DISCHARGE_COLUMNS + ['TFMEUnloadSpotRail']
 
-    """
-    exc_type, exc_obj, tb = sys.exc_info()
-    f = tb.tb_frame
-    line_no = tb.tb_lineno
-    file_name = f.f_code.co_filename
-    linecache.checkcache(file_name)
-    line = linecache.getline(file_name, line_no, f.f_globals)
-    return f'Failure at {file_name}: {line_no} [{line.strip()}] - {exc_obj}'
+# Input of the worker processes of transform_tanks_parallel, set by attach_shared_input
+_shared_input = None
 
 
 def duration_string(x: int) -> str:
@@ -34,7 +36,419 @@ def duration_string(x: int) -> str:
     return string
 
 
-def data_transformation(raw_data):
+def as_float(series: pd.Series) -> pd.Series:
+    """
+    Float64 values of a raw column. Columns typed by the extraction (float32, Int8) are only upcast,
+    object columns, e.g. from a csv, are still parsed
+    """
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return series.astype(np.float64)
+    return pd.to_numeric(series)
+
+
+def tank_capacity(tank, capacity=None) -> float:
+    """
+    Capacity of an underground tank, NaN for the others.
+    capacity is the value of the registry's Capacity column when the caller has it
+    """
+    if capacity is not None:
+        return capacity
+    return DEFAULT_CAPACITIES.get(f'{tank}', np.nan)
+
+
+# Aggregates of an event, only cython reductions so pandas never falls back to Python callables
+EVENT_AGGREGATES = {'Time (First)': ('Time', 'min'),
+                    'Time (Last)': ('Time', 'max'),
+                    'Level (Mean)': ('Level', 'mean'),
+                    'Level (Min*)': ('Level', 'min'),
+                    'Level (Max*)': ('Level', 'max'),
+                    'Temp. (Mean)': ('Temp.', 'mean'),
+                    'Temp. (Min*)': ('Temp.', 'min'),
+                    'Temp. (Max*)': ('Temp.', 'max'),
+                    'Total Volume': ('UsableTankVolume', 'mean'),
+                    'OnePercentLITDelta (Mean)': ('OnePercentLITDelta', 'mean'),
+                    'Density (Mean)': ('Density', 'mean'),
+                    'Supply discharge pump%': ('Disc_Output', 'mean')}
+
+
+def aggregate_events(main_df: pd.DataFrame, keys: list) -> pd.DataFrame:
+    """
+    Event segmentation kernel: splits the prepared rows on pump state and Event_Id and computes
+    the aggregates of discharge (PumpRunning == 0) and unloading (PumpRunning == 1) events in one grouped pass
+
+    Args:
+    :main_df (pd.DataFrame): prepared rows with Time, Level, Temp., Density, Disc_Output,
+                             OnePercentLITDelta, UsableTankVolume, PumpRunning and Event_Id
+    :keys (list): grouping columns, ending with 'PumpRunning' and 'Event_Id'
+
+    Returns: one row per event, discharge events first
+    """
+    main_df = main_df[main_df['PumpRunning'].isin([0, 1])]
+    return main_df.groupby(keys, sort=True).agg(**EVENT_AGGREGATES).reset_index()
+
+
+def event_metrics(events: pd.DataFrame, size, capacity) -> pd.DataFrame:
+    """
+    Durations, rates and quantities of the events returned by aggregate_events.
+    Events of 20 minutes or less are discarded.
+
+    Args:
+    :events (pd.DataFrame):
+    :size: mean UsableTankVolume of the tank, scalar or one value per event
+    :capacity: capacity of underground tanks, NaN for tanks whose quantity comes from density and volume
+
+    Returns: events with the calculated fields, 'Event Type' and 'TFMEUnloadSpotRail'
+    """
+    events['Seconds'] = (events['Time (Last)'] - events['Time (First)']).dt.total_seconds()
+    events['Minutes'] = events['Seconds'] / 60
+    events['Hours'] = events['Seconds'] / 3600
+    events['Time (Duration)'] = events['Seconds'].apply(duration_string)
+
+    level_range = events['Level (Max*)'] - events['Level (Min*)']
+    events['Event_rate(Appr.)'] = level_range / 100
+    events['Event_rate(Appr.)'] = events['Event_rate(Appr.)'] / (1 / size)
+    events['Event_rate(Appr.)'] = events['Event_rate(Appr.)'] / events['Seconds'] * 60
+
+    event_rate = level_range * events['Density (Mean)'] * events['OnePercentLITDelta (Mean)']
+    events['Event_rate(min)'] = event_rate / events['Minutes']
+    events['Event_rate(hr)'] = event_rate / events['Hours']
+
+    events['Quantity'] = np.where(np.isnan(capacity), level_range * events['Density (Mean)'] * events['OnePercentLITDelta (Mean)'],
+                                  level_range * capacity)
+
+    unloading = events['PumpRunning'] == 1
+    events['TFMEUnloadSpotRail'] = np.where(unloading, events['Quantity'] / 79000, np.nan)
+    events['Event Type'] = np.where(unloading, 'Unloading', 'Discharge')
+
+    # Discarding events < 20 mins
+    return events[events['Minutes'] > 20].reset_index(drop=True)
+
+
+def transform_all_tanks(raw_data: pd.DataFrame, tags: pd.DataFrame) -> pd.DataFrame:
+    """
+    Long-format engine computing the events of every tank in one pass.
+    The per-row preparation (interpolation, Level ROC, pump state, Event_Id, OnePercentLITDelta)
+    runs on (rows x tanks) arrays, then a single groupby over (Tank, PumpRunning, Event_Id)
+    computes the discharge and unloading aggregates of all tanks.
+    Gives the same events as the per-tank loop of data_transformation.
+
+    Args:
+    :raw_data (pd.DataFrame): wide frame produced by the extraction
+    :tags (pd.DataFrame): tags_mapping() of the tank registry, or contents of 'Tags Mapping.csv'
+
+    Returns: discharge and unloading events of every tank, in 'Tags Mapping.csv' order
+    """
+    metrics = ['Level', 'Temp.', 'Density', 'Kilos', 'Disc_Output']
+    tanks = []
+    capacities = []
+    columns = {metric: [] for metric in metrics + ['PumpRunning']}
+    # Positions of every tank's columns, looked up once instead of probing raw_data.columns per tank
+    positions = column_positions(raw_data.columns, list(tags['Tank']))
+    required = [list(TANK_COLUMNS).index(metric) for metric in ['Level', 'Temp.', 'Density', 'Kilos', 'GCAS', 'PumpRunning']]
+    for (index, row), tank_positions in zip(tags.iterrows(), positions):
+        tank = row['Tank']
+        try:
+            if (tank_positions[required] < 0).any():
+                missing = [TANK_COLUMNS[metric].format(tank) for metric, position in zip(TANK_COLUMNS, tank_positions)
+                           if position < 0 and metric != 'Disc_Output']
+                raise KeyError(f'{missing} not in index')
+            tank_values = {metric: as_float(raw_data.iloc[:, position]) if position >= 0 else pd.Series(np.nan, index=raw_data.index)
+                           for metric, position in zip(TANK_COLUMNS, tank_positions) if metric in metrics}
+            tank_values['PumpRunning'] = combine_pumps(raw_data, tank, row['Extra Pumps'])
+        except Exception as e:
+            logging.exception(f'Tank {tank} Exception Occured!\n')
+            logging.exception(get_exception())
+            continue
+        tanks.append(tank)
+        capacities.append(tank_capacity(tank, row.get('Capacity')))
+        for metric, values in tank_values.items():
+            columns[metric].append(values.to_numpy(dtype=np.float64, na_value=np.nan))
+
+    if len(tanks) == 0:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+
+    rows = len(raw_data)
+    values = {metric: np.column_stack(columns[metric]) for metric in columns}
+    time = pd.DatetimeIndex(pd.to_datetime(raw_data['Time']))
+
+    with np.errstate(divide='ignore', invalid='ignore'), instrumentation.stage('interpolate', tank='all'):
+        roc = level_roc(values['Level'], time.asi8)
+        for metric in metrics:
+            values[metric] = interpolate_forward(values[metric])
+        values['Level ROC'] = interpolate_forward(roc)
+        pump = forward_fill(values['PumpRunning'])
+
+        # Populating Event_Id: a new event starts whenever the pump switches on, and on the first record
+        event_start = event_starts(pump)
+
+        one_percent = values['Kilos'] / values['Level']
+        usable_volume = one_percent * 100
+        # Mean over each tank, computed column by column like Series.mean
+        size = np.array([np.where(np.isnan(column), 0, column).sum() / np.count_nonzero(~np.isnan(column))
+                         for column in usable_volume.T])
+
+    # Long format, one block of rows per tank
+    long_df = pd.DataFrame({'Tank': np.repeat(np.arange(len(tanks)), rows),
+                            'PumpRunning': pump.ravel(order='F'),
+                            'Event_Id': time.take(event_start.ravel(order='F')),
+                            'Time': time.take(np.tile(np.arange(rows), len(tanks))),
+                            'Level': values['Level'].ravel(order='F'),
+                            'Temp.': values['Temp.'].ravel(order='F'),
+                            'Density': values['Density'].ravel(order='F'),
+                            'Disc_Output': values['Disc_Output'].ravel(order='F'),
+                            'OnePercentLITDelta': one_percent.ravel(order='F'),
+                            'UsableTankVolume': usable_volume.ravel(order='F')})
+
+    with instrumentation.stage('aggregate', tank='all'):
+        events = aggregate_events(long_df, ['Tank', 'PumpRunning', 'Event_Id'])
+    tank_code = events['Tank'].to_numpy()
+    capacity = np.array(capacities, dtype=np.float64)
+    with instrumentation.stage('event_metrics', tank='all'):
+        events = event_metrics(events, size[tank_code], capacity[tank_code])
+    events['Tank'] = pd.Series(tanks, dtype=object).to_numpy()[events['Tank'].to_numpy()]
+    return events[RESULT_COLUMNS]
+
+
+def combine_pumps(raw_data: pd.DataFrame, tank, extra_pumps) -> pd.Series:
+    """
+    Pump state of a tank, OR-ed with the pumps of its extra unload spots when it has any.
+    All the pump columns are combined at once on the rows of raw_data: the tank's own pump is forward filled,
+    the extra spots are forward then back filled, and a spot is running when its state is not 0.
+    The tank is running (1) when any spot runs, stopped (0) when no spot runs and at least one is known,
+    and unknown (NaN) only when no spot is known. A spot without any sample (an all-NA column) therefore
+    counts as stopped instead of hiding the state of the others.
+
+    Args:
+    :raw_data (pd.DataFrame):
+    :tank: tank number as in 'Tags Mapping.csv'
+    :extra_pumps: comma separated pump columns, NaN when the tank has a single unload spot, or split_pumps output
+
+    Returns: the PumpRunning series
+    """
+    extra_pumps = [extra_pump for extra_pump in split_pumps(extra_pumps) if extra_pump in raw_data.columns]
+    if not extra_pumps:
+        return as_float(raw_data[f'{tank}'])
+
+    pumps = raw_data[[f'{tank}'] + extra_pumps]
+    if not all(pd.api.types.is_numeric_dtype(dtype) for dtype in pumps.dtypes):
+        pumps = pumps.apply(as_float)
+    states = forward_fill(pumps.to_numpy(dtype=np.float64, na_value=np.nan))
+    states[:, 1:] = forward_fill(states[::-1, 1:])[::-1]
+
+    known = ~np.isnan(states)
+    running = (known & (states != 0)).any(axis=1)
+    combined = np.where(running, 1.0, np.where(known.any(axis=1), 0.0, np.nan))
+    return pd.Series(combined, index=raw_data.index, name=f'{tank}')
+
+
+def transform_tank(raw_data: pd.DataFrame, tank, extra_pumps, capacity: float = None) -> pd.DataFrame:
+    """
+    Computes the discharge and unloading events of a single tank
+
+    Args:
+    :raw_data (pd.DataFrame): wide frame produced by the extraction
+    :tank: tank number as in 'Tags Mapping.csv'
+    :extra_pumps (str): comma separated pump columns of the extra unload spots, NaN if there are none,
+                        or split_pumps output
+    :capacity (float): capacity from the tank registry, looked up in DEFAULT_CAPACITIES by default
+
+    Returns: discharge events followed by unloading events, with the RESULT_COLUMNS columns
+    """
+    config = Tank_Config(tank, extra_pumps)
+    columns = [config.columns[metric] for metric in ('Level', 'Temp.', 'Density', 'Kilos', 'Disc_Output')]
+    required = columns[:4] + [config.columns['GCAS'], config.columns['PumpRunning'], 'Time']
+    missing = [column for column in required if column not in raw_data.columns]
+    if missing:
+        raise KeyError(f'{missing} not in index')
+
+    # One contiguous array per tank instead of a copy of its columns, the discharge is optional
+    values = np.full((len(raw_data), len(columns)), np.nan)
+    for position, column in enumerate(columns):
+        if column in raw_data.columns:
+            values[:, position] = as_float(raw_data[column]).to_numpy(dtype=np.float64, na_value=np.nan)
+    pump = combine_pumps(raw_data, tank, extra_pumps).to_numpy(dtype=np.float64, na_value=np.nan)
+    time = pd.DatetimeIndex(pd.to_datetime(raw_data['Time']))
+
+    # Filling in any missing data using linear interpolation, and populating Event_Id
+    with np.errstate(divide='ignore', invalid='ignore'), instrumentation.stage('interpolate', tank=tank):
+        values, roc, pump, event_start, one_percent = prepare_tank(values, pump, time.asi8)
+
+    main_df = pd.DataFrame({'Level': values[:, 0],
+                            'Temp.': values[:, 1],
+                            'Density': values[:, 2],
+                            'Kilos': values[:, 3],
+                            'PumpRunning': pump,
+                            'Time': time,
+                            'Disc_Output': values[:, 4],
+                            'Level ROC': roc,
+                            'Event_Id': time.take(event_start),
+                            'OnePercentLITDelta': one_percent,
+                            'UsableTankVolume': one_percent * 100})
+    logging.info('Data cleaned and formatted. Ready for transformation')
+
+    logging.info('Starting event calculations')
+    size = main_df['UsableTankVolume'].mean()
+    with instrumentation.stage('aggregate', tank=tank):
+        events = aggregate_events(main_df, ['PumpRunning', 'Event_Id'])
+    with instrumentation.stage('event_metrics', tank=tank):
+        events = event_metrics(events, size, tank_capacity(tank, capacity))
+    events['Tank'] = tank
+    instrumentation.count('events', len(events), tank=tank)
+    logging.info('Completed event calculations')
+    return events[RESULT_COLUMNS]
+
+
+def share_raw_data(raw_data: pd.DataFrame, tags: pd.DataFrame) -> tuple:
+    """
+    Copies the numeric columns used by the tanks of 'Tags Mapping.csv' into shared memory,
+    as a single column-major float64 block plus the Time column as int64 nanoseconds.
+    Columns that cannot be converted to numbers are left out, so the tanks using them fail
+    in the workers as they would in the sequential loop.
+
+    Args:
+    :raw_data (pd.DataFrame):
+    :tags (pd.DataFrame): contents of 'Tags Mapping.csv'
+
+    Returns: (shared memory blocks, layout) - the layout is what workers need to attach to the blocks
+    """
+    columns = []
+    placeholders = []
+    for index, row in tags.iterrows():
+        config = Tank_Config(row['Tank'], row['Extra Pumps'])
+        columns += [column for column in config.numeric_columns if column in raw_data.columns and column not in columns]
+        # GCAS is selected but never used in calculations, only its presence matters
+        if config.columns['GCAS'] in raw_data.columns:
+            placeholders.append(config.columns['GCAS'])
+
+    numeric = {}
+    for column in columns:
+        try:
+            numeric[column] = as_float(raw_data[column]).to_numpy(dtype=np.float64, na_value=np.nan)
+        except Exception:
+            logging.info(f'Column {column} is not numeric, not shared with the workers')
+    columns = list(numeric)
+    time = pd.to_datetime(raw_data['Time'])
+
+    rows = len(raw_data)
+    values_shm = shared_memory.SharedMemory(create=True, size=max(rows * len(columns) * 8, 1))
+    time_shm = shared_memory.SharedMemory(create=True, size=max(rows * 8, 1))
+    try:
+        values = np.ndarray((rows, len(columns)), dtype=np.float64, buffer=values_shm.buf, order='F')
+        for i, column in enumerate(columns):
+            values[:, i] = numeric[column]
+        # .values is datetime64[ns] in UTC, also for tz-aware columns
+        np.ndarray(rows, dtype=np.int64, buffer=time_shm.buf)[:] = time.values.view(np.int64)
+        del values
+    except Exception:
+        for block in (values_shm, time_shm):
+            block.close()
+            block.unlink()
+        raise
+
+    layout = {'values': values_shm.name, 'time': time_shm.name, 'rows': rows, 'columns': columns,
+              'placeholders': placeholders, 'tz': str(time.dt.tz) if time.dt.tz is not None else None}
+    return (values_shm, time_shm), layout
+
+
+def attach_shared_input(layout: dict):
+    """
+    Process pool initializer: maps the shared blocks created by share_raw_data without copying them
+    """
+    global _shared_input
+    blocks = []
+    for name in (layout['values'], layout['time']):
+        # Workers share the resource tracker of the parent, which owns and unlinks the blocks
+        blocks.append(shared_memory.SharedMemory(name=name))
+    pd.options.mode.chained_assignment = None
+
+    rows = layout['rows']
+    values = np.ndarray((rows, len(layout['columns'])), dtype=np.float64, buffer=blocks[0].buf, order='F')
+    time = pd.Series(np.ndarray(rows, dtype=np.int64, buffer=blocks[1].buf).view('datetime64[ns]'))
+    if layout['tz'] is not None:
+        time = time.dt.tz_localize('UTC').dt.tz_convert(layout['tz'])
+    _shared_input = {'blocks': blocks, 'values': values, 'time': time,
+                     'index': {column: i for i, column in enumerate(layout['columns'])},
+                     'placeholders': set(layout['placeholders'])}
+
+
+def transform_tank_worker(task: tuple) -> tuple:
+    """
+    Runs transform_tank in a worker process on a frame built from the shared columns of the tank
+
+    Args:
+    :task (tuple): (tank, extra_pumps, capacity)
+
+    Returns: (events, error) - error is None on success,
+             otherwise the traceback and get_exception details of the failure
+    """
+    tank, extra_pumps, capacity = task
+    try:
+        config = Tank_Config(tank, extra_pumps)
+        index = _shared_input['index']
+        raw_data = pd.DataFrame({column: _shared_input['values'][:, index[column]]
+                                 for column in config.numeric_columns if column in index})
+        if config.columns['GCAS'] in _shared_input['placeholders']:
+            raw_data[config.columns['GCAS']] = np.nan
+        raw_data['Time'] = _shared_input['time']
+        return transform_tank(raw_data, tank, extra_pumps, capacity), None
+    except Exception:
+        return None, (traceback.format_exc(), get_exception())
+
+
+def transform_tanks_parallel(raw_data: pd.DataFrame, tags: pd.DataFrame, workers: int) -> pd.DataFrame:
+    """
+    Runs transform_tank for every tank on a pool of worker processes.
+    The input columns are shared through shared memory instead of being pickled for each worker,
+    results are gathered in 'Tags Mapping.csv' order and a failing tank is logged and skipped,
+    as in the sequential loop.
+
+    Args:
+    :raw_data (pd.DataFrame):
+    :tags (pd.DataFrame): contents of 'Tags Mapping.csv'
+    :workers (int): number of worker processes
+
+    Returns: discharge and unloading events of every tank
+    """
+    blocks, layout = share_raw_data(raw_data, tags)
+    frames = []
+    try:
+        tasks = [(row['Tank'], row['Extra Pumps'], row.get('Capacity')) for index, row in tags.iterrows()]
+        with ProcessPoolExecutor(max_workers=workers, initializer=attach_shared_input, initargs=(layout,)) as executor:
+            for (tank, extra_pumps, capacity), (events, error) in zip(tasks, executor.map(transform_tank_worker, tasks)):
+                if error is not None:
+                    logging.error(f'Tank {tank} Exception Occured!\n{error[0]}')
+                    logging.error(error[1])
+                    continue
+                frames.append(events)
+                logging.info(f'Tank {tank} Done\n')
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return collect_results(frames)
+
+
+def data_transformation(raw_data, output_path: str = None, append: bool = False, engine: str = None,
+                        workers: int = None, writer=None, resolution: str = None) -> pd.DataFrame:
+    """
+    Computes the discharge and unloading events of every tank in 'Tags Mapping.csv'
+    and writes them to output_path ('./data/Daily Results {today}.csv' by default).
+
+    Args:
+    :raw_data (pd.DataFrame): wide frame produced by the extraction
+    :output_path (str):
+    :append (bool): append to output_path instead of overwriting it
+    :writer: output stage from output_writers, make_writer(path=output_path) by default
+    :engine (str): 'tank' runs the per-tank loop, 'long' the vectorized transform_all_tanks.
+                   Defaults to the transform_engine environment variable, or 'tank'
+    :workers (int): with more than one worker the 'tank' engine runs on a process pool.
+                    Defaults to the transform_workers environment variable, or 1
+    :resolution (str): grid step (e.g. '2min') the raw data is resampled to before the transformation,
+                       see resampling.resample_raw_data. Defaults to the resample_resolution environment variable,
+                       the raw data is used as is when neither is set
+
+    Returns: the results dataframe
+    """
 
     # Added this line to remove warnings coming from pandas library modules
     pd.options.mode.chained_assignment = None
@@ -43,276 +457,43 @@ def data_transformation(raw_data):
     start_time = datetime.now()
 
     ## Added for multiple unload spot
-    tags = pd.read_csv('./data/Tags Mapping.csv')
-    ungrnd_tanks = {'12': 122506, '8944': 156692, '8945': 217054, '2230E': 25374, '2230W': 25965, '2232E': 29767, '2232W': 26286,
-                    '2633E': 32914, '2633W': 32914, '30C': 25815, '30E': 21822, '30W': 21585, '40E': 35015, '40W': 34858}
-
-    results_df = pd.DataFrame()
+    registry = get_registry()
+    tags = registry.tags_mapping()
+
+    if resolution is None:
+        resolution = os.getenv('resample_resolution')
+    if resolution:
+        raw_data = resample_raw_data(raw_data, tags, resolution, max_gap=os.getenv('resample_max_gap'))
+    instrumentation.count('rows_transformed', len(raw_data))
+
+    if engine is None:
+        engine = os.getenv('transform_engine', 'tank')
+    if engine == 'long':
+        with instrumentation.stage('transform_all_tanks'):
+            results_df = transform_all_tanks(raw_data, tags)
+        return finalize_results(results_df, start_time, output_path, append, writer)
+
+    if workers is None:
+        workers = int(os.getenv('transform_workers', 1))
+    if workers > 1:
+        with instrumentation.stage('transform_all_tanks'):
+            results_df = transform_tanks_parallel(raw_data, tags, workers)
+        return finalize_results(results_df, start_time, output_path, append, writer)
+
+    frames = []
     counter = 0
 
     ## Added for multiple unload spots
-    for index, row in tags.iterrows():
-        tank = row['Tank']
-        extra_pumps = row['Extra Pumps']
+    for config in registry.tanks.values():
+        tank = config.tank
 
         # The MainDf from BTFT2Query.py
         # TODO: Replace temporary csv data source with data from btf_data_extraction.py
         logging.info(f'WORKING ON TANK {tank}')
 
         try:
-            if f'Discharge {tank}' in raw_data.columns:
-                main_df = raw_data[[f'Level {tank}', f'Temp. {tank}', f'Density {tank}', f'Kilos {tank}', f'GCAS {tank}', f'{tank}', 'Time', f'Discharge {tank}']]
-            else:
-                main_df = raw_data[[f'Level {tank}', f'Temp. {tank}', f'Density {tank}', f'Kilos {tank}', f'GCAS {tank}', f'{tank}', 'Time']]
-                main_df[f'Discharge {tank}'] = pd.NA
-
-            if pd.notna(extra_pumps):
-                main_df[f'{tank}'].ffill(inplace=True)
-                try:
-                    main_df[f'{tank}'] = main_df[f'{tank}'].astype(int)
-                except:
-                    main_df[f'{tank}'] = 0
-
-                extra_pumps = extra_pumps.split(', ')
-                for extra_pump in extra_pumps:
-                    if extra_pump in raw_data.columns:
-                        main_df = pd.merge(main_df, raw_data[extra_pump + ['Time']], on='Time', how='left')
-                        main_df[extra_pump].ffill(inplace=True)
-                        main_df[extra_pump].bfill(inplace=True)
-                        try:
-                            main_df[extra_pump] = main_df[extra_pump].astype(int)
-                        except:
-                            main_df[extra_pump] = 0
-                        main_df[f'{tank}'] = main_df[f'{tank}'] | main_df[extra_pump]
-                main_df.drop(columns=extra_pumps, errors='ignore', inplace=True)
-
-            main_df.columns = ['Level', 'Temp.', 'Density', 'Kilos', 'GCAS', 'PumpRunning', 'Time', 'Disc_Output']
-            main_df['Level'] = pd.to_numeric(main_df['Level'])
-            main_df['Temp.'] = pd.to_numeric(main_df['Temp.'])
-            main_df['Density'] = pd.to_numeric(main_df['Density'])
-            main_df['Kilos'] = pd.to_numeric(main_df['Kilos'])
-            main_df['PumpRunning'] = pd.to_numeric(main_df['PumpRunning'])
-            main_df['Disc_Output'] = pd.to_numeric(main_df['Disc_Output'])
-
-            main_df.reset_index(drop=True, inplace=True)
-            main_df['Level(-1)'] = main_df['Level'].shift(periods=1)    # CopyWarning
-            main_df['Level ROC'] = (main_df['Level'] - main_df['Level(-1)']) * 100    # CopyWarning
-
-            logging.info('Performing initial clean-up operations')
-            main_df['Time'] = pd.to_datetime(main_df['Time'])    # CopyWarning
-            main_df.loc[0:1, 'Level(-1)'].bfill(inplace=True)
-            main_df.loc[0:1, 'Level ROC'].bfill(inplace=True)
-
-            # Filling in any missing data using linear interpolation
-            main_df['Level'].interpolate(method='linear', inplace=True, limit_direction='forward')
-            main_df['Temp.'].interpolate(method='linear', inplace=True, limit_direction='forward')
-            main_df['Density'].interpolate(method='linear', inplace=True, limit_direction='forward')
-            main_df['Kilos'].interpolate(method='linear', inplace=True, limit_direction='forward')
-            main_df['Level(-1)'].interpolate(method='linear', inplace=True, limit_direction='forward')
-            main_df['Level ROC'].interpolate(method='linear', inplace=True, limit_direction='forward')
-            main_df['PumpRunning'].ffill(inplace=True)
-            main_df['Disc_Output'].interpolate(method='linear', inplace=True, limit_direction='forward')
-
-            # Filling in NA values in the first record
-            main_df['Pump Filling'] = main_df['PumpRunning']    # CopyWarning
-            main_df['Level ROC(-1)'] = main_df['Level ROC'].shift(periods=1)    # CopyWarning
-            main_df['PumpRunning(-1)'] = main_df['PumpRunning'].shift(periods=1)    # CopyWarning
-
-            # Populating Event_Id
-            main_df['Event_Id'] = main_df['PumpRunning'] - main_df['PumpRunning(-1)']    # CopyWarning
-            main_df.loc[0, 'Event_Id'] = 1
-            main_df.loc[~(main_df['Event_Id'] == 1), 'Event_Id'] = pd.NA
-            main_df.loc[main_df['Event_Id'] == 1, 'Event_Id'] = main_df['Time']
-
-            main_df['Event_Id'].ffill(inplace=True)
-
-            # Adding 'OnePercentLITDelta' and 'UsableTankVolume' fields
-            main_df['OnePercentLITDelta'] = main_df['Kilos'] / main_df['Level']    # CopyWarning
-            main_df['UsableTankVolume'] = (main_df['Kilos'] / main_df['Level']) * 100    # CopyWarning
-            logging.info('Data cleaned and formatted. Ready for transformation')
-
-            logging.info('Starting GCAS Density calculations')
-            # GCAS DENSITY CALCULATIONS
-            # Grouping by 'Event_Id' and dates
-            gcas_calc = main_df.groupby(pd.Grouper(key='Event_Id', freq='1D')) \
-                            .agg(Mean_OnePercentLITDelta=('OnePercentLITDelta', 'mean'),
-                                    Mean_UsableTankVolume=('UsableTankVolume', 'mean'),
-                                    Min_UsableTankVolume=('UsableTankVolume', min),
-                                    Min_OnePercentLITDelta=('OnePercentLITDelta', min),
-                                    Max_OnePercentLITDelta=('OnePercentLITDelta', max),
-                                    Max_UsableTankVolume=('UsableTankVolume', max),
-                                    Mean_Density=('Density', 'mean'))
-            gcas_calc.dropna(how='any', inplace=True)
-
-            # Doing post-ops and clean up
-            gcas_calc.rename(columns={'Mean_OnePercentLITDelta': 'Mean(OnePercentLITDelta)',
-                                    'Mean_UsableTankVolume': 'Mean(UsableTankVolume)',
-                                    'Min_UsableTankVolume': 'Min*(UsableTankVolume)',
-                                    'Min_OnePercentLITDelta': 'Min*(OnePercentLITDelta)',
-                                    'Max_OnePercentLITDelta': 'Max*(OnePercentLITDelta)',
-                                    'Max_UsableTankVolume': 'Max*(UsableTankVolume)',
-                                    'Mean_Density': 'Mean(Density)'}, inplace=True)
-            gcas_calc['Year'] = gcas_calc.index.year
-            gcas_calc['Month (number)'] = gcas_calc.index.month
-            gcas_calc['Day of month'] = gcas_calc.index.day
-            gcas_calc.reset_index(drop=True, inplace=True)
-
-            logging.info('Completed GCAS Density calculations')
-
-            logging.info('Starting Discharge calculations')
-            # DISCHARGE CALCULATIONS
-            # Grouping by 'Event_Id'
-            discharge_calc = main_df[main_df['PumpRunning'] == 0].groupby(by='Event_Id', as_index=False) \
-                                                                .agg(Time_First=('Time', min),
-                                                                    Time_Last=('Time', max),
-                                                                    Level_Mean=('Level', 'mean'),
-                                                                    Level_ROC_Mean=('Level ROC', 'mean'),
-                                                                    Level_ROC_Min=('Level ROC', min),
-                                                                    Level_ROC_Max=('Level ROC', 'max'),
-                                                                    Level_Min=('Level', min),
-                                                                    Level_Max=('Level', max),
-                                                                    Temp_Mean=('Temp.', 'mean'),
-                                                                    Temp_Min=('Temp.', min),
-                                                                    Temp_Max=('Temp.', max),
-                                                                    Total_volume=('UsableTankVolume', 'mean'),
-                                                                    OnePercentLITDelta_Mean=('OnePercentLITDelta', 'mean'),
-                                                                    UsableTankVolume_Mean=('UsableTankVolume', 'mean'),
-                                                                    Density_Mean=('Density', 'mean'),
-                                                                    Disc_Output_Mean=('Disc_Output', 'mean'))
-
-            # Renaming columns
-            discharge_calc.rename(columns={'Time_First': 'Time (First)',
-                                        'Time_Last': 'Time (Last)',
-                                        'Level_Mean': 'Level (Mean)',
-                                        'Level_ROC_Mean': 'Level ROC (Mean)',
-                                        'Level_ROC_Min': 'Level ROC (Min*)',
-                                        'Level_ROC_Max': 'Level ROC (Max*)',
-                                        'Level_Min': 'Level (Min*)',
-                                        'Level_Max': 'Level (Max*)',
-                                        'Temp_Mean': 'Temp. (Mean)',
-                                        'Temp_Min': 'Temp. (Min*)',
-                                        'Temp_Max': 'Temp. (Max*)',
-                                        'Total_volume': 'Total Volume',
-                                        'Density_Mean': 'Density (Mean)',
-                                        'OnePercentLITDelta_Mean': 'OnePercentLITDelta (Mean)',
-                                        'UsableTankVolume_Mean': 'UsableTankVolume (Mean)',
-                                        'Disc_Output_Mean': 'Supply discharge pump%'}, inplace=True)
-
-            # Doing post-ops to get calculated fields
-            discharge_calc['Time (Duration)'] = discharge_calc['Time (Last)'] - discharge_calc['Time (First)']
-            discharge_calc['Seconds'] = discharge_calc['Time (Duration)'].dt.total_seconds()
-            discharge_calc['Minutes'] = discharge_calc['Seconds'] / 60
-            discharge_calc['Hours'] = discharge_calc['Seconds'] / 3600
-            discharge_calc['Time (Duration)'] = discharge_calc['Seconds'].apply(duration_string)
-
-            size = main_df['UsableTankVolume'].mean()
-            discharge_calc['Event_rate(Appr.)'] = (discharge_calc['Level (Max*)'] - discharge_calc['Level (Min*)']) / 100
-            discharge_calc['Event_rate(Appr.)'] = discharge_calc['Event_rate(Appr.)'] / (1 / size)
-            discharge_calc['Event_rate(Appr.)'] = discharge_calc['Event_rate(Appr.)'] / discharge_calc['Seconds'] * 60
-
-            discharge_calc['Event_rate'] = (discharge_calc['Level (Max*)'] - discharge_calc['Level (Min*)']) * discharge_calc['Density (Mean)']
-            discharge_calc['Event_rate'] = discharge_calc['Event_rate'] * discharge_calc['OnePercentLITDelta (Mean)']
-            discharge_calc['Event_rate(min)'] = discharge_calc['Event_rate'] / discharge_calc['Minutes']
-            discharge_calc['Event_rate(hr)'] = discharge_calc['Event_rate'] / discharge_calc['Hours']
-
-
-            discharge_calc['Quantity'] = (discharge_calc['Level (Max*)'] - discharge_calc['Level (Min*)'])
-            if tank in ungrnd_tanks:
-                discharge_calc['Quantity'] = discharge_calc['Quantity'] * ungrnd_tanks[tank]
-            else:
-                discharge_calc['Quantity'] = discharge_calc['Quantity'] * discharge_calc['Density (Mean)'] * discharge_calc['OnePercentLITDelta (Mean)']
-
-            # Discarding events < 20 mins
-            discharge_calc = discharge_calc[discharge_calc['Minutes'] > 20]
-
-            discharge_calc['Event Type'] = 'Discharge'
-            discharge_calc['Tank'] = tank
-            discharge_calc = discharge_calc[['Event_Id', 'Time (Duration)', 'Time (First)', 'Time (Last)', 'Level (Mean)', 'Level (Min*)',
-                                            'Level (Max*)', 'Temp. (Mean)', 'Temp. (Min*)', 'Temp. (Max*)', 'Seconds', 'Total Volume',
-                                            'Event_rate(Appr.)', 'Minutes', 'Hours', 'Quantity', 'Event_rate(hr)', 'Event_rate(min)',
-                                            'Event Type', 'Tank', 'Supply discharge pump%']]
-
-            results_df = results_df.append(discharge_calc, ignore_index=True)
-
-            logging.info('Completed Discharge calculations')
-            # discharge_calc.to_csv('./data/disc.csv', index=False)
-
-            # UNLOADING CALCULATION
-            logging.info('Starting Unload calculations')
-            # Grouping by 'Event_Id'
-            unloading_calc = main_df[main_df['PumpRunning'] == 1].groupby(by='Event_Id', as_index=False) \
-                                                                .agg(Time_First=('Time', min),
-                                                                    Time_Last=('Time', max),
-                                                                    Level_Mean=('Level', 'mean'),
-                                                                    Level_ROC_Mean=('Level ROC', 'mean'),
-                                                                    Level_ROC_Min=('Level ROC', min),
-                                                                    Level_ROC_Max=('Level ROC', 'max'),
-                                                                    Level_Min=('Level', min),
-                                                                    Level_Max=('Level', max),
-                                                                    Temp_Mean=('Temp.', 'mean'),
-                                                                    Temp_Min=('Temp.', min),
-                                                                    Temp_Max=('Temp.', max),
-                                                                    Total_volume=('UsableTankVolume', 'mean'),
-                                                                    OnePercentLITDelta_Mean=('OnePercentLITDelta', 'mean'),
-                                                                    UsableTankVolume_Mean=('UsableTankVolume', 'mean'),
-                                                                    Density_Mean=('Density', 'mean'),
-                                                                    Disc_Output_Mean=('Disc_Output', 'mean'))
-
-            # Renaming columns
-            unloading_calc.rename(columns={'Time_First': 'Time (First)',
-                                        'Time_Last': 'Time (Last)',
-                                        'Level_Mean': 'Level (Mean)',
-                                        'Level_ROC_Mean': 'Level ROC (Mean)',
-                                        'Level_ROC_Min': 'Level ROC (Min*)',
-                                        'Level_ROC_Max': 'Level ROC (Max*)',
-                                        'Level_Min': 'Level (Min*)',
-                                        'Level_Max': 'Level (Max*)',
-                                        'Temp_Mean': 'Temp. (Mean)',
-                                        'Temp_Min': 'Temp. (Min*)',
-                                        'Temp_Max': 'Temp. (Max*)',
-                                        'Total_volume': 'Total Volume',
-                                        'Density_Mean': 'Density (Mean)',
-                                        'OnePercentLITDelta_Mean': 'OnePercentLITDelta (Mean)',
-                                        'UsableTankVolume_Mean': 'UsableTankVolume (Mean)',
-                                        'Disc_Output_Mean': 'Supply discharge pump%'}, inplace=True)
-
-            # Performing post-ops to get calculated fields
-            unloading_calc['Time (Duration)'] = unloading_calc['Time (Last)'] - unloading_calc['Time (First)']
-            unloading_calc['Seconds'] = unloading_calc['Time (Duration)'].dt.total_seconds()
-            unloading_calc['Minutes'] = unloading_calc['Seconds'] / 60
-            unloading_calc['Hours'] = unloading_calc['Seconds'] / 3600
-            unloading_calc['Time (Duration)'] = unloading_calc['Seconds'].apply(duration_string)
-
-            unloading_calc['Event_rate(Appr.)'] = (unloading_calc['Level (Max*)'] - unloading_calc['Level (Min*)']) / 100
-            unloading_calc['Event_rate(Appr.)'] = unloading_calc['Event_rate(Appr.)'] / (1 / size)
-            unloading_calc['Event_rate(Appr.)'] = unloading_calc['Event_rate(Appr.)'] / unloading_calc['Seconds'] * 60
-
-            unloading_calc['Event_rate'] = (unloading_calc['Level (Max*)'] - unloading_calc['Level (Min*)']) * unloading_calc['Density (Mean)']
-            unloading_calc['Event_rate'] = unloading_calc['Event_rate'] * unloading_calc['OnePercentLITDelta (Mean)']
-            unloading_calc['Event_rate(min)'] = unloading_calc['Event_rate'] / unloading_calc['Minutes']
-            unloading_calc['Event_rate(hr)'] = unloading_calc['Event_rate'] / unloading_calc['Hours']
-
-            unloading_calc['Quantity'] = unloading_calc['Level (Max*)'] - unloading_calc['Level (Min*)']
-            if tank in ungrnd_tanks:
-                unloading_calc['Quantity'] = unloading_calc['Quantity'] * ungrnd_tanks[tank]
-            else:
-                unloading_calc['Quantity'] = unloading_calc['Quantity'] * unloading_calc['Density (Mean)'] * unloading_calc['OnePercentLITDelta (Mean)']
-
-            unloading_calc['TFMEUnloadSpotRail'] = unloading_calc['Quantity'] / 79000
-
-            # Discarding events < 20 mins
-            unloading_calc = unloading_calc[unloading_calc['Minutes'] > 20]
-
-            unloading_calc['Event Type'] = 'Unloading'
-            unloading_calc['Tank'] = tank
-            unloading_calc = unloading_calc[['Event_Id', 'Time (Duration)', 'Time (First)', 'Time (Last)', 'Level (Mean)', 'Level (Min*)',
-                                            'Level (Max*)', 'Temp. (Mean)', 'Temp. (Min*)', 'Temp. (Max*)', 'Seconds', 'Total Volume',
-                                            'Event_rate(Appr.)', 'Minutes', 'Hours', 'Quantity', 'Event_rate(hr)', 'Event_rate(min)',
-                                            'Event Type', 'Tank', 'TFMEUnloadSpotRail', 'Supply discharge pump%']]
-
-            results_df = results_df.append(unloading_calc, ignore_index=True)
-
-            logging.info('Completed Unloading calculations')
+            with instrumentation.stage('transform_tank', tank=tank), instrumentation.profile('transform_tank', tank=tank):
+                frames.append(transform_tank(raw_data, tank, config.extra_pumps, config.capacity))
             logging.info(f'Tank {tank} Done\n')
 
         except Exception as e:
@@ -323,6 +504,42 @@ def data_transformation(raw_data):
         counter += 1
         print(f'Transformation counter: {counter} / {len(tags)}\r', end='')
 
+    results_df = collect_results(frames)
+    return finalize_results(results_df, start_time, output_path, append, writer)
+
+
+def collect_results(frames: list) -> pd.DataFrame:
+    """
+    Concatenates the per-tank event frames in a single pass,
+    instead of copying the accumulated results for every tank with DataFrame.append
+
+    Args:
+    :frames (list): event dataframes, in 'Tags Mapping.csv' order
+
+    Returns: dataframe with the RESULT_COLUMNS columns
+    """
+    # Empty frames carry no rows and only object dtypes, skipping them keeps the numeric dtypes
+    frames = [frame for frame in frames if len(frame) > 0]
+    if len(frames) == 0:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    return pd.concat(frames, ignore_index=True).reindex(columns=RESULT_COLUMNS)
+
+
+def finalize_results(results_df: pd.DataFrame, start_time: datetime, output_path: str = None, append: bool = False,
+                     writer=None) -> pd.DataFrame:
+    """
+    Unit conversions, calendar fields and sanity filters applied to the events of all tanks,
+    before they are written to output_path
+
+    Args:
+    :results_df (pd.DataFrame): discharge and unloading events of every tank
+    :start_time (datetime): start of the transformation, for the timing log
+    :output_path (str):
+    :append (bool):
+    :writer: output stage, make_writer(path=output_path) by default
+
+    Returns: the results dataframe
+    """
     # Adding as per the PowerBI team's request
     # Converting all the volume columns from Kg to MT
     results_df['Total Volume'] = results_df['Total Volume'] / 1000
@@ -331,7 +548,7 @@ def data_transformation(raw_data):
     results_df['Event_rate(hr)'] = results_df['Event_rate(hr)'] / 1000
     results_df['Event_rate(min)'] = results_df['Event_rate(min)'] / 1000
 
-    results_df['TFMEUnloadSpotRail'].fillna(0, inplace=True)
+    results_df['TFMEUnloadSpotRail'] = results_df['TFMEUnloadSpotRail'].fillna(0)
     results_df['TFMEWeek_'] = pd.to_datetime(results_df['Event_Id']).dt.strftime('%U')
     results_df['Site'] = 'Lima'
     results_df['Plant Code'] = 1702
@@ -340,8 +557,14 @@ def data_transformation(raw_data):
     results_df = results_df[~((results_df['Level (Min*)'] > 100) | (results_df['Level (Min*)'] < 0))]    # Removing faulty min values
     results_df = results_df[~((results_df['Level (Mean)'] > 100) | (results_df['Level (Mean)'] < 0))]    # Removing faulty mean values
 
-    results_df.to_csv(f'./data/Daily Results {date.today()}.csv', index=False)
+    if writer is None:
+        writer = make_writer(path=output_path)
+    with instrumentation.stage('output_write'):
+        output_path = writer.write(results_df, append)
+    instrumentation.count('results_written', len(results_df))
+    logging.info(f'Results written to {output_path}')
 
     end_time = datetime.now()
     logging.info(f'Time for transformation of data: {(end_time - start_time).seconds} seconds')
     logging.info('----------------------- ENDED BTF DATA TRANSFORMATION ----------------------------\n\n')
+    return results_df
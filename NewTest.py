@@ -1,71 +1,121 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-from datetime import datetime, date, timedelta
-import traceback
-import os
+from datetime import datetime, timedelta
 import logging
 import sys
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from dotenv import load_dotenv
-import requests
+import numpy as np
 import pandas as pd
-from pandas import json_normalize
-
-from BTFeTL import data_transformation, get_exception
-
-
-class Historian_Connection:
-    """
-    Creating a class to store Historian connection information as well as the access token.
-    Refactored as a class to avoid using global variables and to keep related code together.
-    Can be reused as required.
-    """
-    username = None
-    password = None
-    server = None
-    url = None
-    client_id = None
-    client_secret = None
-    access_token = None
-
-    def __init__(self, username: str, password: str, server: str, url:str, client_id: str, client_secret: str):
-        """
-        Initializes a Historian_Connection object with required connecion details
-        """
-        # Seperating server field from url to make the function generic
-        self.username = username
-        self.password = password
-        self.server = server
-        self.url = url.format(server)
-        self.client_id = client_id
-        self.client_secret = client_secret
-
-    def get_token(self) -> bool:
-        """
-        Single call to get Historian access token with resource owner credentails
-        in the body and client credentials as the basic auth header.
-
-        Returns:
-        :access_token (obj):
-
-        """
-        data = {'grant_type': 'password', 'username': self.username, 'password': self.password}
-        try:
-            response = requests.post(self.url, data=data, allow_redirects=False, auth=(self.client_id, self.client_secret))
-            self.access_token = response.json()
-            logger.info('Successfully set Access Token\n')
-            return False
-        except Exception as e:
-            logger.error('Unable to set Access Token\n')
-            logger.error(e)
-            return True
+
+# orjson is optional, it only speeds up the parsing of the Historian responses
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from errors import get_exception
+from historian import Historian_Connection
+from output_writers import make_writer
+import quality
+from raw_cache import Sample_Cache
+from tank_registry import tank_tags
+import instrumentation
+
+
+logger = logging.getLogger()
+
+# Limits for the batched sampled endpoint, chunks are split further if the server still rejects them
+MAX_TAGS_PER_REQUEST = 50
+MAX_URL_LENGTH = 2000
+
+# Time format expected by the Historian REST API
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.000Z"
+
+
+def load_json(content: bytes):
+    """
+    Parses a Historian response body, with orjson when it is installed
+
+    Params:
+    :content (bytes):
+
+    Returns:
+    :data (dict):
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
 
 
-def print_data_to_df(tag_name: str, retrieval_mode: str, cycle_time: str, start_time: str, end_time: str,
-                     results_df: pd.DataFrame, time_stamp_populated: int, historian_conn: Historian_Connection) -> pd.DataFrame:
+def decode_samples(samples: list) -> pd.DataFrame:
     """
-    Function that retirieves data for the target tag and appends to the results dataframe
+    Function that decodes the Samples list of a Historian response straight into typed columns:
+    datetime64 TimeStamp floored to the second, float Value and int8 Quality.
+    Values that are not numeric (e.g. GCAS codes) are kept as strings.
+
+    Params:
+    :samples (list):
+
+    Returns:
+    :data (pd.DataFrame):
+    """
+    count = len(samples)
+    time_stamps = [sample['TimeStamp'] for sample in samples]
+    values = pd.Series([sample['Value'] for sample in samples], dtype=object)
+    quality = np.fromiter((sample['Quality'] for sample in samples), dtype=np.int8, count=count)
+
+    try:
+        time_stamps = pd.to_datetime(time_stamps)
+    except ValueError:
+        # Mixed precision timestamps (with and without milliseconds)
+        time_stamps = pd.to_datetime(time_stamps, format='ISO8601')
+
+    numeric_values = pd.to_numeric(values, errors='coerce')
+    if numeric_values.isna().sum() == values.isna().sum():
+        values = numeric_values.astype(np.float64)
+
+    return pd.DataFrame({'TimeStamp': time_stamps.floor('s'), 'Value': values.to_numpy(), 'Quality': quality})
+
+
+def clean_samples(samples: list, retrieval_mode: str, tag_name: str = None) -> pd.DataFrame:
+    """
+    Function that turns the Samples list of a Historian response into a cleaned dataframe.
+    Samples whose quality code is not accepted (see quality.accepted_quality) are dropped,
+    or blanked in "lab" mode where all tags share the same timestamps.
+
+    Params:
+    :samples (list):
+    :retrieval_mode (str):
+    :tag_name (str): for the rejection counters
+
+    Returns:
+    :data (pd.DataFrame):
+    """
+    data = decode_samples(samples)
+
+    # Drop bad quality data
+    if (len(data) == 0):
+        return data
+    rejected = ~np.isin(data['Quality'].to_numpy(), quality.accepted_quality(retrieval_mode))
+    if rejected.any():
+        instrumentation.count('samples_rejected', int(np.count_nonzero(rejected)), tag=tag_name, reason='quality')
+    if (retrieval_mode.lower() != "lab"):
+        data = data[~rejected].reset_index(drop=True)
+    else:
+        data.loc[rejected, 'Value'] = np.nan if data['Value'].dtype == np.float64 else None
+
+    data.drop(columns='Quality', inplace=True)
+    return data
+
+
+def fetch_tag_data(tag_name: str, retrieval_mode: str, cycle_time: str, start_time: str, end_time: str,
+                   historian_conn: Historian_Connection) -> pd.DataFrame:
+    """
+    Function that retrieves and cleans the samples of a single tag.
+    Does not touch any shared state, so it can be called from several threads at once.
 
     Params:
     :tag_name (str):
@@ -73,163 +123,541 @@ def print_data_to_df(tag_name: str, retrieval_mode: str, cycle_time: str, start_
     :cycle_time (str):
     :start_time (str):
     :end_time (str):
-    :results_df (pd.DataFrame):
-    :time_stamp_populated (int):
     :historian_conn (Historian_Connection):
 
     Returns:
-    :results_df (pd.DataFrame):
+    :data (pd.DataFrame): None if the request or the parsing failed
     """
     # As the "#" symbol gives issues in proficy, we replace it with *
     target_tag_name = tag_name.replace("#", "*")
 
     if retrieval_mode.lower()=="rawbytime" or retrieval_mode.lower()=="rawwithgaps":
-        url = f'https://{historian_conn.server}:443/historian-rest-api/v1/datapoints/raw/{target_tag_name}/{start_time}/{end_time}/0/0'
+        url = f'{historian_conn.base_url}/historian-rest-api/v1/datapoints/raw/{target_tag_name}/{start_time}/{end_time}/0/0'
     elif retrieval_mode.lower()=="lab":
-       url = f'https://{historian_conn.server}:443/historian-rest-api/v1/datapoints/sampled?tagNames={target_tag_name}\
+       url = f'{historian_conn.base_url}/historian-rest-api/v1/datapoints/sampled?tagNames={target_tag_name}\
                        &start={start_time}&end={end_time}&samplingMode=7&calculationMode=1&direction=0&count=0&intervalMs={str(cycle_time)}'
     else:
-       url = f'https://{historian_conn.server}:443/historian-rest-api/v1/datapoints/interpolated/{target_tag_name}/{start_time}/{end_time}/0/{str(cycle_time)}'
-
-    headers = {'Authorization': f"Bearer {historian_conn.access_token['access_token']}"}
+       url = f'{historian_conn.base_url}/historian-rest-api/v1/datapoints/interpolated/{target_tag_name}/{start_time}/{end_time}/0/{str(cycle_time)}'
 
     try:
-        response = requests.get(url, headers=headers)
-        data = response.json()
-        data = str(data['Data'][0]['Samples'])
-        data = json.loads(data.replace('\'', '"'))
-        data = json_normalize(data)
-
-        # Drop bad quality data
-        if (len(data) == 0):
-            logging.info(f'No data or bad quality data: {tag_name} ')
-            results_df[tag_name] = pd.NA
+        with instrumentation.stage('fetch_tag', tag=tag_name):
+            response = historian_conn.get(url, tag=tag_name)
+        instrumentation.count('tag_bytes', len(response.content), tag=tag_name)
+        with instrumentation.stage('json_decode'):
+            data = load_json(response.content)
+        with instrumentation.stage('clean_samples'):
+            data = clean_samples(data['Data'][0]['Samples'], retrieval_mode, tag_name)
+        instrumentation.count('tag_rows', len(data), tag=tag_name)
+        return data
+    except Exception as e:
+        logger.exception(e)
+        return None
+
+
+def union_index(indexes: list) -> pd.DatetimeIndex:
+    """
+    Sorted union of several TimeStamp indexes, computed with a single sort of all their values
+
+    Params:
+    :indexes (list): DatetimeIndex objects, all naive or all in the same time zone
+
+    Returns:
+    :index (pd.DatetimeIndex):
+    """
+    index = pd.DatetimeIndex(np.unique(np.concatenate([index.values for index in indexes])), name='TimeStamp')
+    tz = indexes[0].tz
+    if tz is not None:
+        # .values are UTC for tz-aware indexes
+        index = index.tz_localize('UTC').tz_convert(tz)
+    return index
+
+
+def assemble_series(series: dict) -> pd.DataFrame:
+    """
+    Builds the wide frame of the extraction in one pass: every series is aligned on the sorted union
+    of all timestamps, instead of merging the frame with one tag or tank at a time.
+    Series without samples become all-NA columns. Columns keep the order of series and their dtypes.
+
+    Params:
+    :series (dict): column name -> pd.Series indexed by unique TimeStamp values in any order, None for a tag without data
+
+    Returns:
+    :results_df (pd.DataFrame): TimeStamp column followed by one column per series
+    """
+    with instrumentation.stage('assemble'):
+        indexes = [values.index for values in series.values() if values is not None and len(values) > 0]
+        if len(indexes) == 0:
+            results_df = pd.DataFrame({'TimeStamp': pd.DatetimeIndex([], tz='UTC')})
+            for name in series:
+                results_df[name] = pd.NA
             return results_df
-        elif (len(data) != 0 and retrieval_mode.lower() != "lab"):
-            data = data[data["Quality"] == 3]
-        elif (len(data) != 0 and retrieval_mode.lower() == "lab"):
-            data.loc[data['Quality'] == 0, ['Value']] = None
-
-        # Then check if there is still data
-        if (len(data) != 0):
-            data['TimeStamp'] = pd.to_datetime(data['TimeStamp'], format='%Y-%m-%dT%H:%M:%S')
-            data['TimeStamp'] = data['TimeStamp'].apply(lambda x: x.replace(microsecond=0))
-            data.drop(columns='Quality', errors='ignore', inplace=True)
-            # Remove duplicates due to dowsampling
-            data = data[~data.index.duplicated()]
 
+        index = union_index(indexes)
+        columns = {}
+        for name, values in series.items():
+            if values is None or len(values) == 0:
+                columns[name] = pd.Series(pd.NA, index=index, dtype=object)
+            elif values.index.equals(index):
+                # Already on the union index. Series are not always sorted, the Historian answers in descending order
+                # when the boundaries are swapped, so any other series is aligned by reindex
+                columns[name] = values.set_axis(index)
+            else:
+                columns[name] = values.reindex(index)
+        return pd.DataFrame(columns, index=index).reset_index()
+
+
+def assemble_tanks(frames: list) -> pd.DataFrame:
+    """
+    Joins the raw data of every tank on TimeStamp, see assemble_series
+
+    Params:
+    :frames (list): extract_tank outputs, in 'T2 Tags.csv' order
+
+    Returns:
+    :final_data (pd.DataFrame): None if there is no frame
+    """
+    if len(frames) == 0:
+        return None
+    series = {}
+    for raw_data in frames:
+        has_samples = 'TimeStamp' in raw_data.columns and len(raw_data) > 0
+        if has_samples:
+            raw_data = raw_data.set_index('TimeStamp')
+        for column in raw_data.columns:
+            if column != 'TimeStamp':
+                series[column] = raw_data[column] if has_samples else None
+    return assemble_series(series)
+
+
+def fetch_tags_cached(tags_list: list, retrieval_mode: str, cycle_time: str, start_time: str, end_time: str,
+                      cache: Sample_Cache, fetch) -> dict:
+    """
+    Serves the samples of tags_list from the cache and only calls fetch for the missing windows.
+    Windows that are not entirely in the past are never stored, as they can still receive data,
+    and only their part in [start_time, end_time] is fetched.
+
+    Params:
+    :tags_list (list):
+    :retrieval_mode (str):
+    :cycle_time (str):
+    :start_time (str):
+    :end_time (str):
+    :cache (Sample_Cache):
+    :fetch (function): fetch(tags, window_start, window_end) -> dict of tag name -> cleaned dataframe
+
+    Returns:
+    :tags_data (dict): tag name -> cleaned dataframe, None for tags that failed
+    """
+    # Extraction is sometimes called with the boundaries swapped
+    start, end = sorted([datetime.strptime(start_time, TIME_FORMAT), datetime.strptime(end_time, TIME_FORMAT)])
+    now = datetime.utcnow()
+
+    pieces = {tag_name: [] for tag_name in tags_list}
+    failed = set()
+    for window_start, window_end in cache.windows(start, end):
+        missing = []
+        for tag_name in tags_list:
+            data = cache.load(tag_name, retrieval_mode, cycle_time, window_start, window_end)
+            if data is None:
+                missing.append(tag_name)
+            else:
+                pieces[tag_name].append(data)
+        if len(missing) == 0:
+            continue
+
+        fetch_start, fetch_end = window_start, window_end
+        if window_end > now:
+            # Open windows are not stored, so only the requested part of them is fetched
+            fetch_start, fetch_end = max(start, window_start), min(end, window_end)
+        fetched = fetch(missing, fetch_start.strftime(TIME_FORMAT), fetch_end.strftime(TIME_FORMAT))
+        for tag_name in missing:
+            data = fetched.get(tag_name)
+            if data is None:
+                failed.add(tag_name)
+                continue
+            # The sample at window_end belongs to the next window
+            if len(data) != 0:
+                boundary = pd.Timestamp(window_end)
+                if data['TimeStamp'].dt.tz is not None:
+                    boundary = boundary.tz_localize('UTC')
+                data = data[data['TimeStamp'] < boundary].reset_index(drop=True)
+            if window_end <= now:
+                cache.store(data, tag_name, retrieval_mode, cycle_time, window_start, window_end)
+            pieces[tag_name].append(data)
+
+    tags_data = {}
+    for tag_name in tags_list:
+        if tag_name in failed:
+            tags_data[tag_name] = None
+            continue
+        data = pd.concat([piece for piece in pieces[tag_name] if len(piece) != 0] or pieces[tag_name][:1], ignore_index=True)
+        if len(data) != 0:
+            lower, upper = pd.Timestamp(start), pd.Timestamp(end)
+            if data['TimeStamp'].dt.tz is not None:
+                lower, upper = lower.tz_localize('UTC'), upper.tz_localize('UTC')
+            data = data[(data['TimeStamp'] >= lower) & (data['TimeStamp'] <= upper)].reset_index(drop=True)
+        tags_data[tag_name] = data
+    return tags_data
+
+
+def get_data_as_df(historian_conn: Historian_Connection, tags_list: list, retrieval_mode: str, cycle_time: str, start_time: str, end_time: str,
+                   max_workers: int = 1, cache: Sample_Cache = None, rules: dict = None) -> pd.DataFrame:
+    """
+    Function that retrieves every tag in tags_list and aligns them into a single dataframe.
+    With max_workers > 1 the HTTP requests run on a bounded thread pool, the columns are always
+    assembled in tags_list order so the result matches the sequential extraction.
+
+    Params:
+    :historian_conn (Historian_Connection):
+    :tags_list (list):
+    :retrieval_mode (str):
+    :cycle_time (str):
+    :start_time (str):
+    :end_time (str):
+    :max_workers (int): maximum number of concurrent requests
+    :cache (Sample_Cache): optional on-disk cache of the samples
+    :rules (dict): tag name -> quality.Quality_Rule applied to the samples of each tag before they are aligned
+
+    Returns:
+    :results_df (pd.DataFrame):
+    """
+    def fetch_window(tags, window_start, window_end):
+        def fetch(tag_name):
+            return fetch_tag_data(tag_name, retrieval_mode, cycle_time, window_start, window_end, historian_conn)
+        if max_workers > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                return dict(zip(tags, executor.map(fetch, tags)))
+        return dict(zip(tags, map(fetch, tags)))
+
+    if cache is not None:
+        tags_data = fetch_tags_cached(tags_list, retrieval_mode, cycle_time, start_time, end_time, cache, fetch_window)
+    else:
+        tags_data = fetch_window(tags_list, start_time, end_time)
+
+    if retrieval_mode.lower() not in ('rawbytime', 'lab'):
+        logger.info(f"{retrieval_mode}: Invalid extraction method. Use lab or rawbytime")
+        return pd.DataFrame()
+    return assemble_tags(tags_list, quality.gate_tags(tags_data, rules))
+
+
+
+def sampled_url(historian_conn: Historian_Connection, tags_list: list, cycle_time: str, start_time: str, end_time: str) -> str:
+    """
+    Builds the url of the sampled endpoint for one or more tags
+
+    Params:
+    :historian_conn (Historian_Connection):
+    :tags_list (list):
+    :cycle_time (str):
+    :start_time (str):
+    :end_time (str):
+
+    Returns:
+    :url (str):
+    """
+    # As the "#" symbol gives issues in proficy, we replace it with *
+    tag_names = ';'.join(tag_name.replace("#", "*") for tag_name in tags_list)
+    return f'{historian_conn.base_url}/historian-rest-api/v1/datapoints/sampled?tagNames={tag_names}' \
+           f'&start={start_time}&end={end_time}&samplingMode=7&calculationMode=1&direction=0&count=0&intervalMs={str(cycle_time)}'
+
+
+def chunk_tags(historian_conn: Historian_Connection, tags_list: list, cycle_time: str, start_time: str, end_time: str,
+               max_tags_per_request: int = MAX_TAGS_PER_REQUEST, max_url_length: int = MAX_URL_LENGTH) -> list:
+    """
+    Splits tags_list into consecutive chunks that respect both the tag count and the url length limits
+
+    Returns:
+    :chunks (list): list of tag lists
+    """
+    chunks = []
+    chunk = []
+    for tag_name in tags_list:
+        candidate = chunk + [tag_name]
+        if chunk and (len(candidate) > max_tags_per_request or
+                      len(sampled_url(historian_conn, candidate, cycle_time, start_time, end_time)) > max_url_length):
+            chunks.append(chunk)
+            candidate = [tag_name]
+        chunk = candidate
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def fetch_tags_batch(tags_list: list, cycle_time: str, start_time: str, end_time: str,
+                     historian_conn: Historian_Connection, tank=None) -> dict:
+    """
+    Function that retrieves several tags from the sampled endpoint with a single request
+    and splits the response back out per tag.
+    If the server rejects the request as too large, the chunk is halved and retried.
+
+    Params:
+    :tags_list (list):
+    :cycle_time (str):
+    :start_time (str):
+    :end_time (str):
+    :historian_conn (Historian_Connection):
+    :tank: tank of the tags, to label the request timings and bytes
+
+    Returns:
+    :tags_data (dict): tag name -> cleaned dataframe, None for tags that failed
+    """
+    url = sampled_url(historian_conn, tags_list, cycle_time, start_time, end_time)
+    labels = {'tags': ';'.join(tags_list)}
+    if tank is not None:
+        labels['tank'] = tank
+    try:
+        with instrumentation.stage('fetch_batch', **labels):
+            response = historian_conn.get(url, **labels)
+        if response.status_code in (413, 414) and len(tags_list) > 1:
+            logger.info(f'Request for {len(tags_list)} tags rejected with {response.status_code}, splitting')
+            half = len(tags_list) // 2
+            tags_data = fetch_tags_batch(tags_list[:half], cycle_time, start_time, end_time, historian_conn, tank)
+            tags_data.update(fetch_tags_batch(tags_list[half:], cycle_time, start_time, end_time, historian_conn, tank))
+            return tags_data
+        with instrumentation.stage('json_decode'):
+            data = load_json(response.content)['Data']
     except Exception as e:
         logger.exception(e)
-        traceback.print_exc
-        return results_df
+        return {tag_name: None for tag_name in tags_list}
+
+    # The server answers with the proficy names, map them back to the requested ones
+    target_names = {tag_name.replace("#", "*"): tag_name for tag_name in tags_list}
+    tags_data = {tag_name: None for tag_name in tags_list}
+    for i, tag_result in enumerate(data):
+        tag_name = target_names.get(tag_result.get('TagName'))
+        if tag_name is None and i < len(tags_list):
+            tag_name = tags_list[i]
+        try:
+            with instrumentation.stage('clean_samples'):
+                tags_data[tag_name] = clean_samples(tag_result['Samples'], 'lab', tag_name)
+            instrumentation.count('tag_rows', len(tags_data[tag_name]), tag=tag_name)
+        except Exception as e:
+            logger.exception(f'{tag_name}: {e}')
+    return tags_data
 
-    # If I have a variable with gaps, I fill it in and fill the gaps with "NA"
-    try:
-        # ONUR - is it OK if we have the data in narrow format instead of wide if it's 'rawbytime'? It's gonna take much less space, and also will be easier to post-treat.
-        if (retrieval_mode.lower()=="rawbytime"):
-            data.reset_index(drop=True, inplace=True) #ONUR
-            data.rename(columns={'Value': tag_name}, inplace=True)
-            if time_stamp_populated == 0: #ONUR
-                time_stamp_populated = 1 #ONUR
-                results_df = data #ONUR
-            else: #ONUR
-                results_df = results_df.merge(data, on='TimeStamp', how='outer')
-            logger.info(f'End: {tag_name}') #ONUR
-        elif (retrieval_mode.lower()=="lab"):
-            # ONUR - to be able to use the timestamp in first column
-            results_df['TimeStamp'] = data['TimeStamp']
-            results_df[tag_name] = data['Value'] #ONUR
-            if time_stamp_populated == 0:
-                time_stamp_populated = 1
-            logger.info(f'End: {tag_name}')
+
+def get_batched_data_as_df(historian_conn: Historian_Connection, tags_list: list, cycle_time: str, start_time: str, end_time: str,
+                           max_tags_per_request: int = MAX_TAGS_PER_REQUEST, max_url_length: int = MAX_URL_LENGTH,
+                           max_workers: int = 1, cache: Sample_Cache = None, rules: dict = None, tank=None) -> pd.DataFrame:
+    """
+    Batched equivalent of get_data_as_df for the "lab" retrieval mode.
+    Tags are requested in as few calls as the limits allow and the wide frame is built in one pass,
+    aligned on TimeStamp.
+
+    Params:
+    :historian_conn (Historian_Connection):
+    :tags_list (list):
+    :cycle_time (str):
+    :start_time (str):
+    :end_time (str):
+    :max_tags_per_request (int):
+    :max_url_length (int):
+    :max_workers (int): maximum number of concurrent requests
+    :cache (Sample_Cache): optional on-disk cache of the samples
+    :rules (dict): tag name -> quality.Quality_Rule, see get_data_as_df
+    :tank: tank of the tags, to label the requests in the metrics
+
+    Returns:
+    :results_df (pd.DataFrame):
+    """
+    def fetch_window(tags, window_start, window_end):
+        chunks = chunk_tags(historian_conn, tags, cycle_time, window_start, window_end, max_tags_per_request, max_url_length)
+
+        def fetch(chunk):
+            return fetch_tags_batch(chunk, cycle_time, window_start, window_end, historian_conn, tank)
+
+        tags_data = {}
+        if max_workers > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for chunk_data in executor.map(fetch, chunks):
+                    tags_data.update(chunk_data)
         else:
-            logger.info(f"{tag_name}: Invalid extraction method. Use lab or rawbytime")
-        # If I am retrieving with gaps to fill, I postprocess data and fill it
-        # The first time I populate the timestamp, I set one.
-        return results_df
-    except Exception as e:
-        logging.exception(e)
-        traceback.print_exc()
-        return results_df
+            for chunk in chunks:
+                tags_data.update(fetch(chunk))
+        return tags_data
 
+    if cache is not None:
+        tags_data = fetch_tags_cached(tags_list, 'lab', cycle_time, start_time, end_time, cache, fetch_window)
+    else:
+        tags_data = fetch_window(tags_list, start_time, end_time)
 
-def get_data_as_df(historian_conn: Historian_Connection, tags_list: list, retrieval_mode: str, cycle_time: str, start_time: str, end_time: str):
-    results_df = pd.DataFrame()
-    time_stamp_populated = 0
-    for tags in tags_list:
-        results_df = print_data_to_df(tags, retrieval_mode, cycle_time, start_time, end_time, results_df, time_stamp_populated, historian_conn)
-        if len(results_df) > 0:
-            time_stamp_populated = 1
-    return results_df
+    # After the cache, so the spike and flatline checks see the windows joined and rule changes apply to cached samples
+    return assemble_tags(tags_list, quality.gate_tags(tags_data, rules))
 
 
-if __name__ == '__main__':
-    logging.basicConfig(filename='./logs/logs.log',
-                        format='%(asctime)s -> [%(levelname)s] %(message)s',
-                        filemode='a')
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
-
-    logger.info('----------------------- STARTED BTF DATA EXTRACTION ----------------------------\n')
-
-    start_time = datetime.now()
-    #---------------------------------------------------------------------------------------------------------------
-
-    # GETTING TIME BOUNDARIES
-    today = date.today()
-    yesterday = today - timedelta(days=1)
-    extract_start = datetime(yesterday.year, yesterday.month, yesterday.day, 0, 0, 0)
-    extract_end = datetime(yesterday.year, yesterday.month, yesterday.day, 23, 59, 59)
-
-    end_time_str = extract_end.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-    start_time_str = extract_start.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-    logger.info(f'Extraction Start Time: {extract_start}')
-    logger.info(f'Extraction End Time: {extract_end}')
-
-    #---------------------------------------------------------------------------------------------------------------
-    # GETTING THE ENVIRONMENT VARIABLES AND ACCESS TOKEN
-    load_dotenv()
-    client_id = os.getenv('client_id')
-    client_secret = os.getenv('client_secret')
-    username = os.getenv('ion_username')
-    password = os.getenv('ion_password')
-    server = os.getenv('server')
-    url = os.getenv('token_url')
-    historian_conn = Historian_Connection(username, password, server, url, client_id, client_secret)
-    flag = historian_conn.get_token()
-    if flag:
-        sys.exit('Unable to access Historian Database')
-
-    #---------------------------------------------------------------------------------------------------------------
-    # GETTING TAGS
-    tag_data = pd.read_csv('./data/T2 Tags.csv')
-    # TODO: What is this for? It's not being used anywhere
-    ### Loops for tags on multiple LPDs
-    LPD_Numbers = [1,2,3,4,5,6,7]
-    # Note, in the future, have this operation done on a list autmatically
-
-    final_data = None
+def assemble_tags(tags_list: list, tags_data: dict) -> pd.DataFrame:
+    """
+    Wide frame of the cleaned samples of tags_list, aligned on TimeStamp by assemble_series.
+    Tags that failed are left out, tags without samples become NA columns.
 
+    Params:
+    :tags_list (list):
+    :tags_data (dict): tag name -> cleaned dataframe, None for tags that failed
+
+    Returns:
+    :results_df (pd.DataFrame):
+    """
+    series = {}
+    for tag_name in tags_list:
+        data = tags_data.get(tag_name)
+        if data is None:
+            continue
+        if len(data) == 0:
+            logging.info(f'No data or bad quality data: {tag_name} ')
+            series[tag_name] = None
+            continue
+        series[tag_name] = data.drop_duplicates(subset='TimeStamp').set_index('TimeStamp')['Value']
+        logger.info(f'End: {tag_name}')
+    if len(series) == 0:
+        return pd.DataFrame()
+    return assemble_series(series)
+
+
+
+def type_tank_data(raw_data: pd.DataFrame, tank) -> pd.DataFrame:
+    """
+    Casts the columns of one tank to the schema consumed by data_transformation, so it never has to parse them:
+    float32 measurements, Int8 pump state (float32 if the pump tag is not a 0/1 style integer signal)
+    and categorical GCAS. Values that are not numbers become NaN.
+
+    Params:
+    :raw_data (pd.DataFrame): columns already renamed by extract_tank
+    :tank: tank number
+
+    Returns:
+    :raw_data (pd.DataFrame):
+    """
+    for column in [f'Temp. {tank}', f'Level {tank}', f'Density {tank}', f'Kilos {tank}']:
+        if column in raw_data:
+            raw_data[column] = pd.to_numeric(raw_data[column], errors='coerce').astype(np.float32)
+
+    if f'{tank}' in raw_data:
+        pump = pd.to_numeric(raw_data[f'{tank}'], errors='coerce')
+        values = pump.dropna()
+        if ((values == values.round()) & (values.abs() <= 127)).all():
+            raw_data[f'{tank}'] = pump.astype('Int8')
+        else:
+            raw_data[f'{tank}'] = pump.astype(np.float32)
+
+    if f'GCAS {tank}' in raw_data:
+        raw_data[f'GCAS {tank}'] = raw_data[f'GCAS {tank}'].astype('category')
+    return raw_data
+
+
+def extract_tank(historian_conn: Historian_Connection, row: pd.Series, cycle_time: str, start_time: str, end_time: str,
+                 cache: Sample_Cache = None) -> pd.DataFrame:
+    """
+    Retrieves the tags of one tank through the quality gate, renames them to the data_transformation columns and types them
+
+    Params:
+    :historian_conn (Historian_Connection):
+    :row (pd.Series): row of 'T2 Tags.csv'
+    :cycle_time (str):
+    :start_time (str):
+    :end_time (str):
+    :cache (Sample_Cache):
+
+    Returns:
+    :raw_data (pd.DataFrame):
+    """
+    columns = tank_tags(row)
+    rules = quality.tag_rules(columns, row['Tank number'])
+    with instrumentation.stage('extract_tank', tank=row['Tank number']):
+        raw_data = get_batched_data_as_df(historian_conn, list(columns.keys()), cycle_time, start_time, end_time, cache=cache,
+                                          rules=rules, tank=row['Tank number'])
+    instrumentation.count('rows_extracted', len(raw_data), tank=row['Tank number'])
+    raw_data.drop(columns='index', errors='ignore', inplace=True)
+    for column in columns:
+        if column in raw_data:
+            raw_data.rename(columns={column: columns[column]}, inplace=True)
+    return type_tank_data(raw_data, row['Tank number'])
+
+
+def extract_tanks_concurrent(historian_conn: Historian_Connection, tag_data: pd.DataFrame, cycle_time: str,
+                             start_time: str, end_time: str, max_concurrency: int = 10, cache: Sample_Cache = None):
+    """
+    Thread-pool extraction engine: extracts up to max_concurrency tanks at once, one thread per tank.
+    A thread fetches the tags of its tank one request at a time, so at most max_concurrency requests are in flight,
+    all on the connection's session: retries, backoff and token refresh behave as in Historian_Connection.get.
+
+    Params:
+    :historian_conn (Historian_Connection):
+    :tag_data (pd.DataFrame): contents of 'T2 Tags.csv'
+    :cycle_time (str):
+    :start_time (str):
+    :end_time (str):
+    :max_concurrency (int): number of threads
+    :cache (Sample_Cache):
+
+    Yields:
+    :(tank, raw_data) (tuple): in completion order, raw_data is None if the tank failed
+    """
+    def extract(row):
+        try:
+            return row['Tank number'], extract_tank(historian_conn, row, cycle_time, start_time, end_time, cache)
+        except Exception:
+            logger.exception(f'Tank {row["Tank number"]} could not get raw\n')
+            logger.exception(get_exception())
+            return row['Tank number'], None
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = [executor.submit(extract, row) for index, row in tag_data.iterrows()]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def get_all_tanks_concurrent(historian_conn: Historian_Connection, tag_data: pd.DataFrame, cycle_time: str,
+                             start_time: str, end_time: str, max_concurrency: int = 10, cache: Sample_Cache = None) -> pd.DataFrame:
+    """
+    Runs extract_tanks_concurrent to completion and merges the tanks in 'T2 Tags.csv' order,
+    giving the same frame as the sequential loop of extract_all_tanks
+
+    Returns:
+    :final_data (pd.DataFrame):
+    """
+    tanks_data = dict(extract_tanks_concurrent(historian_conn, tag_data, cycle_time, start_time, end_time, max_concurrency,
+                                               cache))
+    frames = []
+    for tank in tag_data['Tank number']:
+        if tanks_data.get(tank) is not None:
+            frames.append(tanks_data[tank])
+            logger.info(f'Tank {tank} data extracted\n')
+    return assemble_tanks(frames)
+
+
+def extract_all_tanks(historian_conn: Historian_Connection, tag_data: pd.DataFrame, cycle_time: str, start_time: str,
+                      end_time: str, max_concurrency: int = 0, cache: Sample_Cache = None) -> pd.DataFrame:
+    """
+    Extracts every tank of tag_data, with the thread-pool engine when max_concurrency > 0 and one tank at a time otherwise.
+    A failing tank is logged and left out.
+
+    Params:
+    :historian_conn (Historian_Connection):
+    :tag_data (pd.DataFrame): contents of 'T2 Tags.csv'
+    :cycle_time (str):
+    :start_time (str):
+    :end_time (str):
+    :max_concurrency (int): number of tanks extracted concurrently, 0 keeps the sequential loop
+    :cache (Sample_Cache):
+
+    Returns:
+    :final_data (pd.DataFrame): TimeStamp column followed by the columns of every tank
+    """
+    if max_concurrency > 0:
+        return get_all_tanks_concurrent(historian_conn, tag_data, cycle_time, start_time, end_time, max_concurrency, cache)
+
+    frames = []
     counter = 0
     for index, row in tag_data.iterrows():
         tank = row['Tank number']
-        columns = {row['tIT']:f'Temp. {tank}', row['LIT']:f'Level {tank}', row['Unload Pump']:f'{tank}',
-                   row['Density']:f'Density {tank}', row['Kilo']:f'Kilos {tank}', row['GCAS']:f'GCAS {tank}'}
-
         try:
             # GETTING RAW DATA
-            raw_data = get_data_as_df(historian_conn, list(columns.keys()), 'lab', '120000', end_time_str, start_time_str)
-            raw_data.drop(columns='index', errors='ignore', inplace=True)
-            for column in columns:
-                if column in raw_data:
-                    raw_data.rename(columns={column: columns[column]}, inplace=True)
-
-            if final_data is None:
-                final_data = raw_data
-            elif len(raw_data) == 0:
-                final_data[raw_data.columns] = pd.NA
-            else:
-                final_data = final_data.merge(raw_data, how='outer', on='TimeStamp')
+            raw_data = extract_tank(historian_conn, row, cycle_time, start_time, end_time, cache)
+            frames.append(raw_data)
             logger.info(f'Tank {tank} data extracted\n')
         except Exception as e:
             logger.exception(f'Tank {tank} could not get raw\n')
@@ -237,14 +665,130 @@ if __name__ == '__main__':
 
         counter += 1
         print(f'Extract counter: {counter}/{len(tag_data)}\r', end='')
+    return assemble_tanks(frames)
+
 
-    print('')
-    final_data.rename(columns={'TimeStamp': 'Time'}, inplace=True)
+def split_windows(start: datetime, end: datetime, window: timedelta, period: timedelta = timedelta(days=1)) -> list:
+    """
+    Splits [start, end] into fetch windows of at most window length.
+    Windows never cross a period boundary (periods are aligned on midnight), so they can be
+    stitched back into whole periods before the transformation.
 
-    # final_data.to_csv(f'./data/Raw Data {date.today()}.csv', index=False)
-    end_time = datetime.now()
-    logger.info(f'Time for Data Extraction: {(end_time - start_time).seconds / 60} mins\n')
-    logger.info('----------------------- END OF BTF DATA EXTRACTION ----------------------------\n\n')
+    Params:
+    :start (datetime):
+    :end (datetime):
+    :window (timedelta):
+    :period (timedelta):
+
+    Returns:
+    :windows (list): list of (period_start, window_start, window_end)
+    """
+    windows = []
+    midnight = datetime(start.year, start.month, start.day)
+    period_start = midnight + ((start - midnight) // period) * period
+    while period_start < end:
+        window_start = max(start, period_start)
+        period_end = min(end, period_start + period)
+        while window_start < period_end:
+            window_end = min(window_start + window, period_end)
+            windows.append((period_start, window_start, window_end))
+            window_start = window_end
+        period_start += period
+    return windows
+
+
+def extract_window(historian_conn: Historian_Connection, tag_data: pd.DataFrame, window_start: datetime, window_end: datetime,
+                   cycle_time: str, max_concurrency: int, last: bool, cache: Sample_Cache = None) -> pd.DataFrame:
+    """
+    Extracts every tank for one window. The sample at window_end belongs to the next window,
+    so it is dropped unless this is the last window of the backfill.
+
+    Returns:
+    :final_data (pd.DataFrame):
+    """
+    final_data = get_all_tanks_concurrent(historian_conn, tag_data, cycle_time, window_start.strftime(TIME_FORMAT),
+                                          window_end.strftime(TIME_FORMAT), max_concurrency, cache)
+    if final_data is None or len(final_data) == 0 or last:
+        return final_data
 
-    # Passing the extracted data to transformation logic
-    data_transformation(final_data)
+    boundary = pd.Timestamp(window_end)
+    if final_data['TimeStamp'].dt.tz is not None:
+        boundary = boundary.tz_localize('UTC')
+    return final_data[final_data['TimeStamp'] < boundary]
+
+
+def backfill(historian_conn: Historian_Connection, tag_data: pd.DataFrame, start: datetime, end: datetime,
+             window: timedelta = timedelta(hours=6), period: timedelta = timedelta(days=1), cycle_time: str = '120000',
+             max_parallel_windows: int = 4, max_concurrency: int = 10, output_path: str = None, cache: Sample_Cache = None):
+    """
+    Re-processes an arbitrary time range in one run.
+    The range is split into windows that are extracted in parallel, at most max_parallel_windows at a time,
+    and each completed period is stitched together and passed to data_transformation,
+    so peak memory is bounded by the period and the windows in flight rather than the whole range.
+
+    Params:
+    :historian_conn (Historian_Connection):
+    :tag_data (pd.DataFrame): contents of 'T2 Tags.csv'
+    :start (datetime):
+    :end (datetime):
+    :window (timedelta): length of a single extraction
+    :period (timedelta): amount of data given to each data_transformation call
+    :cycle_time (str):
+    :max_parallel_windows (int):
+    :max_concurrency (int): concurrent tank requests within a window
+    :output_path (str): results file, all periods are appended to it
+    :cache (Sample_Cache):
+    """
+    if output_path is None:
+        output_path = f'./data/Backfill Results {start:%Y-%m-%d} {end:%Y-%m-%d}.csv'
+    writer = make_writer(path=output_path)
+    # Running the same backfill again (e.g. after a failure) replaces its results instead of adding to them
+    writer.clear(start.date(), end.date())
+    windows = split_windows(start, end, window, period)
+    logger.info(f'Backfill from {start} to {end} in {len(windows)} windows')
+
+    def transform(period_start, frames):
+        frames = [frame for frame in frames if frame is not None and len(frame) > 0]
+        if len(frames) == 0:
+            logger.info(f'No data for period {period_start}')
+            return
+        period_data = pd.concat(frames, ignore_index=True).rename(columns={'TimeStamp': 'Time'})
+        try:
+            # Imported here, so that extraction-only runs do not load the transformation
+            from BTFeTL import data_transformation
+            data_transformation(period_data, output_path=output_path, append=True, writer=writer)
+        except Exception as e:
+            logger.exception(f'Period {period_start} could not be transformed\n')
+            logger.exception(get_exception())
+
+    with ThreadPoolExecutor(max_workers=max_parallel_windows) as executor:
+        pending = deque()
+        next_window = 0
+        current_period = None
+        frames = []
+        while next_window < len(windows) or pending:
+            # Keep at most max_parallel_windows windows in flight, results are consumed in order
+            while next_window < len(windows) and len(pending) < max_parallel_windows:
+                period_start, window_start, window_end = windows[next_window]
+                last = next_window == len(windows) - 1
+                future = executor.submit(extract_window, historian_conn, tag_data, window_start, window_end,
+                                         cycle_time, max_concurrency, last, cache)
+                pending.append((period_start, window_start, future))
+                next_window += 1
+
+            period_start, window_start, future = pending.popleft()
+            if period_start != current_period:
+                if current_period is not None:
+                    transform(current_period, frames)
+                current_period = period_start
+                frames = []
+            frames.append(future.result())
+            logger.info(f'Window starting {window_start} extracted')
+
+        if current_period is not None:
+            transform(current_period, frames)
+
+if __name__ == '__main__':
+    # Same as python btf.py run, kept for the existing schedules
+    import btf
+    sys.exit(btf.main(['run'] + sys.argv[1:]))
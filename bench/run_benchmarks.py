@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Extraction and transformation benchmarks on synthetic data, compared against a stored baseline.
+
+    python -m bench.run_benchmarks                      # run and compare with bench/baseline.json
+    python -m bench.run_benchmarks --update-baseline    # run and store the results as the new baseline
+
+Exits with status 1 when a benchmark is slower (or uses more memory) than its baseline by more than --tolerance.
+"""
+import argparse
+from datetime import datetime
+import gc
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+import BTFeTL
+import NewTest
+from bench.stub_historian import Stub_Historian
+from bench.synthetic import make_raw_data, make_tag_table, make_tags_mapping, tag_columns
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def best_of(function, repeat: int) -> float:
+    """
+    Returns: the fastest of repeat runs of function, in seconds
+    """
+    timings = []
+    for i in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def traced_peak(function) -> int:
+    """
+    Returns: peak memory allocated while function runs, in bytes
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_extraction(args, raw_data: pd.DataFrame) -> dict:
+    """
+    Extracts every synthetic tank from the stub, sequentially and with the thread-pool engine
+    """
+    tag_table = make_tag_table(args.tanks)
+    stub = Stub_Historian(raw_data, tag_columns(tag_table), latency=args.latency)
+    base_url = stub.start()
+    try:
+        historian_conn = NewTest.Historian_Connection('user', 'password', 'stub', f'{base_url}/token', 'client', 'secret',
+                                                      base_url=base_url, pool_size=args.concurrency)
+        historian_conn.get_token()
+        start = pd.Timestamp(raw_data['Time'].iloc[0]).strftime(NewTest.TIME_FORMAT)
+        end = pd.Timestamp(raw_data['Time'].iloc[-1]).strftime(NewTest.TIME_FORMAT)
+
+        def sequential():
+            frames = [NewTest.extract_tank(historian_conn, row, '120000', start, end) for index, row in tag_table.iterrows()]
+            NewTest.assemble_tanks(frames)
+
+        def concurrent():
+            NewTest.get_all_tanks_concurrent(historian_conn, tag_table, '120000', start, end, args.concurrency)
+
+        requests_before, bytes_before = stub.requests, stub.bytes_sent
+        sequential_seconds = best_of(sequential, args.repeat)
+        requests = (stub.requests - requests_before) // args.repeat
+        megabytes = (stub.bytes_sent - bytes_before) / args.repeat / 1024 ** 2
+        concurrent_seconds = best_of(concurrent, args.repeat)
+    finally:
+        stub.stop()
+
+    return {'extract_sequential': {'seconds': sequential_seconds, 'requests': requests, 'megabytes': megabytes,
+                                   'tags_per_second': len(tag_table) * 6 / sequential_seconds},
+            'extract_concurrent': {'seconds': concurrent_seconds, 'tags_per_second': len(tag_table) * 6 / concurrent_seconds}}
+
+
+def bench_transformation(args, raw_data: pd.DataFrame) -> dict:
+    """
+    Runs data_transformation with each engine, timing it and tracing its peak memory
+    """
+    results = {}
+    for engine in ('tank', 'long'):
+        def transform():
+            BTFeTL.data_transformation(raw_data.copy(), output_path='./data/Bench Results.csv', engine=engine, workers=1)
+        seconds = best_of(transform, args.repeat)
+        results[f'transform_{engine}'] = {'seconds': seconds, 'rows_per_second': len(raw_data) * args.tanks / seconds,
+                                          'peak_megabytes': traced_peak(transform) / 1024 ** 2}
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Returns: descriptions of the metrics that regressed beyond tolerance
+    """
+    regressions = []
+    for name, metrics in results.items():
+        for metric in ('seconds', 'peak_megabytes'):
+            if metric not in metrics or metric not in baseline.get(name, {}):
+                continue
+            reference = baseline[name][metric]
+            if metrics[metric] > reference * (1 + tolerance):
+                regressions.append(f'{name} {metric}: {metrics[metric]:.3f} vs {reference:.3f} baseline')
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='BTF extraction and transformation benchmarks')
+    parser.add_argument('--tanks', type=int, default=10)
+    parser.add_argument('--days', type=float, default=1)
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds added by the stub to every request')
+    parser.add_argument('--concurrency', type=int, default=8, help='tanks extracted at once by the thread-pool engine')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, the fastest one is kept')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown over the baseline')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--skip-extraction', action='store_true')
+    args = parser.parse_args()
+
+    # data_transformation reads and writes relative to the working directory
+    repo = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='btf-bench-')
+    os.chdir(work_dir)
+    os.makedirs('data')
+    logging.basicConfig(filename=os.path.join(work_dir, 'bench.log'), level=logging.INFO)
+    make_tags_mapping(args.tanks).to_csv('./data/Tags Mapping.csv', index=False)
+    raw_data = make_raw_data(args.tanks, args.days)
+
+    results = {}
+    if not args.skip_extraction:
+        results.update(bench_extraction(args, raw_data))
+    results.update(bench_transformation(args, raw_data))
+    os.chdir(repo)
+    logging.shutdown()
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    for name, metrics in results.items():
+        print(f'{name:20} ' + '  '.join(f'{metric}={value:.3f}' for metric, value in metrics.items()))
+
+    run = {'date': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+           'pandas': pd.__version__, 'cpus': os.cpu_count(),
+           'parameters': {key: getattr(args, key) for key in ('tanks', 'days', 'latency', 'concurrency')},
+           'results': results}
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(run, f, indent=2)
+        print(f'Baseline written to {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}, run with --update-baseline first')
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['parameters'] != run['parameters']:
+        print('Warning: the baseline was recorded with different parameters, comparing anyway')
+    regressions = compare(results, baseline['results'], args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the Historian REST API, serving synthetic samples so the extraction can be measured
+without production credentials. Speaks the token endpoint and the raw, interpolated and sampled
+/historian-rest-api/v1/datapoints endpoints used by Historian_Connection and fetch_tag_data.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+import pandas as pd
+
+DATAPOINTS_PATH = '/historian-rest-api/v1/datapoints/'
+
+
+class Stub_Historian:
+    """
+    Serves the columns of a wide frame (see synthetic.make_raw_data) as Historian tags.
+    Every request waits latency seconds before being answered, requests and bytes sent are counted.
+    Missing values are sent as bad quality samples, as the Historian does for gaps.
+    """
+    raw_data = None
+    columns = None
+    latency = None
+    requests = None
+    bytes_sent = None
+    server = None
+
+    def __init__(self, raw_data: pd.DataFrame, columns: dict, latency: float = 0.0):
+        """
+        Args:
+        :raw_data (pd.DataFrame): wide frame with a Time column
+        :columns (dict): tag name -> column of raw_data
+        :latency (float): seconds added to every request
+        """
+        self.raw_data = raw_data.set_index(pd.DatetimeIndex(raw_data['Time']).tz_localize('UTC')).drop(columns='Time')
+        self.columns = columns
+        self.latency = latency
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    def start(self) -> str:
+        """
+        Starts serving on a free local port in a daemon thread
+
+        Returns: base url of the server, to pass as Historian_Connection base_url
+        """
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                stub.send(self, {'access_token': 'stub-token', 'token_type': 'bearer', 'expires_in': 3600})
+
+            def do_GET(self):
+                time.sleep(stub.latency)
+                try:
+                    body = stub.datapoints(self.path)
+                except KeyError as e:
+                    body = {'ErrorCode': 1, 'ErrorMessage': f'Unknown tag {e}', 'Data': []}
+                stub.send(self, body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def send(self, handler: BaseHTTPRequestHandler, body: dict):
+        content = json.dumps(body).encode()
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += len(content)
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(content)))
+        handler.end_headers()
+        handler.wfile.write(content)
+
+    def datapoints(self, path: str) -> dict:
+        """
+        Answers a GET on one of the datapoints endpoints
+        """
+        url = urllib.parse.urlparse(path)
+        mode = url.path[len(DATAPOINTS_PATH):].split('/')[0]
+        if mode == 'sampled':
+            query = urllib.parse.parse_qs(url.query)
+            tag_names = query['tagNames'][0].strip().split(';')
+            start, end = query['start'][0].strip(), query['end'][0].strip()
+            interval = int(query.get('intervalMs', ['120000'])[0])
+        else:
+            # {mode}/{tag}/{start}/{end}/{direction}/{count or interval}
+            parts = [urllib.parse.unquote(part) for part in url.path[len(DATAPOINTS_PATH):].split('/')]
+            tag_names, start, end = [parts[1]], parts[2], parts[3]
+            interval = int(parts[5]) if mode == 'interpolated' else 0
+        return {'ErrorCode': 0, 'Data': [{'TagName': tag_name, 'Samples': self.samples(tag_name, start, end, interval)}
+                                         for tag_name in tag_names]}
+
+    def samples(self, tag_name: str, start: str, end: str, interval: int) -> list:
+        """
+        Samples of a tag between start and end (in any order), every interval milliseconds when interval is set
+        """
+        # The extraction replaces "#" with "*" in tag names
+        column = self.columns[tag_name] if tag_name in self.columns else self.columns[tag_name.replace('*', '#')]
+        start, end = sorted([pd.Timestamp(start), pd.Timestamp(end)])
+        values = self.raw_data.loc[start:end, column]
+        if interval > 0:
+            values = values.iloc[::max(int(pd.Timedelta(milliseconds=interval) / self.sample_period()), 1)]
+
+        time_stamps = values.index.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        quality = np.where(values.isna(), 0, 3)
+        if values.dtype == object:
+            values = values.where(values.notna(), None)
+        else:
+            values = values.astype(object).where(values.notna(), 0.0)
+        return [{'TimeStamp': time_stamp, 'Value': value, 'Quality': int(code)}
+                for time_stamp, value, code in zip(time_stamps, values, quality)]
+
+    def sample_period(self) -> pd.Timedelta:
+        if len(self.raw_data) < 2:
+            return pd.Timedelta(minutes=2)
+        return self.raw_data.index[1] - self.raw_data.index[0]
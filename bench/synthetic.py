@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic tank data with the shape of the Historian extraction:
+unloading sessions that raise the level, slow discharge in between, daily temperature cycles,
+drifting density, occasional product (GCAS) changes and gaps in every signal.
+"""
+import zlib
+
+import numpy as np
+import pandas as pd
+
+# Real tank numbers first, so the underground tank capacities of BTFeTL are exercised too.
+# A non numeric name comes first so 'Tags Mapping.csv' is read back with string tank names
+TANK_NAMES = ['2230E', '12', '8944', '8945', '2230W', '30C', '30E', '30W', '40E', '40W']
+PRODUCTS = ['A100', 'B200', 'C300', 'D400']
+
+
+def tank_names(tanks: int) -> list:
+    """
+    Returns: tanks names, the real ones first then T1, T2...
+    """
+    return (TANK_NAMES + [f'T{i}' for i in range(1, tanks + 1)])[:tanks]
+
+
+def tank_seed(seed: int, tank) -> int:
+    """
+    Stable per-tank seed, unlike hash() it does not change between interpreter runs
+    """
+    return zlib.crc32(f'{seed}|{tank}'.encode())
+
+
+def tank_signals(tank, time: pd.DatetimeIndex, seed: int = 0, gap_rate: float = 0.01, discharge: bool = True) -> dict:
+    """
+    Signals of one tank over time
+
+    Args:
+    :tank: tank name
+    :time (pd.DatetimeIndex): regular sample times
+    :seed (int):
+    :gap_rate (float): share of missing samples of every signal, outages of a few hours come on top
+    :discharge (bool): add a 'Discharge' pump output signal
+
+    Returns: column name -> values, with the column names of the extraction
+    """
+    rng = np.random.default_rng(tank_seed(seed, tank))
+    rows = len(time)
+    step_minutes = (time[1] - time[0]).total_seconds() / 60 if rows > 1 else 2
+
+    # Unloading sessions of 30 minutes to 2 hours every 2 to 10 hours
+    pump = np.zeros(rows)
+    i = int(rng.integers(0, max(int(240 / step_minutes), 1)))
+    while i < rows:
+        length = int(rng.uniform(30, 120) / step_minutes)
+        pump[i:i + length] = 1
+        i += length + int(rng.uniform(120, 600) / step_minutes)
+
+    fill_rate = rng.uniform(0.5, 1.0) * step_minutes / 2
+    discharge_rate = rng.uniform(0.02, 0.06) * step_minutes / 2
+    noise = rng.normal(0, 0.02, rows)
+    level = np.empty(rows)
+    current = rng.uniform(30, 70)
+    for j in range(rows):
+        current += (fill_rate if pump[j] else -discharge_rate) + noise[j]
+        current = min(max(current, 3.0), 97.0)
+        level[j] = current
+
+    hours = (time - time[0]).total_seconds().to_numpy() / 3600
+    temp = 40 + 3 * np.sin(2 * np.pi * (hours + rng.uniform(0, 24)) / 24) + rng.normal(0, 0.2, rows)
+    density = 1.1 + np.cumsum(rng.normal(0, 0.0005, rows)).clip(-0.05, 0.05)
+    capacity = rng.uniform(20000, 220000)
+    kilos = level / 100 * capacity * density
+    product = np.array(PRODUCTS)[np.cumsum(rng.random(rows) < 0.002) % len(PRODUCTS)]
+
+    signals = {f'Level {tank}': level, f'Temp. {tank}': temp, f'Density {tank}': density, f'Kilos {tank}': kilos,
+               f'{tank}': pump}
+    if discharge:
+        signals[f'Discharge {tank}'] = np.where(pump == 1, 0, rng.uniform(20, 80, rows))
+    for column, values in signals.items():
+        values = values.astype(np.float64)
+        values[rng.random(rows) < gap_rate] = np.nan
+        if rng.random() < 0.3:
+            start = int(rng.integers(0, rows))
+            values[start:start + int(rng.uniform(60, 240) / step_minutes)] = np.nan
+        signals[column] = values
+    signals[f'GCAS {tank}'] = product
+    return signals
+
+
+def make_raw_data(tanks: int = 10, days: float = 1, seed: int = 0, start: str = '2024-03-01',
+                  cycle_time: str = '2min', gap_rate: float = 0.01) -> pd.DataFrame:
+    """
+    Wide frame as data_transformation receives it from the extraction
+
+    Returns: Time column followed by the columns of every tank
+    """
+    time = pd.date_range(start, periods=int(pd.Timedelta(days=days) / pd.Timedelta(cycle_time)), freq=cycle_time)
+    columns = {'Time': time}
+    for i, tank in enumerate(tank_names(tanks)):
+        columns.update(tank_signals(tank, time, seed, gap_rate, discharge=i % 2 == 0))
+    return pd.DataFrame(columns)
+
+
+def make_tags_mapping(tanks: int = 10) -> pd.DataFrame:
+    """
+    Returns: contents of 'Tags Mapping.csv' for the synthetic tanks
+    """
+    return pd.DataFrame({'Tank': tank_names(tanks), 'Extra Pumps': np.nan})
+
+
+def make_tag_table(tanks: int = 10) -> pd.DataFrame:
+    """
+    Returns: contents of 'T2 Tags.csv' for the synthetic tanks, with one Historian tag per signal
+    """
+    return pd.DataFrame([{'Tank number': tank, 'tIT': f'BTF.{tank}.TIT', 'LIT': f'BTF.{tank}.LIT',
+                          'Unload Pump': f'BTF.{tank}.PUMP', 'Density': f'BTF.{tank}.DENSITY',
+                          'Kilo': f'BTF.{tank}.KILO', 'GCAS': f'BTF.{tank}.GCAS'} for tank in tank_names(tanks)])
+
+
+def tag_columns(tag_table: pd.DataFrame) -> dict:
+    """
+    Returns: Historian tag name -> column of make_raw_data
+    """
+    columns = {}
+    for index, row in tag_table.iterrows():
+        tank = row['Tank number']
+        columns.update({row['tIT']: f'Temp. {tank}', row['LIT']: f'Level {tank}', row['Unload Pump']: f'{tank}',
+                        row['Density']: f'Density {tank}', row['Kilo']: f'Kilos {tank}', row['GCAS']: f'GCAS {tank}'})
+    return columns
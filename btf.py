@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Command line entry point of the BTF pipeline.
+
+    python btf.py check-token                          # can the Historian be reached with the .env credentials
+    python btf.py extract --output raw.pkl             # extraction of yesterday only
+    python btf.py transform --input raw.pkl            # transformation of a saved extraction
+    python btf.py transform --input raw.parquet --chunk-rows 10000    # same, reading the file a chunk at a time
+    python btf.py run                                  # extraction then transformation, as python NewTest.py
+    python btf.py run --start 2024-01-01 --end 2024-02-01 --window-hours 6    # backfill
+    python btf.py serve --interval-minutes 5           # resident micro-batches on a warm connection
+    python btf.py --profile-import check-token         # also reports the time spent importing each module
+
+pandas, numpy and the pipeline modules are only imported by the subcommands that need them,
+so a token check or a --dry-run starts without loading them.
+"""
+import argparse
+from datetime import date, datetime, timedelta
+import importlib
+import logging
+import os
+import signal
+import sys
+import time
+
+PROCESS_START = time.perf_counter()
+logger = logging.getLogger()
+
+# Time format expected by the Historian REST API, as NewTest.TIME_FORMAT
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.000Z"
+
+# Rows per row group of the raw data Parquet files
+RAW_ROW_GROUP_SIZE = 10000
+
+# Modules imported by lazy_import, with the seconds it took and the number of modules they pulled in
+IMPORT_TIMES = []
+
+
+def lazy_import(name: str):
+    """
+    Imports module name on first use, recording how long it took for --profile-import
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    loaded = len(sys.modules)
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    IMPORT_TIMES.append((name, time.perf_counter() - start, len(sys.modules) - loaded))
+    return module
+
+
+def import_report() -> str:
+    """
+    Returns: the modules imported by lazy_import, slowest first, and the time since the process started
+    """
+    lines = [f'{"module":20} {"seconds":>8} {"modules loaded":>15}']
+    for name, seconds, modules in sorted(IMPORT_TIMES, key=lambda item: -item[1]):
+        lines.append(f'{name:20} {seconds:8.3f} {modules:15d}')
+    lines.append(f'{"total imports":20} {sum(item[1] for item in IMPORT_TIMES):8.3f} {len(sys.modules):15d}')
+    lines.append(f'{"since start":20} {time.perf_counter() - PROCESS_START:8.3f}')
+    return '\n'.join(lines)
+
+
+def setup_logging():
+    os.makedirs('./logs', exist_ok=True)
+    logging.basicConfig(filename='./logs/logs.log',
+                        format='%(asctime)s -> [%(levelname)s] %(message)s',
+                        filemode='a')
+    logger.setLevel(logging.INFO)
+
+
+def daily_window() -> tuple:
+    """
+    Returns: (start, end) of the daily run, the whole of yesterday
+    """
+    yesterday = date.today() - timedelta(days=1)
+    return (datetime(yesterday.year, yesterday.month, yesterday.day, 0, 0, 0),
+            datetime(yesterday.year, yesterday.month, yesterday.day, 23, 59, 59))
+
+
+def connect(pool_size: int = None):
+    """
+    Historian_Connection built from the .env file and the environment, with its access token
+
+    Returns: the connection, or None if no token could be obtained
+    """
+    dotenv = lazy_import('dotenv')
+    dotenv.load_dotenv()
+    missing = [variable for variable in ('server', 'token_url') if not os.getenv(variable)]
+    if missing:
+        logger.error(f'Environment variables {missing} are not set')
+        return None
+    historian = lazy_import('historian')
+    if pool_size is None:
+        pool_size = max(int(os.getenv('max_workers', 6)), int(os.getenv('max_concurrency', 0)))
+    historian_conn = historian.Historian_Connection(os.getenv('ion_username'), os.getenv('ion_password'), os.getenv('server'),
+                                                    os.getenv('token_url'), os.getenv('client_id'), os.getenv('client_secret'),
+                                                    base_url=os.getenv('historian_base_url'),
+                                                    timeout=float(os.getenv('request_timeout', 60)), pool_size=pool_size)
+    if historian_conn.get_token():
+        return None
+    return historian_conn
+
+
+def sample_cache():
+    """
+    Raw samples are cached on disk when the raw_cache_dir environment variable is set
+
+    Returns: a Sample_Cache or None
+    """
+    cache_dir = os.getenv('raw_cache_dir')
+    return lazy_import('raw_cache').Sample_Cache(cache_dir) if cache_dir else None
+
+
+def write_metrics():
+    """
+    Stage timings, counters and peak memory of the run, as JSON or Prometheus text (.prom), when metrics_path is set
+    """
+    metrics_path = os.getenv('metrics_path')
+    if metrics_path:
+        lazy_import('instrumentation').write_metrics(metrics_path)
+
+
+def dry_run(args) -> int:
+    """
+    Prints what a run would do and checks the .env variables and configuration files exist,
+    without connecting or loading pandas
+
+    Returns: 1 if a required variable or file is missing
+    """
+    lazy_import('dotenv').load_dotenv()
+    start, end = (args.start, args.end or datetime.now()) if getattr(args, 'start', None) else daily_window()
+    print(f'{args.command} from {start} to {end}')
+    missing = []
+    for variable in ('client_id', 'client_secret', 'ion_username', 'ion_password', 'server', 'token_url'):
+        print(f'  {variable:22} {"set" if os.getenv(variable) else "MISSING"}')
+        if not os.getenv(variable):
+            missing.append(variable)
+    for variable in ('max_concurrency', 'transform_engine', 'transform_kernel', 'transform_workers', 'transform_state', 'output_format',
+                     'resample_resolution', 'quality_codes', 'raw_cache_dir', 'metrics_path'):
+        if os.getenv(variable):
+            print(f'  {variable:22} {os.getenv(variable)}')
+    for path in ('./data/T2 Tags.csv', './data/Tags Mapping.csv'):
+        if not os.path.exists(path):
+            print(f'  missing {path}')
+            missing.append(path)
+    return 1 if missing else 0
+
+
+def check_token(args) -> int:
+    historian_conn = connect(pool_size=1)
+    print('Access token OK' if historian_conn is not None else 'Unable to access Historian Database')
+    return 0 if historian_conn is not None else 1
+
+
+def extract(args, historian_conn=None):
+    """
+    Extracts every tank of the registry for yesterday
+
+    Returns: the raw data with a Time column, as data_transformation expects it
+    """
+    NewTest = lazy_import('NewTest')
+    tank_registry = lazy_import('tank_registry')
+    if historian_conn is None:
+        historian_conn = connect()
+        if historian_conn is None:
+            sys.exit('Unable to access Historian Database')
+
+    start, end = daily_window()
+    logger.info(f'Extraction Start Time: {start}')
+    logger.info(f'Extraction End Time: {end}')
+    cache = sample_cache()
+    final_data = NewTest.extract_all_tanks(historian_conn, tank_registry.get_registry().tag_table(), '120000',
+                                           end.strftime(TIME_FORMAT), start.strftime(TIME_FORMAT),
+                                           int(os.getenv('max_concurrency', 0)), cache)
+    if cache is not None:
+        cache.evict()
+    return final_data.rename(columns={'TimeStamp': 'Time'})
+
+
+def save_raw_data(raw_data, path: str):
+    """
+    Writes the extraction to path: csv, Parquet or, for any other extension, a pickle keeping the column types
+    """
+    if path.endswith('.csv'):
+        raw_data.to_csv(path, index=False)
+    elif path.endswith('.parquet'):
+        # Small row groups, so transform --chunk-rows can read the file a few at a time
+        raw_data.to_parquet(path, index=False, row_group_size=RAW_ROW_GROUP_SIZE)
+    else:
+        raw_data.to_pickle(path)
+
+
+def load_raw_data(path: str):
+    pd = lazy_import('pandas')
+    if path.endswith('.csv'):
+        return pd.read_csv(path, parse_dates=['Time'])
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    return pd.read_pickle(path)
+
+
+def transform(raw_data, output_path: str = None):
+    """
+    Passes the extracted data to the transformation.
+    With a transform_state file, events are carried across runs instead of being cut at the extraction boundaries
+    """
+    state_path = os.getenv('transform_state')
+    if state_path:
+        return lazy_import('event_stream').incremental_transformation(raw_data, state_path, output_path=output_path)
+    return lazy_import('BTFeTL').data_transformation(raw_data, output_path=output_path)
+
+
+def extract_command(args) -> int:
+    if args.dry_run:
+        return dry_run(args)
+    start_time = datetime.now()
+    logger.info('----------------------- STARTED BTF DATA EXTRACTION ----------------------------\n')
+    raw_data = extract(args)
+    output_path = args.output if args.output else f'./data/Raw Data {date.today()}.pkl'
+    save_raw_data(raw_data, output_path)
+    logger.info(f'Raw data written to {output_path}')
+    logger.info(f'Time for Data Extraction: {(datetime.now() - start_time).seconds / 60} mins\n')
+    write_metrics()
+    return 0
+
+
+def transform_command(args) -> int:
+    if args.dry_run:
+        return dry_run(args)
+    if args.chunk_rows:
+        event_stream = lazy_import('event_stream')
+        max_gap = args.max_gap_rows if args.max_gap_rows is not None else event_stream.MAX_GAP_ROWS
+        event_stream.chunked_transformation(args.input, args.chunk_rows, output_path=args.output, max_gap=max_gap)
+    else:
+        transform(load_raw_data(args.input), args.output)
+    write_metrics()
+    return 0
+
+
+def run_command(args) -> int:
+    """
+    Daily run (extraction of yesterday then transformation), or a backfill of [--start, --end]
+    """
+    if args.dry_run:
+        return dry_run(args)
+    start_time = datetime.now()
+    logger.info('----------------------- STARTED BTF DATA EXTRACTION ----------------------------\n')
+    if args.start is not None:
+        # Every window in flight extracts max_concurrency tanks at once, the pool needs a connection for each
+        max_concurrency = max(int(os.getenv('max_concurrency', 0)), 1)
+        historian_conn = connect(pool_size=args.parallel_windows * max_concurrency)
+    else:
+        historian_conn = connect()
+    if historian_conn is None:
+        sys.exit('Unable to access Historian Database')
+
+    if args.start is not None:
+        NewTest = lazy_import('NewTest')
+        tank_registry = lazy_import('tank_registry')
+        cache = sample_cache()
+        NewTest.backfill(historian_conn, tank_registry.get_registry().tag_table(), args.start,
+                         args.end if args.end is not None else datetime.now(),
+                         window=timedelta(hours=args.window_hours), max_parallel_windows=args.parallel_windows,
+                         max_concurrency=max_concurrency, cache=cache)
+        if cache is not None:
+            cache.evict()
+        logger.info(f'Time for Backfill: {(datetime.now() - start_time).seconds / 60} mins\n')
+        write_metrics()
+        return 0
+
+    raw_data = extract(args, historian_conn)
+    print('')
+    logger.info(f'Time for Data Extraction: {(datetime.now() - start_time).seconds / 60} mins\n')
+    logger.info('----------------------- END OF BTF DATA EXTRACTION ----------------------------\n\n')
+    transform(raw_data)
+    write_metrics()
+    return 0
+
+
+def serve_command(args) -> int:
+    """
+    Stays resident and processes the samples received since the previous batch every --interval-minutes.
+    The connection, its token, the tank registry and the event state are kept between batches; SIGTERM
+    (or Ctrl+C) stops the service after the current batch.
+    """
+    if args.dry_run:
+        return dry_run(args)
+    historian_conn = connect()
+    if historian_conn is None:
+        sys.exit('Unable to access Historian Database')
+
+    service = lazy_import('service')
+    pipeline = service.Pipeline_Service(historian_conn, os.getenv('transform_state', './data/Transform State.pkl'),
+                                        interval=timedelta(minutes=args.interval_minutes),
+                                        lag=timedelta(minutes=args.lag_minutes), lookback=timedelta(hours=args.lookback_hours),
+                                        max_concurrency=max(int(os.getenv('max_concurrency', 0)), 1))
+    signal.signal(signal.SIGTERM, lambda signum, frame: pipeline.stop())
+    logger.info('----------------------- STARTED BTF SERVICE ----------------------------\n')
+    try:
+        pipeline.serve(max_batches=1 if args.once else None)
+    except KeyboardInterrupt:
+        pass
+    logger.info('----------------------- STOPPED BTF SERVICE ----------------------------\n')
+    write_metrics()
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='BTF data extraction and transformation')
+    parser.add_argument('--profile-import', action='store_true', help='print the time spent importing modules on exit')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('check-token', help='request an access token and exit')
+    command.set_defaults(function=check_token)
+
+    command = commands.add_parser('extract', help='extract yesterday and save the raw data')
+    command.add_argument('--output', help="raw data file (.pkl, .csv or .parquet), './data/Raw Data {today}.pkl' by default")
+    command.add_argument('--dry-run', action='store_true', help='check the configuration without connecting')
+    command.set_defaults(function=extract_command)
+
+    command = commands.add_parser('transform', help='transform a raw data file saved by extract')
+    command.add_argument('--input', required=True)
+    command.add_argument('--output', help="results file, './data/Daily Results {today}.csv' by default")
+    command.add_argument('--chunk-rows', type=int, help='read a .parquet or .csv input this many rows at a time, '
+                                                        'for files too large to load at once')
+    command.add_argument('--max-gap-rows', type=int, help='with --chunk-rows, rows waiting for a sensor that stopped '
+                                                          'reporting before its last value is used, 720 by default. '
+                                                          'Longer outages that end differ from the in-memory '
+                                                          'transform, which interpolates them')
+    command.add_argument('--dry-run', action='store_true', help='check the configuration without transforming')
+    command.set_defaults(function=transform_command)
+
+    command = commands.add_parser('run', help='extract then transform, or backfill a time range with --start')
+    command.add_argument('--start', type=datetime.fromisoformat, help='backfill start, defaults to the daily run of yesterday')
+    command.add_argument('--end', type=datetime.fromisoformat, help='backfill end, defaults to now')
+    command.add_argument('--window-hours', type=float, default=6, help='length of each backfill extraction window')
+    command.add_argument('--parallel-windows', type=int, default=4, help='number of backfill windows extracted in parallel')
+    command.add_argument('--dry-run', action='store_true', help='check the configuration without connecting')
+    command.set_defaults(function=run_command)
+
+    command = commands.add_parser('serve', help='stay resident and process new samples every few minutes')
+    command.add_argument('--interval-minutes', type=float, default=5, help='time between two micro-batches')
+    command.add_argument('--lag-minutes', type=float, default=2, help='samples younger than this wait for the next batch')
+    command.add_argument('--lookback-hours', type=float, default=24, help='range of the first batch without a saved state')
+    command.add_argument('--once', action='store_true', help='process a single micro-batch and exit')
+    command.add_argument('--dry-run', action='store_true', help='check the configuration without connecting')
+    command.set_defaults(function=serve_command)
+    return parser
+
+
+def main(argv: list = None) -> int:
+    args = build_parser().parse_args(argv)
+    setup_logging()
+    try:
+        return args.function(args)
+    finally:
+        if args.profile_import:
+            print(import_report(), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import linecache
+import sys
+
+
+def get_exception() -> str:
+    """
+    A function which returns Exception details in the format
+    'Failure at {file_name}: {line_number} [{line}] - {exception_message}'
+
+    Args:
+
+    Returns: Formatted string with exception details
+
+    """
+    exc_type, exc_obj, tb = sys.exc_info()
+    f = tb.tb_frame
+    line_no = tb.tb_lineno
+    file_name = f.f_code.co_filename
+    linecache.checkcache(file_name)
+    line = linecache.getline(file_name, line_no, f.f_globals)
+    return f'Failure at {file_name}: {line_no} [{line.strip()}] - {exc_obj}'
@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+from datetime import datetime
+import logging
+import os
+import pickle
+import uuid
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+from BTFeTL import (EVENT_AGGREGATES, RESULT_COLUMNS, as_float, collect_results, combine_pumps, event_metrics,
+                    finalize_results, get_exception, tank_capacity)
+from kernels import event_starts, forward_fill, interpolate_forward
+from tank_registry import Tank_Config, get_registry
+
+
+STREAM_METRICS = ['Level', 'Temp.', 'Density', 'Kilos', 'Disc_Output']
+
+# Rows per chunk of chunked_transformation, about 2 weeks of 2-minute samples
+CHUNK_ROWS = 10000
+
+# Rows a column waits for its next sample before its gap is filled with its last value, a day of 2-minute samples.
+# Bounds the rows kept between updates when a sensor stops reporting
+MAX_GAP_ROWS = 720
+
+# Partial aggregates of an open event: means are kept as sums and counts so that chunks can be merged
+PARTIAL_AGGREGATES = {}
+for name, (column, function) in EVENT_AGGREGATES.items():
+    if function == 'mean':
+        PARTIAL_AGGREGATES[f'{name} sum'] = (column, 'sum')
+        PARTIAL_AGGREGATES[f'{name} count'] = (column, 'count')
+    else:
+        PARTIAL_AGGREGATES[name] = (column, function)
+MERGE_FUNCTIONS = {name: 'sum' if function in ('sum', 'count') else function
+                   for name, (column, function) in PARTIAL_AGGREGATES.items()}
+
+
+def tank_samples(raw_data: pd.DataFrame, tank, extra_pumps) -> pd.DataFrame:
+    """
+    Numeric columns of a tank, as they are carried between chunks
+
+    Args:
+    :raw_data (pd.DataFrame): wide frame produced by the extraction
+    :tank: tank number as in 'Tags Mapping.csv'
+    :extra_pumps (str): comma separated pump columns of the extra unload spots, NaN if there are none
+
+    Returns: Level, Temp., Density, Kilos, Disc_Output, the pump columns of the tank and Time
+    """
+    config = Tank_Config(tank, extra_pumps)
+    required = [config.columns[metric] for metric in STREAM_METRICS[:4] + ['GCAS', 'PumpRunning']] + ['Time']
+    missing = [column for column in required if column not in raw_data.columns]
+    if missing:
+        raise KeyError(f'{missing} not in index')
+
+    samples = pd.DataFrame({metric: as_float(raw_data[config.columns[metric]]) for metric in STREAM_METRICS[:4]})
+    if config.columns['Disc_Output'] in raw_data.columns:
+        samples['Disc_Output'] = as_float(raw_data[config.columns['Disc_Output']])
+    else:
+        samples['Disc_Output'] = np.nan
+    for pump in config.pump_group:
+        if pump in raw_data.columns:
+            samples[pump] = as_float(raw_data[pump])
+    samples['Time'] = pd.to_datetime(raw_data['Time'])
+    return samples.sort_values('Time', kind='stable').reset_index(drop=True)
+
+
+def last_valid(valid: np.ndarray) -> np.ndarray:
+    """
+    Index of the last True of every column of a 2D boolean array, -1 for columns without any
+    """
+    rows = valid.shape[0]
+    return np.where(valid.any(axis=0), rows - 1 - np.argmax(valid[::-1], axis=0), -1)
+
+
+class Event_Stream:
+    """
+    Incremental version of the per-tank transformation.
+    Each call to update takes the samples received since the previous one and returns the events that
+    closed in the meantime; per tank, the stream keeps:
+    - the samples that cannot be interpolated yet because a later valid value is missing,
+      plus the last valid sample of every column as interpolation and pump anchor.
+      A column silent for more than max_gap rows stops holding the others back: its gap is filled with
+      its last value, as data_transformation does for trailing gaps, so at most max_gap rows wait.
+      If the sensor reports again, the rows already settled keep that value where data_transformation
+      interpolates up to the new sample; each such fill is logged and counted as stream_forced_fills
+    - the open Event_Id and the partial aggregates of its unloading and discharge parts
+    - a running mean of UsableTankVolume, used as tank size when no size is given
+    so events spanning several chunks (e.g. across midnight) come out whole instead of cut in two.
+    watermark is left to the caller, e.g. the end of the last extraction fed to the stream.
+    """
+    tanks = None
+    watermark = None
+    max_gap = MAX_GAP_ROWS
+
+    def __init__(self, max_gap: int = MAX_GAP_ROWS):
+        self.tanks = {}
+        self.max_gap = max_gap
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Stream saved by save, or a new one if path does not exist
+        """
+        if not os.path.exists(path):
+            return cls()
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, path: str):
+        """
+        Writes the stream atomically, so an interrupted run keeps the previous state
+        """
+        temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+    def update(self, raw_data: pd.DataFrame, tags: pd.DataFrame, final: bool = False, sizes: dict = None) -> pd.DataFrame:
+        """
+        Feeds a chunk of samples to every tank of 'Tags Mapping.csv'.
+        Samples older than the last one already received for a tank are ignored, so chunks may overlap.
+
+        Args:
+        :raw_data (pd.DataFrame): wide frame produced by the extraction
+        :tags (pd.DataFrame): contents of 'Tags Mapping.csv'
+        :final (bool): end of the stream, open events are closed and the tank states are cleared
+        :sizes (dict): tank size to use instead of the running UsableTankVolume mean, by tank
+
+        Returns: the events closed by this chunk, with the RESULT_COLUMNS columns
+        """
+        frames = []
+        for index, row in tags.iterrows():
+            tank = row['Tank']
+            try:
+                samples = tank_samples(raw_data, tank, row['Extra Pumps'])
+                size = sizes.get(tank) if sizes is not None else None
+                frames.append(self.update_tank(tank, row['Extra Pumps'], samples, final, size, row.get('Capacity')))
+            except Exception as e:
+                logging.exception(f'Tank {tank} Exception Occured!\n')
+                logging.exception(get_exception())
+        return collect_results(frames)
+
+    def flush(self, tags: pd.DataFrame, sizes: dict = None) -> pd.DataFrame:
+        """
+        Closes the open events of every tank, see update
+        """
+        frames = []
+        for index, row in tags.iterrows():
+            tank = row['Tank']
+            if tank not in self.tanks:
+                continue
+            try:
+                samples = self.tanks[tank]['pending'].iloc[:0]
+                size = sizes.get(tank) if sizes is not None else None
+                frames.append(self.update_tank(tank, row['Extra Pumps'], samples, True, size, row.get('Capacity')))
+            except Exception as e:
+                logging.exception(f'Tank {tank} Exception Occured!\n')
+                logging.exception(get_exception())
+        return collect_results(frames)
+
+    def update_tank(self, tank, extra_pumps, samples: pd.DataFrame, final: bool = False, size=None,
+                    capacity: float = None) -> pd.DataFrame:
+        """
+        Feeds the samples of one tank returned by tank_samples, capacity is the one of the tank registry
+
+        Returns: the closed events of the tank
+        """
+        closed, running_size = self.advance_tank(tank, extra_pumps, samples, final)
+        if size is None:
+            size = running_size
+        if closed is None or len(closed) == 0:
+            return pd.DataFrame(columns=RESULT_COLUMNS)
+        return close_events(closed, tank, size, capacity)
+
+    def advance_tank(self, tank, extra_pumps, samples: pd.DataFrame, final: bool = False) -> tuple:
+        """
+        Feeds the samples of one tank without computing the event metrics
+
+        Returns: (partial aggregates of the closed events or None, running UsableTankVolume mean of the tank)
+        """
+        state = self.tanks.get(tank)
+        if state is None:
+            state = {'pending': None, 'done': 0, 'event_id': None, 'open': None, 'last_time': None,
+                     'volume_sum': 0.0, 'volume_count': 0, 'forced': set()}
+            self.tanks[tank] = state
+
+        if state['last_time'] is not None:
+            samples = samples[samples['Time'] > state['last_time']]
+        if len(samples) > 0:
+            state['last_time'] = samples['Time'].iloc[-1]
+        frame = samples if state['pending'] is None else pd.concat([state['pending'], samples], ignore_index=True)
+        frame = frame.reset_index(drop=True)
+        rows = len(frame)
+        done = state['done']
+
+        raw = frame[STREAM_METRICS].to_numpy(dtype=np.float64, na_value=np.nan)
+        valid = ~np.isnan(raw)
+        if final:
+            settled = rows - 1
+        else:
+            # Trailing gaps are interpolated once a later sample arrives, columns never seen are left as is
+            # and columns silent for more than max_gap rows are filled with their last value
+            last = last_valid(valid)
+            waiting = (last >= 0) & (rows - 1 - last <= self.max_gap)
+            settled = last[waiting].min() if waiting.any() else rows - 1
+
+            # Reported once per outage, as the filled rows differ from data_transformation if the sensor comes back
+            forced = {STREAM_METRICS[index] for index in np.flatnonzero((last >= 0) & ~waiting)}
+            for metric in sorted(forced - state.get('forced', set())):
+                instrumentation.count('stream_forced_fills', tank=tank, metric=metric)
+                logging.warning(f'Tank {tank}: no {metric} sample for more than {self.max_gap} rows, '
+                                f'its gap is filled with its last value instead of being interpolated')
+            state['forced'] = forced
+
+        partials = None
+        if settled >= done:
+            partials = self.aggregate_rows(frame, tank, extra_pumps, done, settled, state)
+        if state['open'] is not None:
+            partials = state['open'] if partials is None else pd.concat([state['open'], partials])
+            partials = partials.groupby(level=['PumpRunning', 'Event_Id'], sort=True).agg(MERGE_FUNCTIONS)
+
+        # Keeping the last valid sample of every column before the settled ones as anchors
+        if settled >= 0 and not final:
+            pump_columns = [column for column in frame.columns if column not in STREAM_METRICS + ['Time']]
+            anchors = frame[STREAM_METRICS + pump_columns].iloc[:settled + 1].notna().to_numpy()
+            first = last_valid(anchors)
+            carried = first[first >= 0].min() if (first >= 0).any() else settled
+            carried = max(carried, settled + 1 - self.max_gap, 0)
+            pending = frame.iloc[carried:].reset_index(drop=True)
+            # Anchors older than the kept rows are replaced by the value their column was filled with on the first kept row
+            moved = np.flatnonzero((first >= 0) & (first < carried))
+            if len(moved) > 0:
+                metrics = moved[moved < len(STREAM_METRICS)]
+                pending.loc[0, [STREAM_METRICS[index] for index in metrics]] = interpolate_forward(raw[:, metrics])[carried]
+                for index in moved[moved >= len(STREAM_METRICS)]:
+                    column = pump_columns[index - len(STREAM_METRICS)]
+                    pending.loc[0, column] = frame[column].iloc[first[index]]
+            state['pending'] = pending
+            state['done'] = settled - carried + 1
+        elif not final:
+            state['pending'] = frame
+
+        if partials is None or len(partials) == 0:
+            closed = partials
+            state['open'] = None
+        elif final:
+            closed = partials
+        else:
+            is_open = partials.index.get_level_values('Event_Id') == state['event_id']
+            closed = partials[~is_open]
+            state['open'] = partials[is_open]
+
+        size = state['volume_sum'] / state['volume_count'] if state['volume_count'] > 0 else np.nan
+        if final:
+            del self.tanks[tank]
+        return closed, size
+
+    def aggregate_rows(self, frame: pd.DataFrame, tank, extra_pumps, done: int, settled: int, state: dict) -> pd.DataFrame:
+        """
+        Prepares rows done..settled of frame as transform_tank does and returns their partial aggregates,
+        the rows before done have already been aggregated and only serve as context
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Rows after settled are only there as the next valid values of the interpolation
+            values = interpolate_forward(frame[STREAM_METRICS].to_numpy(dtype=np.float64, na_value=np.nan))[:settled + 1]
+            pump = combine_pumps(frame, tank, extra_pumps).to_numpy(dtype=np.float64, na_value=np.nan)
+            pump = forward_fill(pump.reshape(-1, 1))[:settled + 1, 0]
+
+            one_percent = values[:, 3] / values[:, 0]
+            usable_volume = one_percent * 100
+
+        rows = slice(done, settled + 1)
+        time = pd.DatetimeIndex(frame['Time'].iloc[:settled + 1])
+        event_start = event_starts(pump)[rows]
+        event_ids = time.take(event_start)
+        if state['event_id'] is not None:
+            # Events started on the rows already aggregated are the open event, carried into this chunk
+            event_ids = event_ids.where(event_start >= done, state['event_id'])
+
+        main_df = pd.DataFrame({'PumpRunning': pump[rows],
+                                'Event_Id': event_ids.to_numpy(),
+                                'Time': time[rows],
+                                'Level': values[rows, 0],
+                                'Temp.': values[rows, 1],
+                                'Density': values[rows, 2],
+                                'Disc_Output': values[rows, 4],
+                                'OnePercentLITDelta': one_percent[rows],
+                                'UsableTankVolume': usable_volume[rows]})
+        state['event_id'] = main_df['Event_Id'].iloc[-1]
+        volume = usable_volume[rows]
+        state['volume_sum'] += volume[~np.isnan(volume)].sum()
+        state['volume_count'] += np.count_nonzero(~np.isnan(volume))
+
+        main_df = main_df[main_df['PumpRunning'].isin([0, 1])]
+        return main_df.groupby(['PumpRunning', 'Event_Id'], sort=True).agg(**PARTIAL_AGGREGATES)
+
+
+def close_events(partials: pd.DataFrame, tank, size, capacity: float = None) -> pd.DataFrame:
+    """
+    Turns the partial aggregates of closed events into the rows returned by transform_tank
+
+    Args:
+    :partials (pd.DataFrame): partial aggregates indexed by (PumpRunning, Event_Id)
+    :tank: tank number as in 'Tags Mapping.csv'
+    :size: tank size used for 'Event_rate(Appr.)'
+    :capacity (float): capacity from the tank registry, see BTFeTL.tank_capacity
+
+    Returns: discharge events followed by unloading events, with the RESULT_COLUMNS columns
+    """
+    events = pd.DataFrame(index=partials.index)
+    for name, (column, function) in EVENT_AGGREGATES.items():
+        if function == 'mean':
+            events[name] = partials[f'{name} sum'] / partials[f'{name} count']
+        else:
+            events[name] = partials[name]
+    events = event_metrics(events.reset_index(), size, tank_capacity(tank, capacity))
+    events['Tank'] = tank
+    return events[RESULT_COLUMNS]
+
+
+def incremental_transformation(raw_data: pd.DataFrame, state_path: str = './data/Transform State.pkl',
+                               output_path: str = None, final: bool = False, writer=None) -> pd.DataFrame:
+    """
+    Incremental counterpart of data_transformation: feeds raw_data to the Event_Stream saved at state_path
+    and appends the events it closes to output_path ('./data/Daily Results {today}.csv' by default).
+    Meant to run every few minutes on the samples extracted since the previous run.
+
+    Args:
+    :raw_data (pd.DataFrame): wide frame produced by the extraction
+    :state_path (str): file the per-tank state is kept in between runs
+    :output_path (str):
+    :final (bool): closes the open events and clears the state
+    :writer: output stage from output_writers, make_writer(path=output_path) by default
+
+    Returns: the results dataframe
+    """
+    pd.options.mode.chained_assignment = None
+
+    logging.info('----------------------- STARTED BTF INCREMENTAL TRANSFORMATION ----------------------------\n')
+    start_time = datetime.now()
+    tags = get_registry().tags_mapping()
+
+    stream = Event_Stream.load(state_path)
+    results_df = stream.update(raw_data, tags, final=final)
+    stream.save(state_path)
+    return finalize_results(results_df, start_time, output_path, append=True, writer=writer)
+
+
+def read_chunks(path: str, chunk_rows: int = CHUNK_ROWS):
+    """
+    Reads a raw data file saved by btf.py extract a few rows at a time, in file order
+
+    Args:
+    :path (str): .parquet file (read by row groups, needs pyarrow) or .csv file
+    :chunk_rows (int): rows per chunk
+
+    Returns: generator of wide frames with a Time column
+    """
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+    elif path.endswith('.csv'):
+        with pd.read_csv(path, chunksize=chunk_rows, parse_dates=['Time']) as reader:
+            yield from reader
+    else:
+        raise ValueError(f'{path}: chunked reading needs a .parquet or .csv file')
+
+
+def chunked_transformation(path: str, chunk_rows: int = CHUNK_ROWS, output_path: str = None, writer=None,
+                           max_gap: int = MAX_GAP_ROWS) -> pd.DataFrame:
+    """
+    Out-of-core counterpart of data_transformation, for raw data files too large to load at once (e.g. a year of backfill).
+    The file is fed to an Event_Stream chunk by chunk, which carries the interpolation and the open events across
+    chunk edges; only the aggregates of the events are kept, and at most max_gap rows per tank wait for a sensor
+    that stopped reporting, so peak memory depends on chunk_rows and max_gap, not on the file.
+    The metrics of the events are computed at the end, with the UsableTankVolume mean of the whole file as tank size,
+    so the results match data_transformation on the same data, unless a sensor is silent for more than max_gap rows
+    and then reports again: the stream holds its last value over most of the gap where data_transformation
+    interpolates, see Event_Stream. Raise max_gap above the longest outage to keep them identical.
+
+    Args:
+    :path (str): raw data file sorted by Time, see read_chunks
+    :chunk_rows (int): rows per chunk
+    :output_path (str):
+    :writer: output stage from output_writers, make_writer(path=output_path) by default
+    :max_gap (int): rows a tank waits for a silent sensor, see Event_Stream
+
+    Returns: the results dataframe
+    """
+    pd.options.mode.chained_assignment = None
+
+    logging.info('----------------------- STARTED BTF CHUNKED TRANSFORMATION ----------------------------\n')
+    start_time = datetime.now()
+    configs = list(get_registry().tanks.values())
+
+    stream = Event_Stream(max_gap)
+    partials = {config.tank: [] for config in configs}
+    sizes = {}
+    last_time = None
+    for chunk in read_chunks(path, chunk_rows):
+        time = pd.to_datetime(chunk['Time'])
+        if last_time is not None and time.min() < last_time:
+            logging.warning(f'{path}: samples before {last_time} found after it are ignored, the file must be sorted by Time')
+        last_time = time.max() if last_time is None else max(last_time, time.max())
+        with instrumentation.stage('transform_chunk'):
+            for config in configs:
+                try:
+                    samples = tank_samples(chunk, config.tank, config.extra_pumps)
+                    closed, sizes[config.tank] = stream.advance_tank(config.tank, config.extra_pumps, samples)
+                    if closed is not None and len(closed) > 0:
+                        partials[config.tank].append(closed)
+                except Exception as e:
+                    logging.exception(f'Tank {config.tank} Exception Occured!\n')
+                    logging.exception(get_exception())
+        instrumentation.count('rows_transformed', len(chunk))
+        instrumentation.count('chunks_transformed')
+
+    frames = []
+    for config in configs:
+        tank = config.tank
+        try:
+            if tank in stream.tanks:
+                # Closing the event still open at the end of the file
+                samples = stream.tanks[tank]['pending'].iloc[:0]
+                closed, sizes[tank] = stream.advance_tank(tank, config.extra_pumps, samples, final=True)
+                if closed is not None and len(closed) > 0:
+                    partials[tank].append(closed)
+            if len(partials[tank]) == 0:
+                continue
+            closed = pd.concat(partials[tank]).groupby(level=['PumpRunning', 'Event_Id'], sort=True).agg(MERGE_FUNCTIONS)
+            frames.append(close_events(closed, tank, sizes[tank], config.capacity))
+            logging.info(f'Tank {tank} Done\n')
+        except Exception as e:
+            logging.exception(f'Tank {tank} Exception Occured!\n')
+            logging.exception(get_exception())
+
+    results_df = collect_results(frames)
+    return finalize_results(results_df, start_time, output_path, writer=writer)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Connection to the Historian REST API. Only needs requests, so a token check does not load pandas.
+"""
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import instrumentation
+
+
+logger = logging.getLogger()
+
+# Responses worth retrying with backoff, 401 is handled separately by refreshing the token
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class Historian_Connection:
+    """
+    Creating a class to store Historian connection information as well as the access token.
+    Refactored as a class to avoid using global variables and to keep related code together.
+    Can be reused as required.
+    """
+    username = None
+    password = None
+    server = None
+    url = None
+    client_id = None
+    client_secret = None
+    access_token = None
+    base_url = None
+    timeout = None
+    session = None
+    max_retries = None
+    backoff = None
+    token_expiry = None
+    refresh_margin = None
+
+    def __init__(self, username: str, password: str, server: str, url:str, client_id: str, client_secret: str,
+                 base_url: str = None, timeout: float = 60, pool_size: int = 10, max_retries: int = 5, backoff: float = 0.5,
+                 refresh_margin: float = 120):
+        """
+        Initializes a Historian_Connection object with required connecion details.
+        A single keep-alive session is shared by every request made through the connection,
+        so concurrent extractions reuse the same pool of up to pool_size connections.
+        The token is renewed refresh_margin seconds before it expires, when the server gives its lifetime.
+        """
+        # Seperating server field from url to make the function generic
+        self.username = username
+        self.password = password
+        self.server = server
+        self.url = url.format(server)
+        self.client_id = client_id
+        self.client_secret = client_secret
+        # base_url can point at a local stub server instead of the production REST API
+        self.base_url = base_url if base_url else f'https://{server}:443'
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.refresh_margin = refresh_margin
+        self._token_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get_token(self) -> bool:
+        """
+        Single call to get Historian access token with resource owner credentails
+        in the body and client credentials as the basic auth header.
+
+        Returns:
+        :access_token (obj):
+
+        """
+        data = {'grant_type': 'password', 'username': self.username, 'password': self.password}
+        try:
+            with instrumentation.stage('token'):
+                response = self.session.post(self.url, data=data, allow_redirects=False, auth=(self.client_id, self.client_secret),
+                                             timeout=self.timeout)
+            response.raise_for_status()
+            access_token = response.json()
+            # time.monotonic, so clock changes do not affect the expiry
+            expires_in = access_token.get('expires_in')
+            self.token_expiry = time.monotonic() + float(expires_in) if expires_in else None
+            self.access_token = access_token
+            logger.info('Successfully set Access Token\n')
+            return False
+        except Exception as e:
+            logger.error('Unable to set Access Token\n')
+            logger.error(e)
+            return True
+
+    def refresh_token(self, stale_token: dict) -> bool:
+        """
+        Calls get_token again after the server rejected stale_token.
+        Safe to call from several threads: only the first caller refreshes, the others reuse its token.
+
+        Returns:
+        :flag (bool): True if the token could not be refreshed
+        """
+        with self._token_lock:
+            if self.access_token is not stale_token:
+                return False
+            logger.info('Access Token expired, requesting a new one')
+            return self.get_token()
+
+    def token_expiring(self) -> bool:
+        """
+        True when the token expires within refresh_margin seconds
+        """
+        return self.token_expiry is not None and time.monotonic() >= self.token_expiry - self.refresh_margin
+
+    def ensure_token(self) -> bool:
+        """
+        Renews the token before it expires, so long-running processes never send an expired one
+
+        Returns:
+        :flag (bool): True if the token had to be renewed and could not be
+        """
+        token = self.access_token
+        if token is not None and not self.token_expiring():
+            return False
+        with self._token_lock:
+            if self.access_token is not token:
+                return False
+            logger.info('Access Token about to expire, requesting a new one')
+            return self.get_token()
+
+    def backoff_delay(self, attempt: int) -> float:
+        """
+        Exponential backoff with full jitter for the given retry attempt
+        """
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+    def get(self, url: str, **labels) -> requests.Response:
+        """
+        Issues a GET against the Historian REST API through the pooled session,
+        using the current access token and the connection timeout.
+        429/5xx responses and connection errors are retried with jittered backoff,
+        a 401 triggers a token refresh before retrying.
+
+        Params:
+        :url (str):
+        :labels: instrumentation labels of the request, e.g. tank=tank
+
+        Returns:
+        :response (requests.Response):
+        """
+        attempt = 0
+        self.ensure_token()
+        while True:
+            token = self.access_token
+            headers = {'Authorization': f"Bearer {token['access_token']}"}
+            try:
+                with instrumentation.stage('http_request', **labels):
+                    response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                logger.info(f'Request failed ({e}), retrying')
+                response = None
+            if response is not None:
+                instrumentation.count('http_responses', status=response.status_code, **labels)
+                instrumentation.count('http_bytes', len(response.content), **labels)
+
+            if attempt >= self.max_retries or (response is not None and response.status_code not in RETRY_STATUS_CODES + (401,)):
+                return response
+            if response is not None and response.status_code == 401:
+                if self.refresh_token(token):
+                    return response
+            else:
+                time.sleep(self.backoff_delay(attempt))
+            attempt += 1
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+from datetime import datetime
+import cProfile
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+# resource does not exist on Windows, peak memory is then only known while tracemalloc runs
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class Pipeline_Metrics:
+    """
+    Thread-safe registry of the stage timings and counters of one run.
+    Stages and counters are keyed by name and labels (e.g. tank or tag), so a nightly run can be broken down
+    by stage and by tank. Timings recorded inside process pool workers stay in the workers.
+    """
+    timers = None
+    counters = None
+    started = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timers = {}
+            self.counters = {}
+            self.started = datetime.now()
+
+    def add_time(self, name: str, seconds: float, labels: dict):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            timer = self.timers.setdefault(key, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            timer['calls'] += 1
+            timer['seconds'] += seconds
+            timer['max_seconds'] = max(timer['max_seconds'], seconds)
+
+    def add_count(self, name: str, value, labels: dict):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def snapshot(self) -> dict:
+        """
+        Returns: the timers, counters and peak memory as plain python objects
+        """
+        with self._lock:
+            timers = [dict(stage=name, labels=dict(labels), **timer) for (name, labels), timer in self.timers.items()]
+            counters = [dict(counter=name, labels=dict(labels), value=value) for (name, labels), value in self.counters.items()]
+        return {'started': self.started.isoformat(), 'seconds': (datetime.now() - self.started).total_seconds(),
+                'peak_memory_bytes': peak_memory(), 'stages': timers, 'counters': counters}
+
+
+METRICS = Pipeline_Metrics()
+
+
+def peak_memory() -> int:
+    """
+    Peak resident memory of the process in bytes, or the tracemalloc peak when resource is not available
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[1]
+    return 0
+
+
+@contextmanager
+def stage(name: str, **labels):
+    """
+    Times the enclosed block as one call of stage name, e.g. with stage('interpolate', tank='12'):
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        METRICS.add_time(name, time.perf_counter() - start, labels)
+
+
+def count(name: str, value=1, **labels):
+    """
+    Adds value to counter name, e.g. count('http_bytes', len(response.content), tag=tag_name)
+    """
+    METRICS.add_count(name, value, labels)
+
+
+@contextmanager
+def profile(name: str, **labels):
+    """
+    Runs the enclosed block under cProfile and tracemalloc when the profile_dir environment variable is set,
+    writing {profile_dir}/{name}-{labels}.prof and recording the tracemalloc peak as counter {name}_peak_bytes.
+    Does nothing otherwise, as both slow the profiled code down noticeably.
+    """
+    profile_dir = os.getenv('profile_dir')
+    if not profile_dir:
+        yield
+        return
+
+    os.makedirs(profile_dir, exist_ok=True)
+    suffix = '-'.join(str(value) for key, value in sorted(labels.items()))
+    path = os.path.join(profile_dir, f'{name}-{suffix}.prof' if suffix else f'{name}.prof')
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        count(f'{name}_peak_bytes', tracemalloc.get_traced_memory()[1], **labels)
+        if not tracing:
+            tracemalloc.stop()
+        logging.info(f'Profile written to {path}')
+
+
+def prometheus_text(snapshot: dict) -> str:
+    """
+    Prometheus text exposition of a snapshot, one btf_stage_* series per stage and btf_*_total per counter
+    """
+    def escape(value) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def series(metric, labels, value):
+        if labels:
+            label_text = ','.join(f'{key}="{escape(label)}"' for key, label in labels.items())
+            return f'{metric}{{{label_text}}} {value}'
+        return f'{metric} {value}'
+
+    lines = ['# TYPE btf_stage_seconds_total counter', '# TYPE btf_stage_calls_total counter',
+             '# TYPE btf_stage_seconds_max gauge']
+    for timer in snapshot['stages']:
+        labels = dict(stage=timer['stage'], **timer['labels'])
+        lines.append(series('btf_stage_seconds_total', labels, timer['seconds']))
+        lines.append(series('btf_stage_calls_total', labels, timer['calls']))
+        lines.append(series('btf_stage_seconds_max', labels, timer['max_seconds']))
+    for counter in snapshot['counters']:
+        lines.append(series(f"btf_{counter['counter']}_total", counter['labels'], counter['value']))
+    lines.append('# TYPE btf_peak_memory_bytes gauge')
+    lines.append(series('btf_peak_memory_bytes', {}, snapshot['peak_memory_bytes']))
+    lines.append(series('btf_run_seconds', {}, snapshot['seconds']))
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(path: str):
+    """
+    Writes the metrics of the run to path, as Prometheus text for a .prom file and JSON otherwise
+    """
+    snapshot = METRICS.snapshot()
+    with open(path, 'w') as f:
+        if path.endswith('.prom'):
+            f.write(prometheus_text(snapshot))
+        else:
+            json.dump(snapshot, f, indent=2)
+    logging.info(f'Metrics written to {path}')
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-row kernels of the transformation, working on contiguous NumPy arrays instead of DataFrame columns.
+prepare_tank computes the derived series of a tank in a single loop per column when numba is installed,
+and with the vectorized NumPy functions of this module otherwise; both give the same results bit for bit.
+"""
+import importlib.util
+import logging
+import os
+
+import numpy as np
+
+# numba is optional and only imported on the first call of prepare_tank, it takes longer to import than pandas
+NUMBA_AVAILABLE = importlib.util.find_spec('numba') is not None
+KERNELS = ('numba', 'numpy')
+
+# prepare_tank_loop compiled by numba, see compiled_kernel
+_compiled_kernel = None
+
+
+def interpolate_forward(values: np.ndarray) -> np.ndarray:
+    """
+    Column-wise linear interpolation of a 2D array, equivalent to
+    DataFrame.interpolate(method='linear', limit_direction='forward') and like it based on np.interp:
+    leading NaNs are kept and trailing NaNs take the last valid value.
+
+    Args:
+    :values (np.ndarray): float array of shape (rows, columns)
+
+    Returns: interpolated copy of values
+    """
+    result = values.copy()
+    index = np.arange(values.shape[0])
+    for column in range(values.shape[1]):
+        missing = np.isnan(values[:, column])
+        valid = np.flatnonzero(~missing)
+        if len(valid) == 0:
+            continue
+        # Only the gaps after the first valid value, np.interp gives the last value to trailing ones
+        missing[:valid[0]] = False
+        result[missing, column] = np.interp(index[missing], valid, values[valid, column])
+    return result
+
+
+def forward_fill(values: np.ndarray) -> np.ndarray:
+    """
+    Column-wise ffill of a 2D float array
+    """
+    index = np.arange(values.shape[0]).reshape(-1, 1)
+    previous = np.maximum.accumulate(np.where(~np.isnan(values), index, 0), axis=0)
+    return np.take_along_axis(values, previous, axis=0)
+
+
+def level_roc(level: np.ndarray, time: np.ndarray) -> np.ndarray:
+    """
+    Level rate of change as a time derivative, in hundredths of a percent per minute,
+    so it stays correct when rows are not evenly spaced
+
+    Args:
+    :level (np.ndarray): float array of shape (rows,) or (rows, tanks)
+    :time (np.ndarray): int64 nanosecond times of the rows
+
+    Returns: array shaped as level, NaN on the first row
+    """
+    minutes = np.diff(time) / 6e10
+    if level.ndim > 1:
+        minutes = minutes.reshape(-1, 1)
+    roc = np.full_like(level, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        roc[1:] = np.where(minutes > 0, (level[1:] - level[:-1]) * 100 / minutes, np.nan)
+    return roc
+
+
+def event_starts(pump: np.ndarray) -> np.ndarray:
+    """
+    Row position of the start of the event every row belongs to: a new event starts whenever
+    the pump switches on, and on the first record
+
+    Args:
+    :pump (np.ndarray): forward filled pump states, of shape (rows,) or (rows, tanks)
+
+    Returns: int array shaped as pump
+    """
+    starts = np.zeros(pump.shape, dtype=bool)
+    starts[0] = True
+    starts[1:] = (pump[1:] - pump[:-1]) == 1
+    index = np.arange(len(pump)).reshape((-1,) + (1,) * (pump.ndim - 1))
+    return np.maximum.accumulate(np.where(starts, index, 0), axis=0)
+
+
+def prepare_tank_loop(values: np.ndarray, pump: np.ndarray, interpolated: np.ndarray, filled: np.ndarray,
+                      event_start: np.ndarray, one_percent: np.ndarray):
+    """
+    Loop version of prepare_tank_numpy, written for numba: fills the output arrays in one pass per column.
+    Same arithmetic as interpolate_forward (and np.interp), so the results are identical.
+    interpolated must be a copy of values.
+    """
+    rows, columns = values.shape
+    for column in range(columns):
+        previous = -1
+        for row in range(rows):
+            value = values[row, column]
+            if np.isnan(value):
+                continue
+            if previous >= 0 and row - previous > 1:
+                left = values[previous, column]
+                slope = (value - left) / (row - previous)
+                for gap in range(previous + 1, row):
+                    interpolated[gap, column] = slope * (gap - previous) + left
+            previous = row
+        # Trailing NaNs take the last valid value, leading NaNs are kept
+        if previous >= 0:
+            for gap in range(previous + 1, rows):
+                interpolated[gap, column] = values[previous, column]
+
+    state = np.nan
+    start = 0
+    for row in range(rows):
+        if not np.isnan(pump[row]):
+            state = pump[row]
+        if row > 0 and state - filled[row - 1] == 1:
+            start = row
+        filled[row] = state
+        event_start[row] = start
+        one_percent[row] = interpolated[row, 3] / interpolated[row, 0]
+
+
+def compiled_kernel():
+    """
+    prepare_tank_loop compiled by numba on first use, cached on disk next to this module
+    """
+    global _compiled_kernel
+    if _compiled_kernel is None:
+        import numba
+
+        # error_model='numpy' makes divisions by zero return inf/NaN as NumPy does, instead of raising
+        _compiled_kernel = numba.njit(cache=True, error_model='numpy')(prepare_tank_loop)
+    return _compiled_kernel
+
+
+def prepare_tank_numpy(values: np.ndarray, pump: np.ndarray) -> tuple:
+    """
+    NumPy version of prepare_tank, see there
+    """
+    interpolated = interpolate_forward(values)
+    filled = forward_fill(pump.reshape(-1, 1))[:, 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        one_percent = interpolated[:, 3] / interpolated[:, 0]
+    return interpolated, filled, event_starts(filled), one_percent
+
+
+def prepare_tank(values: np.ndarray, pump: np.ndarray, time: np.ndarray, kernel: str = None) -> tuple:
+    """
+    Every derived series of one tank, on arrays instead of the columns of a DataFrame:
+    forward linear interpolation of the metrics and of the Level rate of change, forward filled pump state,
+    event starts and OnePercentLITDelta (Kilos / Level, UsableTankVolume is 100 times it)
+
+    Args:
+    :values (np.ndarray): float array of shape (rows, 5), Level, Temp., Density, Kilos and Disc_Output with NaN gaps
+    :pump (np.ndarray): float array of shape (rows,), the PumpRunning state, NaN when unknown
+    :time (np.ndarray): int64 nanosecond times of the rows
+    :kernel (str): 'numba' or 'numpy'. Defaults to the transform_kernel environment variable,
+                   or numba when it is installed
+
+    Returns: (interpolated values, Level ROC, pump state, row position of the start of each row's event, OnePercentLITDelta)
+    """
+    if kernel is None:
+        kernel = os.getenv('transform_kernel', 'numba' if NUMBA_AVAILABLE else 'numpy')
+    if kernel not in KERNELS:
+        raise ValueError(f'Unknown kernel {kernel}, expected one of {KERNELS}')
+    if kernel == 'numba' and not NUMBA_AVAILABLE:
+        logging.warning('numba is not installed, using the NumPy kernel')
+        kernel = 'numpy'
+
+    # Level ROC is computed on the raw levels, the first record takes the value of the second
+    roc = level_roc(values[:, 0], time)
+    if len(roc) > 1:
+        roc[0] = roc[1]
+    values = np.column_stack([values, roc])
+
+    if kernel == 'numba':
+        interpolated = values.copy()
+        filled = np.empty(len(pump))
+        event_start = np.empty(len(pump), dtype=np.int64)
+        one_percent = np.empty(len(pump))
+        compiled_kernel()(values, np.ascontiguousarray(pump, dtype=np.float64), interpolated, filled, event_start, one_percent)
+    else:
+        interpolated, filled, event_start, one_percent = prepare_tank_numpy(values, pump)
+    return interpolated[:, :5], interpolated[:, 5], filled, event_start, one_percent
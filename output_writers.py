@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from datetime import date
+import glob
+import importlib.util
+import logging
+import os
+import shutil
+import uuid
+
+import pandas as pd
+
+# The Parquet writer needs pyarrow, without it the results are written as csv.
+# It is imported by Parquet_Writer only, as it takes longer to import than the rest of the pipeline
+PYARROW_AVAILABLE = importlib.util.find_spec('pyarrow') is not None
+
+PARTITION_COLUMNS = ['Site', 'Plant Code', 'Date']
+
+
+class CSV_Writer:
+    """
+    Writes the results to a single csv file, './data/Daily Results {today}.csv' by default
+    """
+    path = None
+
+    def __init__(self, path: str = None):
+        self.path = path
+
+    def clear(self, start: date, end: date):
+        """
+        Removes the results file, so that a run writing it again in several appends does not add to a previous one.
+        The file belongs to the run, start and end are only used by Parquet_Writer.clear
+        """
+        path = self.path if self.path is not None else f'./data/Daily Results {date.today()}.csv'
+        if os.path.exists(path):
+            os.remove(path)
+
+    def write(self, results_df: pd.DataFrame, append: bool = False) -> str:
+        """
+        Args:
+        :results_df (pd.DataFrame):
+        :append (bool): append to the file instead of overwriting it
+
+        Returns: the path written to
+        """
+        path = self.path if self.path is not None else f'./data/Daily Results {date.today()}.csv'
+        if append and os.path.exists(path):
+            results_df.to_csv(path, index=False, mode='a', header=False)
+        else:
+            results_df.to_csv(path, index=False)
+        return path
+
+
+class Parquet_Writer:
+    """
+    Writes the results as a Parquet dataset partitioned by Site, Plant Code and event date,
+    i.e. {directory}/Site=Lima/Plant Code=1702/Date=2024-03-01/part-*.parquet.
+    Without append, the partitions present in the results are replaced; with append, a new file
+    is added to them, which is what incremental runs need.
+    Files are plain Parquet, readers can memory-map them (pyarrow.parquet.read_table(..., memory_map=True))
+    or open the whole directory as a hive partitioned dataset.
+    """
+    directory = None
+
+    def __init__(self, directory: str = './data/Daily Results'):
+        if not PYARROW_AVAILABLE:
+            raise ImportError('pyarrow is required to write Parquet results')
+        self.directory = directory
+
+    def clear(self, start: date, end: date):
+        """
+        Removes the Date partitions from start to end, see CSV_Writer.clear
+        """
+        for partition in glob.glob(os.path.join(glob.escape(self.directory), '*', '*', 'Date=*')):
+            partition_date = os.path.basename(partition)[len('Date='):]
+            if start.isoformat() <= partition_date <= end.isoformat():
+                shutil.rmtree(partition)
+
+    def write(self, results_df: pd.DataFrame, append: bool = False) -> str:
+        """
+        Args:
+        :results_df (pd.DataFrame): results with Site, Plant Code and Event_Id columns
+        :append (bool): add to the existing partitions instead of replacing them
+
+        Returns: the dataset directory
+        """
+        if len(results_df) == 0:
+            return self.directory
+        import pyarrow
+        import pyarrow.parquet as pq
+
+        results_df = results_df.assign(Date=pd.to_datetime(results_df['Event_Id']).dt.strftime('%Y-%m-%d'))
+        table = pyarrow.Table.from_pandas(results_df, preserve_index=False)
+        pq.write_to_dataset(table, self.directory, partition_cols=PARTITION_COLUMNS,
+                            basename_template=f'part-{uuid.uuid4().hex}-{{i}}.parquet',
+                            existing_data_behavior='overwrite_or_ignore' if append else 'delete_matching')
+        return self.directory
+
+
+def make_writer(output_format: str = None, path: str = None):
+    """
+    Output stage of data_transformation
+
+    Args:
+    :output_format (str): 'csv' or 'parquet', defaults to the output_format environment variable, or 'csv'
+    :path (str): csv file or Parquet directory, a '.csv' extension is dropped for Parquet
+
+    Returns: a CSV_Writer or Parquet_Writer
+    """
+    if output_format is None:
+        output_format = os.getenv('output_format', 'csv')
+    if output_format == 'parquet':
+        if not PYARROW_AVAILABLE:
+            logging.warning('pyarrow is not installed, writing the results as csv')
+            return CSV_Writer(path)
+        if path is None:
+            return Parquet_Writer()
+        return Parquet_Writer(os.path.splitext(path)[0] if path.endswith('.csv') else path)
+    if output_format != 'csv':
+        raise ValueError(f'Unknown output format {output_format}')
+    return CSV_Writer(path)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Data-quality gate applied to the samples of every tag as soon as they are decoded, before they are merged,
+interpolated and aggregated: out-of-range values, spikes and flatlines are rejected, long gaps are flagged,
+and the number of samples rejected per tag and reason is logged and counted.
+
+Rules are set per metric and can be overridden per metric or per Historian tag in './data/Quality Rules.csv':
+
+    Metric,Min,Max,Max Step,Flatline Samples,Max Gap
+    Level,0,100,15,,30min
+    Temp.,-20,150,,,
+    T12.LIT,0,95,,60,
+
+Empty cells leave the check off, a row replaces the default rule of its metric as a whole.
+"""
+import logging
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+from tank_registry import file_signature, read_table
+
+QUALITY_RULES_PATH = './data/Quality Rules.csv'
+
+# Historian quality codes: 0 bad, 1 uncertain, 2 not available, 3 good
+GOOD_QUALITY = (3,)
+# Samples kept by the "lab" retrieval mode, which has always only dropped bad ones
+LAB_QUALITY = (1, 2, 3)
+
+# Physical limits of the metrics, Level is a percentage of the tank height.
+# Spike, flatline and gap checks depend on the sensors and are off until configured
+DEFAULT_RULES = {'Level': {'Min': 0, 'Max': 100},
+                 'Density': {'Min': 0},
+                 'Kilos': {'Min': 0}}
+
+RULE_COLUMNS = ['Min', 'Max', 'Max Step', 'Flatline Samples', 'Max Gap']
+
+_rules = None
+_rules_lock = threading.Lock()
+
+
+class Quality_Rule:
+    """
+    Checks applied to the samples of one tag, None leaves a check off
+    """
+    min_value = None
+    max_value = None
+    max_step = None
+    flatline = None
+    max_gap = None
+
+    def __init__(self, min_value: float = None, max_value: float = None, max_step: float = None, flatline: int = None,
+                 max_gap=None):
+        """
+        Args:
+        :min_value (float): samples below are rejected
+        :max_value (float): samples above are rejected
+        :max_step (float): a sample further than this from both its neighbours, in opposite directions, is a spike
+        :flatline (int): in a run of identical values, the samples after the first flatline ones are rejected
+        :max_gap: longer gaps between samples are flagged in the logs, e.g. '30min'
+        """
+        self.min_value = min_value
+        self.max_value = max_value
+        self.max_step = max_step
+        self.flatline = flatline
+        self.max_gap = pd.Timedelta(max_gap) if max_gap is not None else None
+
+    @classmethod
+    def from_row(cls, row: dict):
+        """
+        Rule from a row of 'Quality Rules.csv', or of DEFAULT_RULES
+        """
+        def cell(name, convert):
+            value = row.get(name)
+            if value is None or pd.isna(value) or str(value).strip() == '':
+                return None
+            return convert(str(value).strip())
+
+        return cls(cell('Min', float), cell('Max', float), cell('Max Step', float), cell('Flatline Samples', int),
+                   cell('Max Gap', str))
+
+
+def load_rules(path: str = QUALITY_RULES_PATH) -> dict:
+    """
+    DEFAULT_RULES with the rows of path on top, path is optional
+
+    Returns: metric or tag name -> Quality_Rule
+    """
+    rows = {metric: dict(rule) for metric, rule in DEFAULT_RULES.items()}
+    if path is not None and os.path.exists(path):
+        table = read_table(path, 'Metric')
+        for index, row in table.iterrows():
+            rows[row['Metric']] = {column: row[column] for column in RULE_COLUMNS if column in table.columns}
+        logging.info(f'Loaded {len(table)} quality rules from {path}')
+    return {name: Quality_Rule.from_row(row) for name, row in rows.items()}
+
+
+def get_rules(path: str = QUALITY_RULES_PATH) -> dict:
+    """
+    Rules of the process, read again only when path changes, see tank_registry.get_registry
+    """
+    global _rules
+    signature = file_signature(path)
+    with _rules_lock:
+        if _rules is None or _rules[0] != signature:
+            _rules = (signature, load_rules(path))
+        return _rules[1]
+
+
+def accepted_quality(retrieval_mode: str) -> tuple:
+    """
+    Quality codes kept by clean_samples, the quality_codes environment variable (e.g. '3' or '1,3')
+    applies to every retrieval mode
+    """
+    codes = os.getenv('quality_codes')
+    if codes:
+        return tuple(int(code) for code in codes.split(','))
+    return LAB_QUALITY if retrieval_mode.lower() == 'lab' else GOOD_QUALITY
+
+
+def column_metric(column: str, tank) -> str:
+    """
+    Metric of an extracted column, the pump column is named after the tank alone
+    """
+    return 'PumpRunning' if column == f'{tank}' else column.split(' ')[0]
+
+
+def tag_rules(columns: dict, tank, rules: dict = None) -> dict:
+    """
+    Rule of every tag of a tank: the rule of the tag itself if there is one, else the rule of its metric
+
+    Args:
+    :columns (dict): tag name -> column name, as returned by tank_registry.tank_tags
+    :tank: tank number
+    :rules (dict): get_rules() by default
+
+    Returns: tag name -> Quality_Rule, tags without a rule are left out
+    """
+    if rules is None:
+        rules = get_rules()
+    result = {}
+    for tag_name, column in columns.items():
+        rule = rules.get(tag_name, rules.get(column_metric(column, tank)))
+        if rule is not None:
+            result[tag_name] = rule
+    return result
+
+
+def spikes(values: np.ndarray, max_step: float) -> np.ndarray:
+    """
+    Samples further than max_step from both neighbours, up on one side and down on the other
+    """
+    spike = np.zeros(len(values), dtype=bool)
+    if len(values) < 3:
+        return spike
+    before = values[1:-1] - values[:-2]
+    after = values[2:] - values[1:-1]
+    spike[1:-1] = (np.abs(before) > max_step) & (np.abs(after) > max_step) & (np.sign(before) != np.sign(after))
+    return spike
+
+
+def flatlines(values: np.ndarray, samples: int) -> np.ndarray:
+    """
+    Samples after the first samples ones of a run of identical values
+    """
+    index = np.arange(len(values))
+    changed = np.ones(len(values), dtype=bool)
+    changed[1:] = values[1:] != values[:-1]
+    run_start = np.maximum.accumulate(np.where(changed, index, 0))
+    return index - run_start >= samples
+
+
+def rejected_samples(time: np.ndarray, values: np.ndarray, rule: Quality_Rule) -> dict:
+    """
+    Vectorized checks of rule on the valid samples of one tag.
+    Each check runs on the samples kept by the previous ones, so a rejected value is not a neighbour in the next check.
+
+    Args:
+    :time (np.ndarray): int64 sample times, sorted
+    :values (np.ndarray): float values, NaN for missing samples
+    :rule (Quality_Rule):
+
+    Returns: reason -> bool mask of the rejected samples, and 'gaps', the number of gaps longer than max_gap
+    """
+    kept = ~np.isnan(values)
+    masks = {}
+    if rule.min_value is not None or rule.max_value is not None:
+        with np.errstate(invalid='ignore'):
+            masks['range'] = kept & ((values < (rule.min_value if rule.min_value is not None else -np.inf)) |
+                                     (values > (rule.max_value if rule.max_value is not None else np.inf)))
+        kept &= ~masks['range']
+    for reason, check, setting in (('spike', spikes, rule.max_step), ('flatline', flatlines, rule.flatline)):
+        if setting is None:
+            continue
+        positions = np.flatnonzero(kept)
+        masks[reason] = np.zeros(len(values), dtype=bool)
+        masks[reason][positions[check(values[positions], setting)]] = True
+        kept &= ~masks[reason]
+
+    if rule.max_gap is not None:
+        masks['gaps'] = int(np.count_nonzero(np.diff(time[kept]) > rule.max_gap.value))
+    return masks
+
+
+def gate_samples(data: pd.DataFrame, rule: Quality_Rule, tag_name: str) -> pd.DataFrame:
+    """
+    Drops the samples of one tag rejected by rule and logs what was rejected
+
+    Args:
+    :data (pd.DataFrame): TimeStamp and Value columns, as returned by NewTest.clean_samples
+    :rule (Quality_Rule):
+    :tag_name (str):
+
+    Returns: the kept samples
+    """
+    if data is None or len(data) == 0 or rule is None or data['Value'].dtype != np.float64:
+        # Text values (e.g. GCAS codes) have no numeric checks
+        return data
+    with instrumentation.stage('quality_gate'):
+        time = pd.DatetimeIndex(data['TimeStamp']).asi8
+        masks = rejected_samples(time, data['Value'].to_numpy(), rule)
+        gaps = masks.pop('gaps', 0)
+        rejected = np.zeros(len(data), dtype=bool)
+        for reason, mask in masks.items():
+            count = int(np.count_nonzero(mask))
+            if count > 0:
+                instrumentation.count('samples_rejected', count, tag=tag_name, reason=reason)
+            rejected |= mask
+
+    if gaps > 0:
+        instrumentation.count('sample_gaps', gaps, tag=tag_name)
+        logging.warning(f'{tag_name}: {gaps} gaps longer than {rule.max_gap}')
+    if rejected.any():
+        reasons = ', '.join(f'{reason} {np.count_nonzero(mask)}' for reason, mask in masks.items() if mask.any())
+        logging.warning(f'{tag_name}: rejected {np.count_nonzero(rejected)} of {len(data)} samples ({reasons})')
+        data = data[~rejected].reset_index(drop=True)
+    return data
+
+
+def gate_tags(tags_data: dict, rules: dict) -> dict:
+    """
+    gate_samples on every tag of tags_data that has a rule
+
+    Args:
+    :tags_data (dict): tag name -> cleaned dataframe, None for tags that failed
+    :rules (dict): tag name -> Quality_Rule, see tag_rules
+
+    Returns: tag name -> kept samples
+    """
+    if not rules:
+        return tags_data
+    return {tag_name: gate_samples(data, rules.get(tag_name), tag_name) for tag_name, data in tags_data.items()}
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+import hashlib
+import importlib.util
+import logging
+import os
+import time
+import uuid
+
+import pandas as pd
+
+# Parquet needs pyarrow, without it the cache falls back to pickle files.
+# Only looked up here, pandas imports it when a cache file is read or written
+CACHE_FORMAT = 'parquet' if importlib.util.find_spec('pyarrow') is not None else 'pkl'
+
+
+class Sample_Cache:
+    """
+    On-disk cache of cleaned Historian samples.
+    One file is stored per (tag, retrieval_mode, cycle_time, window), windows being aligned on
+    multiples of window_size so that overlapping runs share the same entries.
+    Files are evicted once they are older than max_age, or least recently used first when the
+    cache grows beyond max_bytes.
+    """
+    directory = None
+    window_size = None
+    max_bytes = None
+    max_age = None
+
+    def __init__(self, directory: str = './data/cache', window_size: timedelta = timedelta(hours=6),
+                 max_bytes: int = 2 * 1024 ** 3, max_age: timedelta = timedelta(days=90)):
+        self.directory = directory
+        self.window_size = window_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def windows(self, start: datetime, end: datetime) -> list:
+        """
+        Aligned cache windows covering [start, end]
+
+        Returns:
+        :windows (list): list of (window_start, window_end)
+        """
+        midnight = datetime(start.year, start.month, start.day)
+        window_start = midnight + ((start - midnight) // self.window_size) * self.window_size
+        windows = []
+        while window_start <= end:
+            windows.append((window_start, window_start + self.window_size))
+            window_start += self.window_size
+        return windows
+
+    def path(self, tag_name: str, retrieval_mode: str, cycle_time: str, window_start: datetime, window_end: datetime) -> str:
+        """
+        File of a cache entry, the key is hashed as tag names can contain any character
+        """
+        key = f'{tag_name}|{retrieval_mode.lower()}|{cycle_time}|{window_start.isoformat()}|{window_end.isoformat()}'
+        return os.path.join(self.directory, f'{hashlib.sha1(key.encode()).hexdigest()}.{CACHE_FORMAT}')
+
+    def load(self, tag_name: str, retrieval_mode: str, cycle_time: str, window_start: datetime, window_end: datetime) -> pd.DataFrame:
+        """
+        Returns:
+        :data (pd.DataFrame): None on a cache miss
+        """
+        path = self.path(tag_name, retrieval_mode, cycle_time, window_start, window_end)
+        try:
+            data = pd.read_parquet(path) if CACHE_FORMAT == 'parquet' else pd.read_pickle(path)
+        except (FileNotFoundError, OSError):
+            return None
+        except Exception as e:
+            logging.info(f'Ignoring unreadable cache entry {path}: {e}')
+            return None
+        # Refreshing the modification time keeps recently used entries out of the size eviction
+        os.utime(path)
+        return data
+
+    def store(self, data: pd.DataFrame, tag_name: str, retrieval_mode: str, cycle_time: str, window_start: datetime, window_end: datetime):
+        """
+        Writes an entry atomically, so concurrent readers never see a partial file
+        """
+        path = self.path(tag_name, retrieval_mode, cycle_time, window_start, window_end)
+        temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        if CACHE_FORMAT == 'parquet':
+            data.to_parquet(temp_path, index=False)
+        else:
+            data.to_pickle(temp_path)
+        os.replace(temp_path, path)
+
+    def evict(self):
+        """
+        Removes entries older than max_age, then the least recently used ones until the cache fits in max_bytes
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+
+        expiry = time.time() - self.max_age.total_seconds()
+        total_bytes = sum(size for mtime, size, path in entries)
+        removed = 0
+        for mtime, size, path in entries:
+            if mtime >= expiry and total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_bytes -= size
+            removed += 1
+        if removed:
+            logging.info(f'Evicted {removed} cache entries, {total_bytes / 1024 ** 2:.1f} MB left')
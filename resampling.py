@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Alignment of the raw extraction on a fixed time grid, ahead of data_transformation.
+The transformation works row by row, which only makes sense when rows are evenly spaced;
+raw-by-time extractions return the samples where the Historian stored them, at irregular times.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+
+# Policy of each metric, by column prefix: measurements are interpolated in time, pump states and
+# products hold their last value. Columns without a policy (e.g. extra pumps) hold their last value too.
+RESAMPLE_POLICIES = {'Level': 'linear', 'Temp.': 'linear', 'Density': 'linear', 'Kilos': 'linear',
+                     'Discharge': 'linear', 'PumpRunning': 'ffill', 'GCAS': 'ffill'}
+POLICIES = ('linear', 'ffill', 'nearest')
+
+
+def column_policies(raw_data: pd.DataFrame, tags: pd.DataFrame, policies: dict = None) -> dict:
+    """
+    Policy of every column of raw_data
+
+    Args:
+    :raw_data (pd.DataFrame): wide frame produced by the extraction
+    :tags (pd.DataFrame): contents of 'Tags Mapping.csv', its tanks' pump columns follow the PumpRunning policy
+    :policies (dict): overrides of RESAMPLE_POLICIES
+
+    Returns: column name -> 'linear', 'ffill' or 'nearest'
+    """
+    policies = {**RESAMPLE_POLICIES, **(policies or {})}
+    unknown = set(policies.values()) - set(POLICIES)
+    if unknown:
+        raise ValueError(f'Unknown resampling policies {unknown}')
+
+    pumps = {f'{tank}' for tank in tags['Tank']}
+    result = {}
+    for column in raw_data.columns:
+        if column == 'Time':
+            continue
+        if column in pumps:
+            result[column] = policies['PumpRunning']
+            continue
+        metric = column.split(' ')[0]
+        result[column] = policies.get(metric, 'ffill')
+    return result
+
+
+def make_grid(time: pd.DatetimeIndex, resolution) -> pd.DatetimeIndex:
+    """
+    Fixed grid at resolution covering the samples, aligned on multiples of resolution
+    so that consecutive runs share the same grid points
+    """
+    return pd.date_range(time.min().ceil(resolution), time.max().floor(resolution), freq=resolution, name='Time')
+
+
+def surrounding_samples(time: np.ndarray, valid: np.ndarray, grid: np.ndarray) -> tuple:
+    """
+    For every grid point and column, the last valid sample at or before it and the first valid sample after it
+
+    Args:
+    :time (np.ndarray): int64 sample times, sorted
+    :valid (np.ndarray): bool array of shape (samples, columns)
+    :grid (np.ndarray): int64 grid times
+
+    Returns: (previous, following) row positions of shape (grid, columns), -1 and len(time) when there is none
+    """
+    rows = len(time)
+    index = np.arange(rows).reshape(-1, 1)
+    previous = np.maximum.accumulate(np.where(valid, index, -1), axis=0)
+    following = np.minimum.accumulate(np.where(valid, index, rows)[::-1], axis=0)[::-1]
+    position = np.searchsorted(time, grid, side='right') - 1
+    previous = np.where(position.reshape(-1, 1) >= 0, previous[position.clip(0)], -1)
+    after = position + 1
+    following = np.where(after.reshape(-1, 1) < rows, following[after.clip(max=rows - 1)], rows)
+    return previous, following
+
+
+def resample_values(time: np.ndarray, values: np.ndarray, grid: np.ndarray, policy: str, max_gap: int = None) -> np.ndarray:
+    """
+    Resamples the columns of a 2D float array sharing a policy, all columns at once
+
+    Args:
+    :time (np.ndarray): int64 sample times, sorted
+    :values (np.ndarray): float array of shape (samples, columns), NaN for missing samples
+    :grid (np.ndarray): int64 grid times
+    :policy (str): 'linear' interpolates in time, 'ffill' holds the last value, 'nearest' takes the closest sample
+    :max_gap (int): nanoseconds, grid points in a longer gap between valid samples are left missing
+
+    Returns: float array of shape (grid, columns)
+    """
+    rows = len(time)
+    previous, following = surrounding_samples(time, ~np.isnan(values), grid)
+    columns = np.broadcast_to(np.arange(values.shape[1]), previous.shape)
+    has_previous = previous >= 0
+    has_following = following < rows
+    left = np.where(has_previous, values[previous.clip(0), columns], np.nan)
+    right = np.where(has_following, values[following.clip(max=rows - 1), columns], np.nan)
+    left_time = time[previous.clip(0)]
+    right_time = time[following.clip(max=rows - 1)]
+    at = grid.reshape(-1, 1)
+
+    exact = has_previous & (at == left_time)
+    if policy == 'ffill':
+        result = left
+    elif policy == 'linear':
+        span = np.where(right_time > left_time, right_time - left_time, 1)
+        result = np.where(has_previous & has_following, left + (right - left) * ((at - left_time) / span), np.nan)
+        # Exactly on a sample, the sample is kept as is
+        result = np.where(exact, left, result)
+    else:
+        closer_left = has_previous & (~has_following | ((at - left_time) <= (right_time - at)))
+        result = np.where(closer_left, left, right)
+    if max_gap is not None:
+        gap = np.where(has_following, right_time, at) - left_time
+        result = np.where(has_previous & ~exact & (gap > max_gap), np.nan, result)
+    return result
+
+
+def resample_raw_data(raw_data: pd.DataFrame, tags: pd.DataFrame, resolution, policies: dict = None,
+                      max_gap=None) -> pd.DataFrame:
+    """
+    Aligns every column of the extraction on a fixed grid, so data_transformation works on evenly spaced rows.
+    A coarser resolution gives fewer rows and less memory at the cost of detail.
+
+    Args:
+    :raw_data (pd.DataFrame): wide frame produced by the extraction, with a Time column
+    :tags (pd.DataFrame): contents of 'Tags Mapping.csv'
+    :resolution: grid step, e.g. '2min' or a pd.Timedelta
+    :policies (dict): metric -> policy overrides of RESAMPLE_POLICIES
+    :max_gap: grid points in a longer gap between samples are left missing, e.g. '1h'. No limit by default
+
+    Returns: frame with the columns of raw_data, one row per grid point
+    """
+    resolution = pd.Timedelta(resolution)
+    raw_data = raw_data[raw_data['Time'].notna()]
+    time_index = pd.DatetimeIndex(pd.to_datetime(raw_data['Time']))
+    if len(time_index) == 0:
+        return raw_data.reset_index(drop=True)
+    if not time_index.is_monotonic_increasing:
+        order = np.argsort(time_index.asi8, kind='stable')
+        raw_data, time_index = raw_data.iloc[order], time_index[order]
+
+    with instrumentation.stage('resample'):
+        grid = make_grid(time_index, resolution)
+        time, grid_time = time_index.asi8, grid.asi8
+        gap = pd.Timedelta(max_gap).value if max_gap is not None else None
+        column_policy = column_policies(raw_data, tags, policies)
+
+        columns = {'Time': grid}
+        numeric = {}
+        for column, policy in column_policy.items():
+            if pd.api.types.is_numeric_dtype(raw_data[column].dtype):
+                numeric.setdefault(policy, []).append(column)
+                continue
+            # Strings and categories can only hold their last value
+            previous = surrounding_samples(time, raw_data[column].notna().to_numpy().reshape(-1, 1), grid_time)[0][:, 0]
+            columns[column] = raw_data[column].iloc[previous.clip(0)].reset_index(drop=True).where(previous >= 0)
+
+        for policy, names in numeric.items():
+            values = raw_data[names].to_numpy(dtype=np.float64, na_value=np.nan)
+            resampled = resample_values(time, values, grid_time, policy, gap)
+            for i, column in enumerate(names):
+                columns[column] = pd.Series(resampled[:, i])
+                dtype = raw_data[column].dtype
+                if dtype != np.float64:
+                    try:
+                        columns[column] = columns[column].astype(dtype)
+                    except (TypeError, ValueError):
+                        # e.g. an Int8 pump interpolated to fractions, kept as floats
+                        pass
+
+        resampled_df = pd.DataFrame(columns)[list(raw_data.columns)]
+    instrumentation.count('rows_resampled', len(resampled_df))
+    logging.info(f'Resampled {len(raw_data)} rows to {len(resampled_df)} rows every {resolution}')
+    return resampled_df
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Resident mode of the pipeline: one process keeps the Historian connection, its token, the tank registry
+and the per-tank Event_Stream state warm, and every few minutes extracts the samples received since
+the previous batch and appends the events they close to the results.
+"""
+from datetime import datetime, timedelta
+import logging
+import threading
+
+import pandas as pd
+
+from BTFeTL import finalize_results, get_exception
+from event_stream import Event_Stream
+from historian import Historian_Connection
+import instrumentation
+import NewTest
+from tank_registry import get_registry, tank_tags
+
+
+def missing_tanks(raw_data: pd.DataFrame, tag_table: pd.DataFrame) -> list:
+    """
+    Tanks of tag_table with a column missing from raw_data: the extraction of the tank or of one of its tags failed.
+    Tags without samples are all-NA columns, not missing ones
+
+    Returns: tank numbers
+    """
+    columns = set(raw_data.columns) if raw_data is not None else set()
+    return [row['Tank number'] for index, row in tag_table.iterrows()
+            if not set(tank_tags(row).values()) <= columns]
+
+
+class Pipeline_Service:
+    """
+    Scheduled micro-batches on a warm connection.
+    Each batch covers [watermark, now - lag], aligned on the cycle time so the sampled and interpolated
+    endpoints return the same timestamps from one batch to the next; lag leaves the Historian time to receive
+    late samples. The Event_Stream and its watermark are saved after every batch, so a restarted service
+    resumes where it stopped, and a failed batch is retried over the same range at the next interval.
+    The watermark does not move either while a tank fails to extract: the next batch fetches its range again,
+    and the tanks already fed ignore the samples they have received.
+    Batches bypass the sample cache, which stores whole windows and would fetch a window for every batch.
+    """
+    historian_conn = None
+    state_path = None
+    interval = None
+    lag = None
+    lookback = None
+    cycle_time = None
+    max_concurrency = None
+    output_path = None
+    writer = None
+    stream = None
+
+    def __init__(self, historian_conn: Historian_Connection, state_path: str = './data/Transform State.pkl',
+                 interval: timedelta = timedelta(minutes=5), lag: timedelta = timedelta(minutes=2),
+                 lookback: timedelta = timedelta(hours=24), cycle_time: str = '120000', max_concurrency: int = 10,
+                 output_path: str = None, writer=None):
+        """
+        Args:
+        :historian_conn (Historian_Connection): connection with a token, renewed before it expires
+        :state_path (str): file the Event_Stream and the watermark are kept in
+        :interval (timedelta): time between the start of two batches
+        :lag (timedelta): samples younger than this are left to the next batch
+        :lookback (timedelta): range of the first batch when there is no saved watermark
+        :cycle_time (str): milliseconds between samples
+        :max_concurrency (int): tanks extracted concurrently
+        :output_path (str): results file, './data/Daily Results {today}.csv' by default
+        :writer: output stage from output_writers, make_writer(path=output_path) by default
+        """
+        self.historian_conn = historian_conn
+        self.state_path = state_path
+        self.interval = interval
+        self.lag = lag
+        self.lookback = lookback
+        self.cycle_time = cycle_time
+        self.max_concurrency = max_concurrency
+        self.output_path = output_path
+        self.writer = writer
+        self.stream = Event_Stream.load(state_path)
+        self._stop = threading.Event()
+
+    def batch_range(self, now: datetime) -> tuple:
+        """
+        Returns: (start, end) of the next batch, end is None when there is nothing new to extract yet
+        """
+        cycle = timedelta(milliseconds=int(self.cycle_time))
+        end = datetime.min + ((now - self.lag - datetime.min) // cycle) * cycle
+        start = self.stream.watermark
+        if start is None:
+            start = end - self.lookback
+        return start, end if end > start else None
+
+    def run_batch(self, now: datetime = None) -> pd.DataFrame:
+        """
+        Extracts the samples since the watermark, feeds them to the Event_Stream and writes the closed events
+
+        Args:
+        :now (datetime): UTC time of the batch, datetime.utcnow() by default
+
+        Returns: the events written, None when there was nothing to extract
+        """
+        start, end = self.batch_range(now if now is not None else datetime.utcnow())
+        if end is None:
+            return None
+
+        batch_start = datetime.now()
+        logging.info(f'Micro-batch from {start} to {end}')
+        with instrumentation.stage('micro_batch'):
+            self.historian_conn.ensure_token()
+            # The registry is only read again when one of its files changed
+            registry = get_registry()
+            tag_table = registry.tag_table()
+            raw_data = NewTest.extract_all_tanks(self.historian_conn, tag_table, self.cycle_time,
+                                                 start.strftime(NewTest.TIME_FORMAT), end.strftime(NewTest.TIME_FORMAT),
+                                                 self.max_concurrency)
+            missing = missing_tanks(raw_data, tag_table)
+            tags = registry.tags_mapping()
+            if missing:
+                instrumentation.count('micro_batch_missing_tanks', len(missing))
+                logging.error(f'Tanks {missing} could not be extracted, the watermark stays at {start}')
+                tags = tags[~tags['Tank'].astype(str).isin([str(tank) for tank in missing])]
+            if raw_data is None or len(raw_data) == 0 or len(tags) == 0:
+                logging.info('No new samples')
+                results_df = None
+            else:
+                results_df = self.stream.update(raw_data.rename(columns={'TimeStamp': 'Time'}), tags)
+                results_df = finalize_results(results_df, batch_start, self.output_path, append=True, writer=self.writer)
+            if not missing:
+                self.stream.watermark = end
+            self.stream.save(self.state_path)
+        instrumentation.count('micro_batches')
+        return results_df
+
+    def serve(self, max_batches: int = None):
+        """
+        Runs a batch every interval until stop is called (or max_batches batches ran).
+        A failing batch is logged, the watermark is not moved so its samples are fetched again by the next one.
+        """
+        batches = 0
+        while not self._stop.is_set():
+            started = datetime.now()
+            try:
+                self.run_batch()
+            except Exception as e:
+                instrumentation.count('micro_batch_failures')
+                logging.exception('Micro-batch failed\n')
+                logging.exception(get_exception())
+            batches += 1
+            if max_batches is not None and batches >= max_batches:
+                break
+            self._stop.wait(max((self.interval - (datetime.now() - started)).total_seconds(), 0))
+
+    def stop(self):
+        """
+        Makes serve return once the current batch is done, e.g. from a SIGTERM handler
+        """
+        self._stop.set()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tank configuration of the site, loaded once from './data/Tags Mapping.csv', './data/T2 Tags.csv'
+and the optional './data/Tank Capacities.csv', validated, and kept for the lifetime of the process.
+"""
+import logging
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+MAPPING_PATH = './data/Tags Mapping.csv'
+TAGS_PATH = './data/T2 Tags.csv'
+CAPACITIES_PATH = './data/Tank Capacities.csv'
+
+# Capacity of the underground tanks, their quantities are computed from the level only.
+# './data/Tank Capacities.csv' (Tank, Capacity) adds tanks or overrides these
+DEFAULT_CAPACITIES = {'12': 122506, '8944': 156692, '8945': 217054, '2230E': 25374, '2230W': 25965, '2232E': 29767,
+                      '2232W': 26286, '2633E': 32914, '2633W': 32914, '30C': 25815, '30E': 21822, '30W': 21585,
+                      '40E': 35015, '40W': 34858}
+
+# Historian tag fields of 'T2 Tags.csv' and the prefix of the column they are extracted to
+TAG_FIELDS = {'tIT': 'Temp. ', 'LIT': 'Level ', 'Unload Pump': '', 'Density': 'Density ', 'Kilo': 'Kilos ', 'GCAS': 'GCAS '}
+
+# Columns of a tank in the extracted frame, in the order of the positions returned by column_positions
+TANK_COLUMNS = {'Level': 'Level {}', 'Temp.': 'Temp. {}', 'Density': 'Density {}', 'Kilos': 'Kilos {}',
+                'Disc_Output': 'Discharge {}', 'GCAS': 'GCAS {}', 'PumpRunning': '{}'}
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def split_pumps(extra_pumps) -> tuple:
+    """
+    Pump columns of the extra unload spots of a tank
+
+    Args:
+    :extra_pumps: comma separated string as in 'Tags Mapping.csv', NaN, or already split
+
+    Returns: tuple of column names, empty when the tank has a single unload spot
+    """
+    if isinstance(extra_pumps, (tuple, list)):
+        return tuple(extra_pumps)
+    if pd.isna(extra_pumps) or str(extra_pumps).strip() == '':
+        return ()
+    return tuple(pump.strip() for pump in str(extra_pumps).split(',') if pump.strip())
+
+
+def tank_tags(row) -> dict:
+    """
+    Historian tags of a 'T2 Tags.csv' row, see TAG_FIELDS
+
+    Returns: tag name -> column of the extracted frame
+    """
+    tank = row['Tank number']
+    return {row[field]: f'{prefix}{tank}' for field, prefix in TAG_FIELDS.items()}
+
+
+class Tank_Config:
+    """
+    Everything the extraction and transformation need to know about one tank
+    """
+    tank = None
+    extra_pumps = None
+    capacity = None
+    columns = None
+
+    def __init__(self, tank, extra_pumps=(), capacity: float = np.nan):
+        """
+        Args:
+        :tank: tank number
+        :extra_pumps: pump columns OR-ed with the tank's own pump, or the 'Extra Pumps' cell, see split_pumps
+        :capacity (float): capacity of underground tanks, NaN when the quantity comes from density and volume
+        """
+        self.tank = tank
+        self.extra_pumps = split_pumps(extra_pumps)
+        self.capacity = capacity
+        self.columns = {metric: column.format(tank) for metric, column in TANK_COLUMNS.items()}
+
+    @property
+    def pump_group(self) -> tuple:
+        """
+        Pump columns whose OR gives the PumpRunning state of the tank
+        """
+        return (self.columns['PumpRunning'],) + self.extra_pumps
+
+    @property
+    def numeric_columns(self) -> list:
+        """
+        Columns the transformation reads as numbers: the metrics, Disc_Output and the pump group
+        """
+        return [self.columns[metric] for metric in ('Level', 'Temp.', 'Density', 'Kilos', 'Disc_Output')] + list(self.pump_group)
+
+
+class Tank_Registry:
+    """
+    Validated tank configuration, in 'Tags Mapping.csv' order.
+    The mapping and tag tables are kept in the shape of the csv files for the functions taking them as DataFrames,
+    with tank numbers always read as strings.
+    """
+    tanks = None
+    tag_data = None
+    signature = None
+
+    def __init__(self, tanks: dict, tag_data: pd.DataFrame = None, signature: tuple = None):
+        self.tanks = tanks
+        self.tag_data = tag_data
+        self.signature = signature
+
+    @classmethod
+    def load(cls, mapping_path: str = MAPPING_PATH, tags_path: str = TAGS_PATH, capacities_path: str = CAPACITIES_PATH):
+        """
+        Reads and validates the configuration files, 'T2 Tags.csv' and the capacities are optional
+
+        Returns: Tank_Registry
+        """
+        mapping = read_table(mapping_path, 'Tank')
+        if 'Extra Pumps' not in mapping.columns:
+            mapping['Extra Pumps'] = np.nan
+        tag_data = read_table(tags_path, 'Tank number', list(TAG_FIELDS)) if os.path.exists(tags_path) else None
+
+        capacities = dict(DEFAULT_CAPACITIES)
+        if capacities_path is not None and os.path.exists(capacities_path):
+            capacity_table = read_table(capacities_path, 'Tank', ['Capacity'])
+            values = pd.to_numeric(capacity_table['Capacity'], errors='coerce')
+            if not (values > 0).all():
+                raise ValueError(f'{capacities_path}: capacities must be positive numbers')
+            capacities.update(zip(capacity_table['Tank'], values))
+
+        if tag_data is not None:
+            unmapped = [tank for tank in tag_data['Tank number'] if tank not in set(mapping['Tank'])]
+            if unmapped:
+                logging.warning(f'{tags_path}: tanks {unmapped} are extracted but not in {mapping_path}')
+
+        tanks = {}
+        for index, row in mapping.iterrows():
+            tank = row['Tank']
+            tanks[tank] = Tank_Config(tank, row['Extra Pumps'], capacities.get(tank, np.nan))
+
+        pump_columns = {config.columns['PumpRunning'] for config in tanks.values()}
+        for config in tanks.values():
+            unknown = [pump for pump in config.extra_pumps if pump not in pump_columns]
+            if unknown:
+                logging.warning(f'{mapping_path}: extra pumps {unknown} of tank {config.tank} are not pumps of another tank')
+
+        signature = tuple(file_signature(path) for path in (mapping_path, tags_path, capacities_path))
+        logging.info(f'Loaded {len(tanks)} tanks from {mapping_path}')
+        return cls(tanks, tag_data, signature)
+
+    def tags_mapping(self) -> pd.DataFrame:
+        """
+        Returns: Tank, Extra Pumps and Capacity of every tank, the 'Tags Mapping.csv' table the transformation takes
+        """
+        return pd.DataFrame({'Tank': [config.tank for config in self.tanks.values()],
+                             'Extra Pumps': [', '.join(config.extra_pumps) if config.extra_pumps else np.nan
+                                             for config in self.tanks.values()],
+                             'Capacity': [config.capacity for config in self.tanks.values()]})
+
+    def tag_table(self) -> pd.DataFrame:
+        """
+        Returns: contents of 'T2 Tags.csv', the table the extraction takes
+        """
+        if self.tag_data is None:
+            raise FileNotFoundError('The registry was loaded without a T2 Tags file')
+        return self.tag_data.copy()
+
+
+def read_table(path: str, key: str, required: list = ()) -> pd.DataFrame:
+    """
+    Reads a configuration csv with every column as strings, checking its columns and the uniqueness of key
+    """
+    table = pd.read_csv(path, dtype=str)
+    table.columns = [column.strip() for column in table.columns]
+    missing = [column for column in [key] + list(required) if column not in table.columns]
+    if missing:
+        raise ValueError(f'{path}: missing columns {missing}')
+    table = table[table[key].notna()].reset_index(drop=True)
+    table[key] = table[key].str.strip()
+    duplicated = table.loc[table[key].duplicated(), key].tolist()
+    if duplicated:
+        raise ValueError(f'{path}: duplicated {key} {duplicated}')
+    return table
+
+
+def file_signature(path: str) -> tuple:
+    if path is None or not os.path.exists(path):
+        return (path, None)
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def column_positions(columns: pd.Index, tanks: list) -> np.ndarray:
+    """
+    Positions of the TANK_COLUMNS of tanks in columns, with a single lookup
+
+    Returns: int array of shape (tanks, len(TANK_COLUMNS)), -1 for missing columns
+    """
+    names = [column.format(tank) for tank in tanks for column in TANK_COLUMNS.values()]
+    return pd.Index(columns).get_indexer(names).reshape(len(tanks), len(TANK_COLUMNS))
+
+
+def get_registry(mapping_path: str = MAPPING_PATH, tags_path: str = TAGS_PATH,
+                 capacities_path: str = CAPACITIES_PATH) -> Tank_Registry:
+    """
+    Registry of the process, loaded on first use and reloaded only when one of its files changes,
+    so long-running processes pick up configuration edits without re-reading the files on every run
+    """
+    global _registry
+    signature = tuple(file_signature(path) for path in (mapping_path, tags_path, capacities_path))
+    with _registry_lock:
+        if _registry is None or _registry.signature != signature:
+            _registry = Tank_Registry.load(mapping_path, tags_path, capacities_path)
+        return _registry
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pytest
+
+# The modules are flat scripts at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.stub_historian import Stub_Historian
+from bench.synthetic import make_raw_data, make_tag_table, make_tags_mapping, tag_columns
+from historian import Historian_Connection
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """
+    Runs the test in an empty directory with the './data' files of the synthetic tanks,
+    as the pipeline reads its configuration and writes its results relative to the working directory
+    """
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data')
+    os.makedirs('logs')
+    make_tags_mapping(10).to_csv('data/Tags Mapping.csv', index=False)
+    return tmp_path
+
+
+@pytest.fixture
+def historian(workdir):
+    """
+    Stub Historian serving 2 tanks over a day, with the matching './data' registry files
+    """
+    tag_table = make_tag_table(2)
+    tag_table.to_csv('data/T2 Tags.csv', index=False)
+    make_tags_mapping(2).to_csv('data/Tags Mapping.csv', index=False)
+    stub = Stub_Historian(make_raw_data(2, 1), tag_columns(tag_table))
+    base_url = stub.start()
+    yield stub, Historian_Connection('user', 'password', 'site', f'{base_url}/token', 'client', 'secret',
+                                     base_url=base_url)
+    stub.stop()
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+
+import NewTest
+
+
+def samples(time_stamps: list, values: list) -> pd.DataFrame:
+    return pd.DataFrame({'TimeStamp': pd.to_datetime(time_stamps, utc=True), 'Value': np.array(values, dtype=np.float64)})
+
+
+TIME = ['2024-03-01 00:00', '2024-03-01 00:02', '2024-03-01 00:04', '2024-03-01 00:06']
+
+
+def test_series_are_aligned_on_timestamps_whatever_their_order():
+    tags_data = {'A': samples(TIME, [1, 2, 3, 4]),
+                 'B': samples(TIME[::-1], [4, 3, 2, 1]),
+                 'C': samples([TIME[3], TIME[1]], [40, 20]),
+                 'D': samples([], []),
+                 'E': None}
+    results = NewTest.assemble_tags(list(tags_data), tags_data)
+
+    assert list(results.columns) == ['TimeStamp', 'A', 'B', 'C', 'D']
+    assert results['TimeStamp'].is_monotonic_increasing
+    assert list(results['A']) == [1, 2, 3, 4]
+    assert list(results['B']) == [1, 2, 3, 4]
+    assert results['C'].isna().tolist() == [True, False, True, False]
+    assert list(results['C'].dropna()) == [20, 40]
+    assert results['D'].isna().all()
+
+
+def test_partial_series_extend_the_union():
+    tags_data = {'A': samples(TIME[2:][::-1], [3, 2]), 'B': samples(TIME[:3], [10, 20, 30])}
+    results = NewTest.assemble_tags(['A', 'B'], tags_data)
+
+    assert list(results['TimeStamp']) == list(pd.to_datetime(TIME[:4], utc=True))
+    assert results['A'].tolist()[2:] == [2, 3]
+    assert results['A'].isna().tolist()[:2] == [True, True]
+    assert results['B'].tolist()[:3] == [10, 20, 30]
@@ -0,0 +1,49 @@
+import dotenv.main
+import pytest
+
+import btf
+
+REQUIRED = ['client_id', 'client_secret', 'ion_username', 'ion_password', 'server', 'token_url']
+
+
+@pytest.fixture
+def env_file(workdir, monkeypatch):
+    """
+    Empty environment, with load_dotenv reading './.env' of the test directory
+    """
+    for variable in REQUIRED:
+        # Set first, so the values loaded from the .env file are removed after the test
+        monkeypatch.setenv(variable, '')
+        monkeypatch.delenv(variable)
+    open('data/T2 Tags.csv', 'w').close()
+    monkeypatch.setattr(dotenv.main, 'find_dotenv', lambda *args, **kwargs: str(workdir / '.env'))
+    return workdir / '.env'
+
+
+def test_dry_run_reads_the_env_file(env_file):
+    env_file.write_text(''.join(f'{variable}=value\n' for variable in REQUIRED))
+    assert btf.main(['extract', '--dry-run']) == 0
+
+
+def test_dry_run_fails_without_a_required_variable(env_file, capsys):
+    env_file.write_text(''.join(f'{variable}=value\n' for variable in REQUIRED if variable != 'token_url'))
+    assert btf.main(['extract', '--dry-run']) == 1
+    assert 'token_url              MISSING' in capsys.readouterr().out
+
+
+def test_backfill_pool_has_a_connection_per_request(historian, monkeypatch):
+    import NewTest
+    stub, historian_conn = historian
+    calls = {}
+    monkeypatch.setenv('max_concurrency', '5')
+    monkeypatch.delenv('raw_cache_dir', raising=False)
+    monkeypatch.delenv('metrics_path', raising=False)
+
+    def connect(pool_size=None):
+        calls['pool_size'] = pool_size
+        return historian_conn
+
+    monkeypatch.setattr(btf, 'connect', connect)
+    monkeypatch.setattr(NewTest, 'backfill', lambda *args, **kwargs: calls.update(kwargs))
+    assert btf.main(['run', '--start', '2024-03-01', '--end', '2024-03-02', '--parallel-windows', '3']) == 0
+    assert calls['pool_size'] == calls['max_parallel_windows'] * calls['max_concurrency'] == 15
@@ -0,0 +1,107 @@
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+import BTFeTL
+import instrumentation
+from bench.synthetic import make_raw_data, make_tags_mapping
+from event_stream import Event_Stream, chunked_transformation
+
+CHUNK = 100
+MAX_GAP = 60
+
+
+@pytest.fixture
+def dead_sensor():
+    """
+    Two tanks over 3 days, the density sensor of the first one stops reporting after a few hours
+    """
+    raw_data = make_raw_data(2, 3)
+    raw_data.loc[200:, 'Density 2230E'] = float('nan')
+    return raw_data
+
+
+def test_dead_sensor_does_not_hold_back_the_stream(workdir, dead_sensor):
+    tags = make_tags_mapping(2)
+    tags.to_csv('data/Tags Mapping.csv', index=False)
+    stream = Event_Stream(max_gap=MAX_GAP)
+    frames = []
+    for start in range(0, len(dead_sensor), CHUNK):
+        frames.append(stream.update(dead_sensor.iloc[start:start + CHUNK], tags))
+        assert len(stream.tanks['2230E']['pending']) <= MAX_GAP + CHUNK
+    streamed = BTFeTL.collect_results(frames)
+    assert (streamed['Tank'] == '2230E').sum() > 0
+    streamed = BTFeTL.collect_results([streamed, stream.flush(tags)])
+
+    # The trailing gap is filled with the last density, as data_transformation does
+    BTFeTL.data_transformation(dead_sensor.copy(), output_path='results.csv')
+    BTFeTL.finalize_results(streamed, datetime.now(), output_path='streamed.csv')
+    order = ['Tank', 'Event Type', 'Event_Id']
+    expected = pd.read_csv('results.csv').sort_values(order, ignore_index=True)
+    streamed = pd.read_csv('streamed.csv').sort_values(order, ignore_index=True)
+    # The stream sizes the tanks with the running UsableTankVolume mean, not the one of the whole data
+    pd.testing.assert_frame_equal(streamed.drop(columns='Event_rate(Appr.)'), expected.drop(columns='Event_rate(Appr.)'),
+                                  rtol=1e-9)
+
+
+@pytest.mark.parametrize('extension', ['csv', 'parquet'])
+def test_chunked_transformation_with_dead_sensor(workdir, dead_sensor, monkeypatch, extension):
+    if extension == 'parquet':
+        pytest.importorskip('pyarrow')
+    make_tags_mapping(2).to_csv('data/Tags Mapping.csv', index=False)
+    path = f'raw.{extension}'
+    if extension == 'csv':
+        dead_sensor.to_csv(path, index=False)
+    else:
+        dead_sensor.to_parquet(path, index=False, row_group_size=CHUNK)
+
+    pending = []
+    advance_tank = Event_Stream.advance_tank
+
+    def recording_advance_tank(self, tank, *args, **kwargs):
+        result = advance_tank(self, tank, *args, **kwargs)
+        if tank in self.tanks:
+            pending.append(len(self.tanks[tank]['pending']))
+        return result
+
+    monkeypatch.setattr(Event_Stream, 'advance_tank', recording_advance_tank)
+    chunked_transformation(path, CHUNK, output_path='chunked.csv', max_gap=MAX_GAP)
+    assert max(pending) <= MAX_GAP + CHUNK
+
+    BTFeTL.data_transformation(dead_sensor.copy(), output_path='results.csv')
+    pd.testing.assert_frame_equal(pd.read_csv('chunked.csv'), pd.read_csv('results.csv'), rtol=1e-12)
+
+
+def test_chunked_transformation_holds_the_last_value_over_long_outages(workdir, caplog):
+    make_tags_mapping(2).to_csv('data/Tags Mapping.csv', index=False)
+    raw_data = make_raw_data(2, 3)
+    # 30 hours without level, longer than MAX_GAP_ROWS, then the sensor reports again
+    raw_data.loc[500:1399, 'Level 2230E'] = float('nan')
+    raw_data.to_csv('raw.csv', index=False)
+    BTFeTL.data_transformation(raw_data.copy(), output_path='results.csv')
+    expected = pd.read_csv('results.csv')
+
+    instrumentation.METRICS.reset()
+    chunked_transformation('raw.csv', CHUNK, output_path='chunked.csv')
+    chunked = pd.read_csv('chunked.csv')
+    counters = [counter for counter in instrumentation.METRICS.snapshot()['counters']
+                if counter['counter'] == 'stream_forced_fills']
+    assert counters == [{'counter': 'stream_forced_fills', 'labels': {'metric': 'Level', 'tank': '2230E'}, 'value': 1}]
+    assert 'no Level sample for more than 720 rows' in caplog.text
+
+    # Same events, the level is held where data_transformation interpolates
+    pd.testing.assert_frame_equal(chunked[chunked['Tank'] == '12'], expected[expected['Tank'] == '12'], rtol=1e-12)
+    level = ['Level (Mean)', 'Level (Min*)', 'Level (Max*)']
+    pd.testing.assert_frame_equal(chunked.drop(columns=level)[['Tank', 'Event Type', 'Event_Id', 'Minutes']],
+                                  expected.drop(columns=level)[['Tank', 'Event Type', 'Event_Id', 'Minutes']])
+    held = chunked[(chunked['Tank'] == '2230E') & (pd.to_datetime(chunked['Event_Id']) > raw_data['Time'][500]) &
+                   (pd.to_datetime(chunked['Event_Id']) + pd.to_timedelta(chunked['Minutes'], unit='min') <
+                    raw_data['Time'][1200])]
+    assert len(held) > 0
+    assert (held['Level (Min*)'] == held['Level (Max*)']).all()
+    assert not chunked[level].equals(expected[level])
+
+    # Without the forced fill the results are the in-memory ones
+    chunked_transformation('raw.csv', CHUNK, output_path='chunked.csv', max_gap=1000)
+    pd.testing.assert_frame_equal(pd.read_csv('chunked.csv'), expected, rtol=1e-12)
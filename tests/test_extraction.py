@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+import instrumentation
+import NewTest
+from tank_registry import get_registry, tank_tags
+
+
+def test_batched_requests_are_labelled_by_tank(historian):
+    stub, historian_conn = historian
+    historian_conn.get_token()
+    bytes_sent = stub.bytes_sent
+    instrumentation.METRICS.reset()
+    tag_table = get_registry().tag_table()
+    NewTest.extract_all_tanks(historian_conn, tag_table, '120000', '2024-03-01T00:00:00.000Z', '2024-03-01T06:00:00.000Z')
+
+    counters = instrumentation.METRICS.snapshot()['counters']
+    http_bytes = {counter['labels'].get('tank'): counter for counter in counters if counter['counter'] == 'http_bytes'}
+    assert set(http_bytes) == {str(tank) for tank in tag_table['Tank number']}
+    for index, row in tag_table.iterrows():
+        assert http_bytes[str(row['Tank number'])]['labels']['tags'] == ';'.join(tank_tags(row))
+    assert sum(counter['value'] for counter in http_bytes.values()) == stub.bytes_sent - bytes_sent
+
+
+@pytest.mark.parametrize('output_format', ['csv', 'parquet'])
+def test_backfill_run_again_replaces_its_results(historian, monkeypatch, output_format):
+    if output_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    monkeypatch.setenv('output_format', output_format)
+    stub, historian_conn = historian
+    tag_table = get_registry().tag_table()
+
+    def run_backfill() -> pd.DataFrame:
+        NewTest.backfill(historian_conn, tag_table, datetime(2024, 3, 1), datetime(2024, 3, 1, 23, 58),
+                         window=timedelta(hours=4), period=timedelta(hours=12), max_parallel_windows=2,
+                         max_concurrency=2, output_path='data/backfill.csv')
+        path = 'data/backfill.csv' if output_format == 'csv' else 'data/backfill'
+        results = pd.read_csv(path) if output_format == 'csv' else pd.read_parquet(path)
+        return results.sort_values(['Tank', 'Event Type', 'Event_Id'], ignore_index=True)
+
+    first = run_backfill()
+    assert len(first) > 0
+    pd.testing.assert_frame_equal(run_backfill(), first)
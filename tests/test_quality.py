@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+import instrumentation
+import NewTest
+import quality
+from quality import Quality_Rule, flatlines, gate_samples, load_rules, rejected_samples, spikes, tag_rules
+
+
+def counters(name: str) -> dict:
+    return {counter['labels']['reason']: counter['value'] for counter in instrumentation.METRICS.snapshot()['counters']
+            if counter['counter'] == name}
+
+
+def test_spikes_go_one_way_then_back():
+    values = np.array([0, 0, 10, 0, 0, 10, 20, 20], dtype=float)
+    # A step up followed by a step down is a spike, two steps up are a ramp
+    assert spikes(values, 5).tolist() == [False, False, True, False, False, False, False, False]
+    assert not spikes(values, 10).any()
+    assert not spikes(values[:2], 5).any()
+
+
+def test_flatlines_keep_the_first_samples_of_a_run():
+    values = np.array([1, 1, 1, 1, 2, 2, 3, 3, 3], dtype=float)
+    assert flatlines(values, 2).tolist() == [False, False, True, True, False, False, False, False, True]
+    assert flatlines(values, 3).tolist() == [False, False, False, True, False, False, False, False, False]
+
+
+def test_checks_run_on_the_samples_kept_by_the_previous_ones():
+    time = np.arange(5, dtype=np.int64)
+    # The out-of-range value is not a spike between its neighbours once it is rejected
+    masks = rejected_samples(time, np.array([10, 10, 500, 10, 10], dtype=float), Quality_Rule(max_value=100, max_step=5))
+    assert masks['range'].tolist() == [False, False, True, False, False]
+    assert not masks['spike'].any()
+
+    # Without the spike, the run of 5 goes on through it
+    masks = rejected_samples(time, np.array([5, 5, 50, 5, 5], dtype=float), Quality_Rule(max_step=10, flatline=3))
+    assert 'range' not in masks
+    assert masks['spike'].tolist() == [False, False, True, False, False]
+    assert masks['flatline'].tolist() == [False, False, False, False, True]
+
+
+def test_gaps_are_counted_between_kept_samples():
+    time = np.array([0, 20, 40], dtype=np.int64) * pd.Timedelta('1min').value
+    rule = Quality_Rule(max_value=100, max_gap='30min')
+    assert rejected_samples(time, np.array([1, 2, 3], dtype=float), rule)['gaps'] == 0
+    assert rejected_samples(time, np.array([1, 200, 3], dtype=float), rule)['gaps'] == 1
+
+
+def test_lab_mode_blanked_samples_are_kept_and_skipped_by_the_checks(monkeypatch):
+    monkeypatch.delenv('quality_codes', raising=False)
+    instrumentation.METRICS.reset()
+    samples = [{'TimeStamp': f'2024-03-01T00:0{minute}:00Z', 'Value': value, 'Quality': code}
+               for minute, (value, code) in enumerate([(50, 3), (200, 0), (51, 1), (52, 3), (-5, 3)])]
+    data = NewTest.clean_samples(samples, 'lab', 'T12.LIT')
+    assert np.isnan(data['Value'][1])
+
+    kept = gate_samples(data, Quality_Rule(min_value=0, max_value=100, max_step=10), 'T12.LIT')
+    # The blanked sample keeps its timestamp, it is neither out of range nor a neighbour of the spike check
+    assert len(kept) == 4
+    assert (kept['Value'][0], kept['Value'][2], kept['Value'][3]) == (50, 51, 52)
+    assert np.isnan(kept['Value'][1])
+    assert counters('samples_rejected') == {'quality': 1, 'range': 1}
+
+
+def test_tag_rules_override_metric_rules():
+    metric_rule, tag_rule, temperature_rule = Quality_Rule(max_value=100), Quality_Rule(max_value=95), Quality_Rule()
+    rules = {'Level': metric_rule, 'T12.LIT': tag_rule, 'Temp.': temperature_rule}
+    columns = {'T12.LIT': 'Level 12', 'T12.TIT': 'Temp. 12', 'T12.PUMP': '12'}
+    assert tag_rules(columns, '12', rules) == {'T12.LIT': tag_rule, 'T12.TIT': temperature_rule}
+    assert tag_rules({'T30E.LIT': 'Level 30E'}, '30E', rules) == {'T30E.LIT': metric_rule}
+
+
+def test_load_rules(tmp_path):
+    path = tmp_path / 'Quality Rules.csv'
+    path.write_text('Metric, Min, Max, Max Step, Flatline Samples, Max Gap\n'
+                    'Level,0,95,15,,30min\n'
+                    'Temp.,-20,150,,,\n'
+                    'T12.LIT,,,,60,\n'
+                    'Kilos,,,,,\n')
+    rules = load_rules(str(path))
+
+    level = rules['Level']
+    assert (level.min_value, level.max_value, level.max_step, level.flatline) == (0, 95, 15, None)
+    assert level.max_gap == pd.Timedelta('30min')
+    assert (rules['Temp.'].min_value, rules['Temp.'].max_value) == (-20, 150)
+    tag = rules['T12.LIT']
+    assert (tag.min_value, tag.max_value, tag.flatline, tag.max_gap) == (None, None, 60, None)
+    assert isinstance(tag.flatline, int)
+    # A row replaces the default rule of its metric, the metrics without one keep theirs
+    assert rules['Kilos'].min_value is None
+    assert rules['Density'].min_value == 0
+    assert set(load_rules(str(tmp_path / 'missing.csv'))) == set(quality.DEFAULT_RULES)
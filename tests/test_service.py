@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from bench.stub_historian import Stub_Historian
+from service import Pipeline_Service
+
+
+def run_batches(service: Pipeline_Service, stub: Stub_Historian, failing: dict) -> list:
+    """
+    Runs 12 hourly batches, failing has the tags the Historian does not know during some of them, by batch number
+    """
+    columns = dict(stub.columns)
+    watermarks = []
+    now = datetime(2024, 3, 1, 4, 3)
+    for batch in range(12):
+        stub.columns = {tag: column for tag, column in columns.items() if tag not in failing.get(batch, [])}
+        service.run_batch(now)
+        watermarks.append(service.stream.watermark)
+        now += timedelta(hours=1)
+    stub.columns = columns
+    return watermarks
+
+
+def test_failed_tank_is_extracted_again(historian):
+    stub, historian_conn = historian
+    kwargs = dict(lookback=timedelta(hours=4), max_concurrency=2)
+    reference = Pipeline_Service(historian_conn, 'data/reference.pkl', output_path='data/reference.csv', **kwargs)
+    run_batches(reference, stub, {})
+
+    service = Pipeline_Service(historian_conn, 'data/state.pkl', output_path='data/results.csv', **kwargs)
+    watermarks = run_batches(service, stub, {3: ['BTF.12.LIT'], 4: ['BTF.12.LIT']})
+    # The watermark waits for the failed tank, then catches up
+    assert watermarks[2] == watermarks[3] == watermarks[4] < watermarks[5]
+    assert service.stream.watermark == reference.stream.watermark
+
+    sort = ['Tank', 'Event Type', 'Event_Id']
+    results = pd.read_csv('data/results.csv').sort_values(sort, ignore_index=True)
+    expected = pd.read_csv('data/reference.csv').sort_values(sort, ignore_index=True)
+    assert (results['Tank'].astype(str) == '12').sum() > 0
+    pd.testing.assert_frame_equal(results, expected)
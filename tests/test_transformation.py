@@ -0,0 +1,57 @@
+import os
+
+import pandas as pd
+import pytest
+
+import BTFeTL
+from bench.synthetic import make_raw_data
+
+# Output of the original per-tank transformation on make_raw_data(10, 3)
+SNAPSHOT_PATH = os.path.join(os.path.dirname(__file__), 'snapshots', 'daily_results.csv')
+
+ENGINES = {'tank': dict(engine='tank', workers=1),
+           'long': dict(engine='long'),
+           'process_pool': dict(engine='tank', workers=2)}
+
+
+@pytest.fixture(scope='module')
+def raw_data():
+    return make_raw_data(10, 3)
+
+
+def transform(raw_data: pd.DataFrame, **kwargs) -> pd.DataFrame:
+    BTFeTL.data_transformation(raw_data.copy(), output_path='results.csv', **kwargs)
+    return pd.read_csv('results.csv')
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_engine_matches_snapshot(workdir, raw_data, engine):
+    results = transform(raw_data, **ENGINES[engine])
+    pd.testing.assert_frame_equal(results, pd.read_csv(SNAPSHOT_PATH), check_exact=True)
+
+
+def test_engines_agree(workdir, raw_data):
+    results = [transform(raw_data, **kwargs) for kwargs in ENGINES.values()]
+    for other in results[1:]:
+        pd.testing.assert_frame_equal(results[0], other, check_exact=True)
+
+
+def single_tank(rows: int = 40) -> pd.DataFrame:
+    """
+    Tank '1' unloading on rows 5-19 then discharging, with an extra spot 'X' that never reported
+    """
+    time = pd.date_range('2024-03-01', periods=rows, freq='2min')
+    pump = [0.0] * 5 + [1.0] * 15 + [0.0] * (rows - 20)
+    level = [50.0]
+    for state in pump[1:]:
+        level.append(level[-1] + (1.0 if state else -0.5))
+    return pd.DataFrame({'Time': time, 'Level 1': level, 'Temp. 1': 40.0, 'Density 1': 1.1,
+                         'Kilos 1': [value * 1000 for value in level], 'GCAS 1': 'A100', '1': pump, 'X': pd.NA})
+
+
+def test_extra_spot_without_samples_is_stopped():
+    raw_data = single_tank()
+    events = BTFeTL.transform_tank(raw_data, '1', 'X')
+    pd.testing.assert_frame_equal(events, BTFeTL.transform_tank(raw_data.drop(columns='X'), '1', float('nan')))
+    assert list(events['Event Type']) == ['Discharge', 'Unloading']
+    assert list(events['Minutes']) == [38.0, 28.0]